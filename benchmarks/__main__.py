@@ -0,0 +1,114 @@
+import argparse
+import json
+import platform
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+import sqlalchemy
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import orm
+from .suite import BENCHMARKS
+
+DEFAULT_BASELINE = Path(__file__).parent / "baseline.json"
+
+
+def make_engine(postgres: bool, workdir: str):
+    if postgres:
+        engine = create_engine(config.get_postgres_uri())
+    else:
+        engine = create_engine(f"sqlite:///{workdir}/bench.db")
+    orm.metadata.create_all(engine)
+    return engine
+
+
+def selected(only=None):
+    # a pattern picks a benchmark if it is part of the results' shared start,
+    # or begins with it and goes on into their parameters
+    return [
+        benchmark
+        for start, benchmark in BENCHMARKS.items()
+        if only is None
+        or any(pattern in start or pattern.startswith(start) for pattern in only)
+    ]
+
+
+def run_suite(engine, only=None):
+    results = {}
+    for benchmark in selected(only):
+        for name, seconds in benchmark(engine).items():
+            if only is None or any(pattern in name for pattern in only):
+                results[name] = seconds
+                print(f"{name:<70} {seconds * 1e6:>12.1f} us", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous and seconds > previous * (1 + tolerance):
+            regressions.append((name, previous, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "--postgres", action="store_true", help="use the app database"
+    )
+    parser.add_argument(
+        "--only",
+        nargs="*",
+        help="run only the benchmarks whose result names start with or contain"
+        " these, e.g. message_bus or product.allocate[batches=10,",
+    )
+    parser.add_argument("--output", type=Path, help="write results as JSON here")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store these results as the baseline",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%"
+    )
+    args = parser.parse_args(argv)
+    if args.only is not None and not selected(args.only):
+        parser.error(f"no benchmark matches --only {' '.join(args.only)}")
+
+    orm.start_mappers()
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_suite(make_engine(args.postgres, workdir), args.only)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "database": "postgres" if args.postgres else "sqlite",
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, sort_keys=True))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+    if not args.baseline.exists():
+        print(f"no baseline at {args.baseline}, nothing to compare", file=sys.stderr)
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for name, previous, seconds in regressions:
+        print(
+            f"REGRESSION {name}: {previous * 1e6:.1f} us -> {seconds * 1e6:.1f} us",
+            file=sys.stderr,
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "HOT-SKU"
+BATCH_COUNTS = [10, 100, 1000, 5000]
+ALLOCATIONS = 500
+
+
+def make_batches(count, rng):
+    today = date.today()
+    return [
+        Batch(
+            f"batch-{i}",
+            SKU,
+            qty=rng.randint(20, 200),
+            eta=None if i % 10 == 0 else today + timedelta(days=rng.randint(1, 365)),
+        )
+        for i in range(count)
+    ]
+
+
+def make_lines(count, rng):
+    return [OrderLine(f"order-{i}", SKU, rng.randint(1, 20)) for i in range(count)]
+
+
+def allocate_by_sorting(batches, line):
+    # what Product.allocate did before it kept an index of its batches
+    batch = next((b for b in sorted(batches) if b.can_allocate(line)), None)
+    if batch is not None:
+        batch.allocate(line)
+        return batch.reference
+
+
+def time_per_allocation(allocate, lines):
+    start = time.perf_counter()
+    for line in lines:
+        allocate(line)
+    return (time.perf_counter() - start) / len(lines)
+
+
+def run(batch_counts=BATCH_COUNTS, allocations=ALLOCATIONS, seed=0):
+    results = []
+    for count in batch_counts:
+        rng = random.Random(seed)
+        batches = make_batches(count, rng)
+        lines = make_lines(allocations, rng)
+
+        product = Product(SKU, batches=batches)
+        indexed = time_per_allocation(product.allocate, lines)
+
+        rng = random.Random(seed)
+        batches = make_batches(count, rng)
+        sorting = time_per_allocation(
+            lambda line: allocate_by_sorting(batches, line), lines
+        )
+        results.append((count, sorting, indexed))
+    return results
+
+
+def main():
+    print(
+        f"{'batches':>8} {'sorted scan (us)':>18} {'indexed (us)':>14} {'speedup':>8}"
+    )
+    for count, sorting, indexed in run():
+        print(
+            f"{count:>8} {sorting * 1e6:>18.1f} {indexed * 1e6:>14.1f}"
+            f" {sorting / indexed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
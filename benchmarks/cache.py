@@ -0,0 +1,68 @@
+import argparse
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import cache, orm
+from allocation.service_layer import unit_of_work
+from .suite import remove_product, seed_product
+
+BATCHES = 50
+LINE_COUNTS = [200, 2_000, 20_000]
+
+
+def load_time(uow, sku, repeat=5):
+    def load():
+        start = time.perf_counter()
+        with uow:
+            product = uow.products.get(sku)
+            for batch in product.batches:
+                batch.available_quantity
+        return time.perf_counter() - start
+
+    return statistics.median(load() for _ in range(repeat))
+
+
+def compare(session_factory, sku):
+    # a hit attaches the cached product to the session; a miss loads it again
+    product_cache = cache.ProductCache()
+    cached = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    with cached:
+        cached.products.get(sku)
+        cached.commit()
+    hit = load_time(cached, sku)
+    miss = load_time(unit_of_work.SqlAlchemyUnitOfWork(session_factory), sku)
+    assert product_cache.stats.hits >= 5
+    return hit, miss
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.cache")
+    parser.add_argument("--batches", type=int, default=BATCHES)
+    parser.add_argument("--lines", type=int, nargs="*", default=LINE_COUNTS)
+    args = parser.parse_args(argv)
+
+    orm.start_mappers()
+    print(f"{'lines':>8} {'hit (ms)':>10} {'miss (ms)':>10} {'hit/miss':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = create_engine(f"sqlite:///{workdir}/cache.db")
+        orm.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        for lines in args.lines:
+            sku = f"CACHE-BENCH-{lines}"
+            with engine.begin() as connection:
+                seed_product(connection, sku, args.batches, lines // args.batches)
+            hit, miss = compare(session_factory, sku)
+            print(
+                f"{lines:>8} {hit * 1e3:>10.1f} {miss * 1e3:>10.1f}"
+                f" {hit / miss:>9.2f}"
+            )
+            with engine.begin() as connection:
+                remove_product(connection, sku)
+
+
+if __name__ == "__main__":
+    main()
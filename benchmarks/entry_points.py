@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+
+# flask_app maps the domain model on import, asgi_app only on lifespan startup
+from allocation.entry_points import asgi_app, flask_app
+
+SKUS = 50
+REQUESTS = 2000
+# sqlite takes one writer at a time, so let the others queue behind it
+CONNECT_ARGS = dict(timeout=60)
+
+
+def make_db(workdir, name):
+    path = f"{workdir}/{name}.db"
+    orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    return path
+
+
+def batches(sku_count):
+    return [
+        dict(ref=f"batch-{i}", sku=f"SKU-{i}", qty=1_000_000, eta=None)
+        for i in range(sku_count)
+    ]
+
+
+def allocations(sku_count, request_count):
+    return [
+        dict(order_id=f"order-{i}", sku=f"SKU-{i % sku_count}", qty=1)
+        for i in range(request_count)
+    ]
+
+
+def flask_requests_per_second(path, sku_count, request_count, threads):
+    session_factory = sessionmaker(
+        bind=create_engine(f"sqlite:///{path}", connect_args=CONNECT_ARGS)
+    )
+    flask_app.make_uow = lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    client = flask_app.app.test_client()
+    for batch in batches(sku_count):
+        client.post("/add-batch", json=batch)
+
+    def allocate(body):
+        assert client.post("/allocate", json=body).status_code == 201
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(allocate, allocations(sku_count, request_count)))
+    return request_count / (time.perf_counter() - start)
+
+
+async def call(app, path, body):
+    request = {"type": "http.request", "body": json.dumps(body).encode()}
+    sent = []
+
+    async def receive():
+        return request
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": "POST", "path": path}, receive, send)
+    return sent[0]["status"]
+
+
+async def asgi_requests_per_second(path, sku_count, request_count, concurrency):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}", connect_args=CONNECT_ARGS
+    )
+    session_factory = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+    app = asgi_app.create_app(
+        lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory)
+    )
+    for batch in batches(sku_count):
+        await call(app, "/add-batch", batch)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def allocate(body):
+        async with slots:
+            assert await call(app, "/allocate", body) == 201
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[allocate(b) for b in allocations(sku_count, request_count)]
+    )
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return request_count / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.entry_points")
+    parser.add_argument("--skus", type=int, default=SKUS)
+    parser.add_argument("--requests", type=int, default=REQUESTS)
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 64])
+    args = parser.parse_args(argv)
+
+    print(f"{'entry point':>12} {'concurrency':>12} {'requests/s':>12}")
+    for concurrency in args.concurrency:
+        with tempfile.TemporaryDirectory() as workdir:
+            flask = flask_requests_per_second(
+                make_db(workdir, "flask"), args.skus, args.requests, concurrency
+            )
+            asgi = asyncio.run(
+                asgi_requests_per_second(
+                    make_db(workdir, "asgi"), args.skus, args.requests, concurrency
+                )
+            )
+        print(f"{'flask':>12} {concurrency:>12} {flask:>12.0f}")
+        print(f"{'asgi':>12} {concurrency:>12} {asgi:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from allocation.adapters import transports
+from allocation.domain import events
+from allocation.service_layer import channels
+
+EVENTS = 20_000
+
+
+class Counter:
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.done = threading.Event()
+
+    def __call__(self, batch):
+        self.received += len(batch)
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def wait_for(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"nothing listening on {path}")
+        time.sleep(0.01)
+
+
+def events_per_second(backend, workdir, event_count, max_batch):
+    counter = Counter(event_count)
+    if backend == "unix-socket":
+        path = f"{workdir}/bench-{max_batch}.sock"
+        receiving = transports.UnixSocketTransport(path)
+        sending = transports.UnixSocketTransport(peers=[path])
+    else:
+        receiving = sending = transports.QueueTransport(multiprocessing.Queue())
+    subscriber = channels.Subscriber(receiving, [events.Allocated], counter)
+    if backend == "unix-socket":
+        wait_for(path)
+    channel = channels.EventChannel(
+        sending, [events.Allocated], max_batch=max_batch, max_queue=event_count
+    )
+    traffic = [
+        events.Allocated(f"order-{i}", f"SKU-{i % 50}", 1, f"batch-{i % 50}")
+        for i in range(event_count)
+    ]
+
+    start = time.perf_counter()
+    for event in traffic:
+        channel.publish([event])  # one at a time, as the message bus does
+    counter.done.wait()
+    elapsed = time.perf_counter() - start
+
+    frames = channel.stats.batches
+    channel.close()
+    subscriber.close()
+    return event_count / elapsed, frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.event_channel")
+    parser.add_argument("--events", type=int, default=EVENTS)
+    parser.add_argument("--max-batch", type=int, nargs="*", default=[1, 10, 100])
+    args = parser.parse_args(argv)
+
+    print(f"{'backend':>12} {'max batch':>10} {'frames':>8} {'events/s':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in ("unix-socket", "queue"):
+            for max_batch in args.max_batch:
+                throughput, frames = events_per_second(
+                    backend, workdir, args.events, max_batch
+                )
+                print(
+                    f"{backend:>12} {max_batch:>10} {frames:>8} {throughput:>10.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
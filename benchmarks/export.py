@@ -0,0 +1,70 @@
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import migrations, orm, repository
+from allocation.entry_points import export
+from .suite import seed_product
+
+SKU = "EXPORT-BENCH-SOFA"
+BATCHES = 10
+LINE_COUNTS = [10_000, 50_000, 200_000]
+
+
+def peak_bytes(run):
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def export_to_csv(engine, chunk_size):
+    def run():
+        with open(os.devnull, "w", newline="") as output:
+            export.export(engine, export.CsvWriter(output), chunk_size=chunk_size)
+
+    return run
+
+
+def load_through_repository(engine):
+    def run():
+        orm.start_mappers()
+        session = sessionmaker(bind=engine)()
+        try:
+            products = repository.SqlAlchemyRepository(session, repository.SELECTIN)
+            product = products.get(SKU)
+            for batch in product.batches:
+                batch.allocated_quantity
+        finally:
+            session.close()
+            clear_mappers()
+
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.export")
+    parser.add_argument("--lines", type=int, nargs="*", default=LINE_COUNTS)
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    args = parser.parse_args(argv)
+
+    print(f"{'rows':>8} {'export MiB':>11} {'repository MiB':>15}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for lines in args.lines:
+            engine = create_engine(f"sqlite:///{workdir}/export-{lines}.db")
+            migrations.migrate(engine)
+            with engine.begin() as connection:
+                seed_product(connection, SKU, BATCHES, lines // BATCHES)
+            exported = peak_bytes(export_to_csv(engine, args.chunk_size))
+            loaded = peak_bytes(load_through_repository(engine))
+            print(f"{lines:>8} {exported / 2**20:>11.1f} {loaded / 2**20:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
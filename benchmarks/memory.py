@@ -0,0 +1,107 @@
+import argparse
+import contextlib
+import gc
+import random
+import tempfile
+import tracemalloc
+from functools import partial
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm, repository
+from allocation.domain import model
+from .suite import product_with_allocations, seed_product
+
+SKU = "MEMORY-BENCH-FLOOR-LAMP"
+BATCHES = 10
+LINES_PER_BATCH = 2_000
+
+
+def bytes_allocated(build):
+    # what `build` leaves allocated, counting only what its result keeps alive;
+    # run once beforehand, so that one-off caches aren't counted
+    build()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+@contextlib.contextmanager
+def interning(enabled):
+    # without it, loaded lines get a copy of the sku per row, as they did
+    # before orm.intern_sku
+    if not enabled:
+        event.remove(model.OrderLine, "load", orm.intern_sku)
+    try:
+        yield
+    finally:
+        if not enabled:
+            event.listen(model.OrderLine, "load", orm.intern_sku)
+
+
+def in_memory(batch_count, lines_per_batch, intern=True):
+    def build():
+        product = product_with_allocations(
+            SKU, batch_count, lines_per_batch, random.Random(0)
+        )
+        if not intern:
+            # a copy of the sku per line, as lines parsed from requests have
+            for batch in product.batches:
+                for line in batch._allocations:
+                    line.sku = SKU.encode().decode()
+        return product
+
+    return build
+
+
+def loaded(session_factory, load_strategy, intern=True):
+    def build():
+        session = session_factory()
+        products = repository.SqlAlchemyRepository(session, load_strategy)
+        with interning(intern):  # lazy loading reads the lines in here
+            product = products.get(SKU)
+            for batch in product.batches:
+                batch.allocated_quantity
+        return session, product
+
+    return build
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.memory")
+    parser.add_argument("--batches", type=int, default=BATCHES)
+    parser.add_argument("--lines-per-batch", type=int, default=LINES_PER_BATCH)
+    args = parser.parse_args(argv)
+    lines = args.batches * args.lines_per_batch
+
+    orm.start_mappers()
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = create_engine(f"sqlite:///{workdir}/memory.db")
+        orm.metadata.create_all(engine)
+        with engine.begin() as connection:
+            seed_product(connection, SKU, args.batches, args.lines_per_batch)
+        session_factory = sessionmaker(bind=engine)
+
+        print(f"{'product':>24} {'bytes/line':>12} {'not interned':>14}")
+        for name, scenario in [
+            ("in memory", partial(in_memory, args.batches, args.lines_per_batch)),
+            ("loaded, lazy", partial(loaded, session_factory, repository.LAZY)),
+            (
+                "loaded, selectin",
+                partial(loaded, session_factory, repository.SELECTIN),
+            ),
+        ]:
+            interned = bytes_allocated(scenario()) / lines
+            not_interned = bytes_allocated(scenario(intern=False)) / lines
+            print(f"{name:>24} {interned:>12.0f} {not_interned:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.domain import events
+from allocation.service_layer import message_bus, unit_of_work
+
+SKUS = 20
+LINES_PER_SKU = 200
+
+
+def make_uow(engine=None):
+    if engine is None:
+        engine = create_engine("sqlite://")
+        orm.metadata.create_all(engine)
+    return unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+
+
+def seed(uow, skus):
+    later = date.today() + timedelta(days=7)
+    for sku in skus:
+        message_bus.handle(events.BatchCreated(f"{sku}-stock", sku, 2000), uow)
+        message_bus.handle(events.BatchCreated(f"{sku}-ship1", sku, 2000, later), uow)
+        message_bus.handle(events.BatchCreated(f"{sku}-ship2", sku, 2000, later), uow)
+
+
+def make_traffic(skus, lines_per_sku, rng):
+    traffic = [
+        events.AllocationRequired(
+            f"order-{i}", skus[i % len(skus)], rng.randint(1, 5)
+        )
+        for i in range(len(skus) * lines_per_sku)
+    ]
+    # cut every warehouse batch down so the bus has to cascade rebalancing
+    traffic += [events.BatchQuantityChanged(f"{sku}-stock", 100) for sku in skus]
+    return traffic
+
+
+def one_at_a_time(traffic, uow):
+    for event in traffic:
+        message_bus.handle(event, uow)
+
+
+def batched(traffic, uow):
+    message_bus.handle_all(traffic, uow, batched=True)
+
+
+def events_per_second(mode, skus, lines_per_sku, seed_=0, engine=None):
+    uow = make_uow(engine)
+    seed(uow, skus)
+    traffic = make_traffic(skus, lines_per_sku, random.Random(seed_))
+    start = time.perf_counter()
+    mode(traffic, uow)
+    return len(traffic) / (time.perf_counter() - start)
+
+
+def run(sku_count=SKUS, lines_per_sku=LINES_PER_SKU):
+    skus = [f"SKU-{i}" for i in range(sku_count)]
+    return [
+        (mode.__name__, events_per_second(mode, skus, lines_per_sku))
+        for mode in (one_at_a_time, batched)
+    ]
+
+
+def main():
+    orm.start_mappers()
+    print(f"{'mode':>14} {'events/s':>10}")
+    for mode, throughput in run():
+        print(f"{mode:>14} {throughput:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from allocation import planning
+from allocation.domain.model import Batch, OrderLine, Product
+
+LINES = 200_000
+SKUS = 100
+BATCHES_PER_SKU = 20
+
+
+def make_products(sku_count, batch_count, rng):
+    today = date.today()
+
+    def eta(b):
+        return None if b == 0 else today + timedelta(days=rng.randint(1, 90))
+
+    return [
+        Product(
+            f"SKU-{s}",
+            [
+                Batch(
+                    f"SKU-{s}-batch-{b}",
+                    f"SKU-{s}",
+                    qty=rng.randint(500, 2000),
+                    eta=eta(b),
+                )
+                for b in range(batch_count)
+            ],
+        )
+        for s in range(sku_count)
+    ]
+
+
+def make_demand(count, sku_count, rng):
+    return [
+        OrderLine(f"forecast-{i}", sku, rng.randint(1, 20))
+        for i, sku in enumerate(
+            f"SKU-{rng.randrange(sku_count)}" for _ in range(count)
+        )
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.planning")
+    parser.add_argument("--lines", type=int, default=LINES)
+    parser.add_argument("--skus", type=int, default=SKUS)
+    parser.add_argument("--batches-per-sku", type=int, default=BATCHES_PER_SKU)
+    args = parser.parse_args(argv)
+    rng = random.Random(0)
+    demand = make_demand(args.lines, args.skus, rng)
+    skus = [line.sku for line in demand]
+    quantities = [line.qty for line in demand]
+
+    def fresh_products():
+        return make_products(args.skus, args.batches_per_sku, random.Random(1))
+
+    products = fresh_products()
+    start = time.perf_counter()
+    snapshots = [planning.snapshot(p) for p in products]
+    plan = planning.plan(snapshots, skus, quantities)
+    planned = time.perf_counter() - start
+
+    products = {p.sku: p for p in fresh_products()}
+    start = time.perf_counter()
+    replayed = [products[line.sku].allocate(line) for line in demand]
+    replay = time.perf_counter() - start
+
+    assert plan.batch_refs == replayed
+    print(f"{'engine':>12} {'seconds':>10} {'lines/s':>12}")
+    for name, seconds in [("replay", replay), ("planner", planned)]:
+        print(f"{name:>12} {seconds:>10.3f} {args.lines / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import random
+import statistics
+import time
+import uuid
+from datetime import date, timedelta
+from typing import Callable, Dict
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from allocation import instrumentation
+from allocation.adapters import repository
+from allocation.domain.model import Batch, OrderLine, Product
+from . import allocate, message_bus as bus
+
+# every result is seconds per operation, so lower is always better
+
+
+def median_time(operation: Callable[[], None], repeat: int = 5) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def product_with_allocations(sku, batch_count, lines_per_batch, rng):
+    batches = allocate.make_batches(batch_count, rng)
+    for batch in batches:
+        batch.sku = sku
+        batch._purchased_quantity = lines_per_batch * 10 + rng.randint(0, 100)
+        for i in range(lines_per_batch):
+            batch.allocate(OrderLine(f"{batch.reference}-order-{i}", sku, 10))
+    return Product(sku, batches=batches)
+
+
+def bench_product_allocate(engine) -> Dict[str, float]:
+    results = {}
+    for batch_count in (10, 100, 1000):
+        for lines_per_batch in (0, 50):
+            rng = random.Random(0)
+            lines = allocate.make_lines(200, rng)
+
+            def allocate_all():
+                product = product_with_allocations(
+                    allocate.SKU, batch_count, lines_per_batch, random.Random(1)
+                )
+                start = time.perf_counter()
+                for line in lines:
+                    product.allocate(line)
+                return time.perf_counter() - start
+
+            name = (
+                f"product.allocate[batches={batch_count},allocated={lines_per_batch}]"
+            )
+            results[name] = (
+                statistics.median(allocate_all() for _ in range(3)) / len(lines)
+            )
+    return results
+
+
+def bench_change_batch_quantity(engine) -> Dict[str, float]:
+    results = {}
+    for line_count in (100, 1000, 10000):
+        def shrink():
+            stock = Batch("stock", "SKU", line_count, eta=None)
+            shipment = Batch("ship", "SKU", line_count, eta=date.today())
+            product = Product("SKU", batches=[stock, shipment])
+            product.allocate_many(
+                [OrderLine(f"order-{i}", "SKU", 1) for i in range(line_count)]
+            )
+            start = time.perf_counter()
+            product.change_batch_quantity("stock", line_count // 10)
+            return time.perf_counter() - start
+
+        evicted = line_count - line_count // 10
+        name = f"product.change_batch_quantity[evicted={evicted}]"
+        results[name] = statistics.median(shrink() for _ in range(3))
+    return results
+
+
+def bench_message_bus(engine) -> Dict[str, float]:
+    def seconds_per_event(mode):
+        # new skus every run, removed afterwards, since the database outlives it
+        skus = [f"bus-{uuid.uuid4().hex[:8]}-{i}" for i in range(10)]
+        try:
+            return 1 / bus.events_per_second(mode, skus, 100, engine=engine)
+        finally:
+            with engine.begin() as connection:
+                for sku in skus:
+                    remove_product(connection, sku)
+
+    results = {
+        f"message_bus.handle[{mode.__name__}]": seconds_per_event(mode)
+        for mode in (bus.one_at_a_time, bus.batched)
+    }
+    instrumentation.enable()
+    try:
+        results["message_bus.handle[one_at_a_time,metrics]"] = seconds_per_event(
+            bus.one_at_a_time
+        )
+    finally:
+        instrumentation.disable()
+    return results
+
+
+def seed_product(connection, sku, batch_count, lines_per_batch):
+    today = date.today()
+    connection.execute(
+        text("INSERT INTO products (sku, version_number) VALUES (:sku, 1)"),
+        dict(sku=sku),
+    )
+    connection.execute(
+        text(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:ref, :sku, :qty, :eta)"
+        ),
+        [
+            dict(
+                ref=f"{sku}-batch-{b}",
+                sku=sku,
+                qty=lines_per_batch * 10,
+                eta=today + timedelta(days=b),
+            )
+            for b in range(batch_count)
+        ],
+    )
+    connection.execute(
+        text(
+            "INSERT INTO order_lines (sku, qty, order_id)"
+            " VALUES (:sku, 10, :order_id)"
+        ),
+        [
+            dict(sku=sku, order_id=f"{sku}-batch-{b}-order-{i}")
+            for b in range(batch_count)
+            for i in range(lines_per_batch)
+        ],
+    )
+    connection.execute(
+        text(
+            "INSERT INTO allocations (orderline_id, batch_id)"
+            " SELECT l.id, b.id FROM order_lines AS l JOIN batches AS b"
+            " ON l.order_id LIKE b.reference || '-order-%'"
+            " WHERE b.sku = :sku AND l.sku = :sku"
+        ),
+        dict(sku=sku),
+    )
+
+
+def remove_product(connection, sku):
+    for statement in [
+        "DELETE FROM allocations WHERE batch_id IN"
+        " (SELECT id FROM batches WHERE sku = :sku)",
+        "DELETE FROM order_lines WHERE sku = :sku",
+        "DELETE FROM batches WHERE sku = :sku",
+        "DELETE FROM products WHERE sku = :sku",
+        "DELETE FROM allocations_view WHERE sku = :sku",
+        "DELETE FROM idempotency_keys WHERE sku = :sku",
+    ]:
+        connection.execute(text(statement), dict(sku=sku))
+
+
+def bench_repository_loads(engine) -> Dict[str, float]:
+    results = {}
+    session_factory = sessionmaker(bind=engine)
+    for batch_count, lines_per_batch in ((10, 10), (100, 10), (500, 10)):
+        sku = f"bench-{uuid.uuid4().hex[:8]}"
+        with engine.begin() as connection:
+            seed_product(connection, sku, batch_count, lines_per_batch)
+
+        def load(get, strategy):
+            session = session_factory()
+            try:
+                product = get(repository.SqlAlchemyRepository(session, strategy))
+                # a full aggregate load, as allocating would need
+                for batch in product.batches:
+                    batch.available_quantity
+            finally:
+                session.close()
+
+        for strategy in (repository.LAZY, repository.SELECTIN, repository.JOINED):
+            size = (
+                f"strategy={strategy},batches={batch_count},"
+                f"allocated={batch_count * lines_per_batch}"
+            )
+            results[f"repository.get[{size}]"] = median_time(
+                lambda: load(lambda repo: repo.get(sku), strategy)
+            )
+            results[f"repository.get_by_batch_ref[{size}]"] = median_time(
+                lambda: load(
+                    lambda repo: repo.get_by_batch_ref(f"{sku}-batch-0"), strategy
+                )
+            )
+        with engine.begin() as connection:
+            remove_product(connection, sku)
+    return results
+
+
+def bench_allocate_once_after_loading(engine) -> Dict[str, float]:
+    # what each uncached request pays on top of the load: the product's
+    # batch and line indexes are built for its one allocation
+    results = {}
+    session_factory = sessionmaker(bind=engine)
+    for batch_count, lines_per_batch in ((10, 10), (100, 10), (1000, 10)):
+        sku = f"bench-{uuid.uuid4().hex[:8]}"
+        with engine.begin() as connection:
+            seed_product(connection, sku, batch_count, lines_per_batch)
+
+        def allocate_once():
+            session = session_factory()
+            try:
+                product = repository.SqlAlchemyRepository(session).get(sku)
+                start = time.perf_counter()
+                product.allocate(OrderLine(f"order-{uuid.uuid4().hex}", sku, 1))
+                return time.perf_counter() - start
+            finally:
+                session.close()
+
+        name = (
+            f"product.allocate_once_after_loading[batches={batch_count},"
+            f"allocated={batch_count * lines_per_batch}]"
+        )
+        results[name] = statistics.median(allocate_once() for _ in range(5))
+        with engine.begin() as connection:
+            remove_product(connection, sku)
+    return results
+
+
+# each benchmark under the start its result names share, so that --only can
+# choose what to run before anything has
+BENCHMARKS = {
+    "product.allocate[": bench_product_allocate,
+    "product.change_batch_quantity[": bench_change_batch_quantity,
+    "message_bus.handle[": bench_message_bus,
+    "repository.get": bench_repository_loads,
+    "product.allocate_once_after_loading[": bench_allocate_once_after_loading,
+}  # type: Dict[str, Callable[..., Dict[str, float]]]
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import inspect
+
+from allocation.domain import model
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+
+class ProductCache:
+    # an LRU of detached Product aggregates, capped both by how many products
+    # and by how many allocated lines (which dominate memory) it holds. each
+    # is lent to one session at a time: taken out while in use, put back after
+    def __init__(self, max_products: int = 1000, max_lines: int = 1_000_000):
+        self.max_products = max_products
+        self.max_lines = max_lines
+        self.stats = CacheStats()
+        self.lines = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sku: str):
+        return sku in self._entries
+
+    def take(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            entry = self._entries.pop(sku, None)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.lines -= entry[1]
+            return entry[0]
+
+    def hit(self):
+        with self._lock:
+            self.stats.hits += 1
+
+    def stale(self):
+        with self._lock:
+            self.stats.stale += 1
+            self.stats.misses += 1
+
+    def put(self, product: model.Product):
+        lines = sum(len(batch._allocations) for batch in product.batches)
+        with self._lock:
+            self._remove(product.sku)
+            if lines > self.max_lines:
+                return
+            self._entries[product.sku] = (product, lines)
+            self.lines += lines
+            while (
+                len(self._entries) > self.max_products or self.lines > self.max_lines
+            ):
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def invalidate(self, sku: str):
+        with self._lock:
+            self._remove(sku)
+
+    def _remove(self, sku: str):
+        entry = self._entries.pop(sku, None)
+        if entry is not None:
+            self.lines -= entry[1]
+
+
+def is_cacheable(product: model.Product) -> bool:
+    # only whole, unexpired aggregates can be attached to later sessions
+    # without touching the database
+    if product.loaded_for_order is not None:
+        return False
+    state = inspect(product)
+    if state.expired or "batches" in state.unloaded:
+        return False
+    return all("_allocations" not in inspect(b).unloaded for b in product.batches)
@@ -0,0 +1,146 @@
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+
+# the one place engines are made: everything else asks for get_engine(),
+# get_session_factory() or their async twins, which build them on first use
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class TimedCheckout:
+    # how long callers wait to get a connection out of the pool, which is
+    # where an undersized pool shows up first
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+        self._stats_lock = threading.Lock()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.wait_stats.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.wait_stats.checkouts += 1
+                self.wait_stats.total_wait += waited
+                self.wait_stats.max_wait = max(self.wait_stats.max_wait, waited)
+
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def _engine_options(uri, poolclass):
+    options = dict(poolclass=poolclass, **config.get_pool_settings())
+    if make_url(uri).get_backend_name() == "postgresql":
+        options["isolation_level"] = "REPEATABLE READ"
+    return options
+
+
+def make_engine(uri=None):
+    uri = uri or config.get_postgres_uri()
+    return create_engine(uri, **_engine_options(uri, TimedQueuePool))
+
+
+def make_async_engine(uri=None):
+    uri = uri or config.get_postgres_async_uri()
+    return create_async_engine(uri, **_engine_options(uri, TimedAsyncQueuePool))
+
+
+_lock = threading.Lock()
+_engine = None
+_async_engine = None
+_session_factory = None
+_async_session_factory = None
+
+
+def get_engine():
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = make_engine()
+        return _engine
+
+
+def get_async_engine():
+    global _async_engine
+    with _lock:
+        if _async_engine is None:
+            _async_engine = make_async_engine()
+        return _async_engine
+
+
+def get_session_factory():
+    global _session_factory
+    engine = get_engine()
+    with _lock:
+        if _session_factory is None:
+            _session_factory = sessionmaker(bind=engine)
+        return _session_factory
+
+
+def get_async_session_factory():
+    global _async_session_factory
+    engine = get_async_engine()
+    with _lock:
+        if _async_session_factory is None:
+            _async_session_factory = sessionmaker(
+                bind=engine,
+                class_=AsyncSession,
+                # attribute refreshes are lazy loads, which an AsyncSession
+                # cannot do
+                expire_on_commit=False,
+            )
+        return _async_session_factory
+
+
+def pool_stats(engine) -> dict:
+    pool = engine.pool
+    stats = dict(
+        size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=max(0, pool.overflow()),
+    )
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats is not None:
+        stats.update(
+            checkouts=wait_stats.checkouts,
+            timeouts=wait_stats.timeouts,
+            total_wait_seconds=wait_stats.total_wait,
+            max_wait_seconds=wait_stats.max_wait,
+            mean_wait_seconds=(
+                wait_stats.total_wait / wait_stats.checkouts
+                if wait_stats.checkouts else 0.0
+            ),
+        )
+    return stats
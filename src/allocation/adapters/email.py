@@ -1,2 +1,58 @@
+import smtplib
+import threading
+
+from allocation import config
+
+FROM_ADDRESS = "allocations@example.com"
+
+
+class SmtpSender:
+    # one connection per sending thread, kept open between messages
+    def __init__(self, host, port, from_address=FROM_ADDRESS, timeout=10):
+        self.host = host
+        self.port = port
+        self.from_address = from_address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def send(self, destination, message):
+        msg = f"Subject: allocation service notification\n\n{message}"
+        try:
+            self._connection().sendmail(self.from_address, [destination], msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # the server may have timed out an idle connection; retry once
+            self.close()
+            self._connection().sendmail(self.from_address, [destination], msg)
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+
+    def _connection(self):
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = smtplib.SMTP(
+                self.host, self.port, timeout=self.timeout
+            )
+        return self._local.connection
+
+
+def _default_sender():
+    settings = config.get_email_host_and_port()
+    if settings["host"] is None:
+        return None
+    return SmtpSender(settings["host"], settings["port"])
+
+
+SENDER = _default_sender()
+
+
 def send(*args):
-    print("SENDING EMAIL:", *args)
+    if SENDER is None:
+        print("SENDING EMAIL:", *args)
+    else:
+        SENDER.send(*args)
@@ -0,0 +1,144 @@
+import abc
+from dataclasses import asdict, dataclass, replace
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, insert, select, update
+
+from allocation.adapters import orm
+
+
+@dataclass(frozen=True)
+class IdempotencyRecord:
+    key: str
+    order_id: str
+    sku: str
+    qty: int
+    batch_ref: str
+
+
+class AbstractIdempotencyStore(abc.ABC):
+    def get(self, key: str) -> Optional[IdempotencyRecord]:
+        return self.get_many([key]).get(key)
+
+    @abc.abstractmethod
+    def get_many(self, keys: Iterable[str]) -> Dict[str, IdempotencyRecord]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, record: IdempotencyRecord):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, order_id: str, sku: str):
+        # forget an order line's requests once it is deallocated, so that
+        # allocating it again isn't answered from the old record
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reassign(self, order_id: str, sku: str, batch_ref: str):
+        # point an order line's requests at the batch it was moved to
+        raise NotImplementedError
+
+
+class SqlAlchemyIdempotencyStore(AbstractIdempotencyStore):
+    # plain selects on the key's primary index, without touching the product.
+    # new records are only inserted by flush, which the unit of work calls
+    # once the product's UPDATE has gone through: a request racing this one
+    # for the same product then fails that version check and is retried,
+    # rather than waiting on the key's index to get a unique violation
+    def __init__(self, session):
+        self.session = session
+        self._pending = []  # type: List[IdempotencyRecord]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self.session.execute(
+            select(orm.idempotency_keys).where(orm.idempotency_keys.c.key.in_(keys))
+        )
+        records = {row.key: IdempotencyRecord(**row._mapping) for row in rows}
+        records.update((r.key, r) for r in self._pending if r.key in keys)
+        return records
+
+    def add(self, record):
+        self._pending.append(record)
+
+    def flush(self):
+        if self._pending:
+            self.session.execute(
+                insert(orm.idempotency_keys), [asdict(r) for r in self._pending]
+            )
+            self._pending = []
+
+    def remove(self, order_id, sku):
+        self._pending = _without_line(self._pending, order_id, sku)
+        self.session.execute(
+            delete(orm.idempotency_keys).where(*_for_line(order_id, sku))
+        )
+
+    def reassign(self, order_id, sku, batch_ref):
+        self._pending = _reassigned(self._pending, order_id, sku, batch_ref)
+        self.session.execute(
+            update(orm.idempotency_keys)
+            .where(*_for_line(order_id, sku))
+            .values(batch_ref=batch_ref)
+        )
+
+
+class AsyncSqlAlchemyIdempotencyStore:
+    # inserts on flush, after the product's UPDATE, like the sync store
+    def __init__(self, session):
+        self.session = session
+        self._pending = []  # type: List[IdempotencyRecord]
+
+    async def get(self, key: str) -> Optional[IdempotencyRecord]:
+        pending = [r for r in self._pending if r.key == key]
+        if pending:
+            return pending[-1]
+        rows = await self.session.execute(
+            select(orm.idempotency_keys).where(orm.idempotency_keys.c.key == key)
+        )
+        row = rows.first()
+        return IdempotencyRecord(**row._mapping) if row else None
+
+    async def add(self, record: IdempotencyRecord):
+        self._pending.append(record)
+
+    async def flush(self):
+        if self._pending:
+            await self.session.execute(
+                insert(orm.idempotency_keys), [asdict(r) for r in self._pending]
+            )
+            self._pending = []
+
+    async def remove(self, order_id: str, sku: str):
+        self._pending = _without_line(self._pending, order_id, sku)
+        await self.session.execute(
+            delete(orm.idempotency_keys).where(*_for_line(order_id, sku))
+        )
+
+    async def reassign(self, order_id: str, sku: str, batch_ref: str):
+        self._pending = _reassigned(self._pending, order_id, sku, batch_ref)
+        await self.session.execute(
+            update(orm.idempotency_keys)
+            .where(*_for_line(order_id, sku))
+            .values(batch_ref=batch_ref)
+        )
+
+
+def _without_line(records, order_id, sku):
+    return [r for r in records if (r.order_id, r.sku) != (order_id, sku)]
+
+
+def _reassigned(records, order_id, sku, batch_ref):
+    return [
+        replace(r, batch_ref=batch_ref) if (r.order_id, r.sku) == (order_id, sku)
+        else r
+        for r in records
+    ]
+
+
+def _for_line(order_id, sku):
+    keys = orm.idempotency_keys.c
+    return keys.order_id == order_id, keys.sku == sku
@@ -0,0 +1,96 @@
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import func, insert, inspect, select, text
+
+from allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: Tuple[str, ...]
+
+
+# append only: once released, a migration's statements never change. each
+# migration runs in a transaction of its own, and has to work on both sqlite
+# and postgres
+MIGRATIONS = [
+    Migration(
+        1,
+        "index the hot lookup paths",
+        (
+            # fails if two batches already share a reference; rename them first
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_batches_reference"
+            " ON batches (reference)",
+            "CREATE INDEX IF NOT EXISTS ix_batches_sku ON batches (sku)",
+            "CREATE INDEX IF NOT EXISTS ix_order_lines_order_id"
+            " ON order_lines (order_id)",
+            "CREATE INDEX IF NOT EXISTS ix_allocations_orderline_id"
+            " ON allocations (orderline_id)",
+            # superseded by the covering index below
+            "DROP INDEX IF EXISTS ix_allocations_batch_id",
+            "CREATE INDEX IF NOT EXISTS ix_allocations_batch_line"
+            " ON allocations (batch_id, orderline_id)",
+            "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_order_line"
+            " ON idempotency_keys (order_id, sku)",
+        ),
+    ),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+def current_version(connection) -> int:
+    if not inspect(connection).has_table(orm.schema_version.name):
+        return 0
+    version = select(func.max(orm.schema_version.c.version))
+    return connection.execute(version).scalar() or 0
+
+
+def migrate(engine) -> List[Migration]:
+    # brings the schema up to HEAD, and returns the migrations it applied
+    with engine.begin() as connection:
+        fresh = not inspect(connection).has_table(orm.batches.name)
+        # creates whatever tables are missing, as orm.py declares them now
+        orm.metadata.create_all(connection)
+        if fresh:
+            # which already includes everything the migrations add
+            _record(connection, MIGRATIONS)
+            return []
+
+    applied = []
+    for migration in MIGRATIONS:
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                # anyone migrating at the same time waits here, then sees
+                # what we applied
+                connection.execute(
+                    text("LOCK TABLE schema_version IN SHARE ROW EXCLUSIVE MODE")
+                )
+            if migration.version <= current_version(connection):
+                continue
+            for statement in migration.statements:
+                connection.execute(text(statement))
+            _record(connection, [migration])
+        logger.info(
+            "applied migration %d: %s", migration.version, migration.description
+        )
+        applied.append(migration)
+    return applied
+
+
+def _record(connection, migrations: List[Migration]):
+    applied_at = datetime.utcnow()
+    connection.execute(
+        insert(orm.schema_version),
+        [
+            dict(version=m.version, description=m.description, applied_at=applied_at)
+            for m in migrations
+        ],
+    )
@@ -1,3 +1,5 @@
+import sys
+
 from sqlalchemy import (
     MetaData,
     Table,
@@ -5,10 +7,13 @@ from sqlalchemy import (
     Integer,
     String,
     Date,
+    DateTime,
     ForeignKey,
+    Index,
+    Text,
     event
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm import attributes, mapper, relationship
 
 from allocation.domain import model
 
@@ -20,7 +25,7 @@ order_lines = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
-    Column("order_id", String(255)),
+    Column("order_id", String(255), index=True),
 )
 
 
@@ -37,9 +42,10 @@ batches = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("sku", ForeignKey("products.sku"), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ux_batches_reference", "reference", unique=True),
 )
 
 
@@ -47,8 +53,56 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
     Column("batch_id", ForeignKey("batches.id")),
+    # covers loading a batch's lines without reading the allocations rows
+    Index("ix_allocations_batch_line", "batch_id", "orderline_id"),
+)
+
+
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("order_id", String(255), index=True),
+    Column("sku", String(255), index=True),
+    Column("qty", Integer, nullable=False),
+    Column("batch_ref", String(255)),
+)
+
+
+# what each allocation request was answered with, so retries get the same
+idempotency_keys = Table(
+    "idempotency_keys",
+    metadata,
+    Column("key", String(255), primary_key=True),
+    Column("order_id", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batch_ref", String(255), nullable=False),
+    Index("ix_idempotency_keys_order_line", "order_id", "sku"),
+)
+
+
+# domain events committed alongside the change that raised them, until the
+# relay has published them
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+
+
+# the migrations applied to this database; see migrations.py
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
 )
 
 
@@ -68,10 +122,32 @@ def start_mappers():
     mapper(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)}
+        properties={"batches": relationship(batches_mapper)},
+        # compare-and-swap on the version the domain model bumps itself
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._batch_index = None
+    product._line_index = None
+    product.loaded_for_order = None
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "refresh")
+@event.listens_for(model.Batch, "expire")
+def reset_allocated_quantity(batch, *_):
+    if batch is not None:  # expiry can outlive a garbage-collected batch
+        batch._allocated_quantity = None
+
+
+@event.listens_for(model.OrderLine, "load")
+def intern_sku(line, _):
+    # rows come back with a string per line; a million lines of one product
+    # need only one copy of its sku. committed, so it isn't seen as a change
+    if line.sku is not None:
+        attributes.set_committed_value(line, "sku", sys.intern(line.sku))
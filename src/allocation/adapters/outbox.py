@@ -0,0 +1,131 @@
+import abc
+import json
+import os
+import socket
+import threading
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from sqlalchemy import delete, insert, select
+
+from allocation.adapters import orm, serialization
+from allocation.domain import events
+
+
+class SqlAlchemyOutbox:
+    # rows go in with the rest of the unit of work, and commit or roll back
+    # with it
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, new_events: Iterable[events.Event]):
+        created_at = datetime.utcnow()
+        rows = [
+            dict(
+                type=type(event).__name__,
+                payload=json.dumps(serialization.to_dict(event)),
+                created_at=created_at,
+            )
+            for event in new_events
+        ]
+        if rows:
+            self.session.execute(insert(orm.outbox), rows)
+
+
+class AbstractSink(abc.ABC):
+    @abc.abstractmethod
+    def publish(self, messages: List[str]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileSink(AbstractSink):
+    # one JSON event per line, which serialization.from_dict reads back.
+    # replay takes the same format, but only the commands it can replay
+    def __init__(self, path):
+        self._file = open(path, "a")
+
+    def publish(self, messages):
+        self._file.write("".join(message + "\n" for message in messages))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class SocketSink(AbstractSink):
+    # newline-delimited JSON over TCP, a stand-in for a real broker
+    def __init__(self, host, port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._socket = None
+
+    def publish(self, messages):
+        data = "".join(message + "\n" for message in messages).encode()
+        try:
+            self._connection().sendall(data)
+        except OSError:
+            # the consumer may have dropped an idle connection; retry once
+            self.close()
+            self._connection().sendall(data)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _connection(self):
+        if self._socket is None:
+            self._socket = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout
+            )
+        return self._socket
+
+
+class RelayStats:
+    def __init__(self):
+        self.batches = 0
+        self.published = 0
+
+
+class Relay:
+    # publishes outbox rows oldest first, then deletes them. a crash between
+    # the two publishes that batch again, so delivery is at least once
+    def __init__(self, session_factory, sink: AbstractSink, batch_size: int = 100):
+        self.session_factory = session_factory
+        self.sink = sink
+        self.batch_size = batch_size
+        self.stats = RelayStats()
+
+    def publish_batch(self) -> int:
+        session = self.session_factory()
+        try:
+            # skip locked rows, so several relays can share one outbox
+            rows = session.execute(
+                select(orm.outbox.c.id, orm.outbox.c.payload)
+                .order_by(orm.outbox.c.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return 0
+            self.sink.publish([row.payload for row in rows])
+            published = [row.id for row in rows]
+            session.execute(delete(orm.outbox).where(orm.outbox.c.id.in_(published)))
+            session.commit()
+        finally:
+            session.close()
+        self.stats.batches += 1
+        self.stats.published += len(rows)
+        return len(rows)
+
+    def run(self, interval: float = 1.0, stop: Optional[threading.Event] = None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            # only wait once caught up
+            if self.publish_batch() < self.batch_size:
+                stop.wait(interval)
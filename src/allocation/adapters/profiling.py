@@ -0,0 +1,125 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# "IN (?, ?, ?)" and "IN (%(p1)s, %(p2)s)" are the same shape of statement
+_PARAMETER = r"\s*(\?|%\(\w+\)s|:\w+)\s*"
+_PARAMETER_LISTS = re.compile(rf"\(({_PARAMETER},)+{_PARAMETER}\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    return _PARAMETER_LISTS.sub("(...)", shape)
+
+
+class QueryProfile:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def repeated(self, more_than: int = 1):
+        # the same statement over and over is usually a lazy load in a loop
+        return [(s, n) for s, n in self.shapes.most_common() if n > more_than]
+
+    def report(self) -> str:
+        lines = [f"{self.statements} statements in {self.seconds * 1000:.1f}ms"]
+        lines += [f"  {n} x {shape}" for shape, n in self.shapes.most_common(5)]
+        return "\n".join(lines)
+
+
+class QueryProfiler:
+    # attaches to a unit of work's session, and keeps a QueryProfile of it
+    def __init__(
+            self,
+            max_statements: Optional[int] = None,
+            max_seconds: Optional[float] = None,
+            max_repeats: Optional[int] = None,
+            keep_profiles: bool = False,
+    ):
+        self.max_statements = max_statements
+        self.max_seconds = max_seconds
+        self.max_repeats = max_repeats
+        self.keep_profiles = keep_profiles
+        self.profiles = []  # type: List[QueryProfile]
+
+    def start(self, session) -> QueryProfile:
+        profile = QueryProfile()
+        started = []
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            started.append(time.perf_counter())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            profile.statements += 1
+            profile.seconds += time.perf_counter() - started.pop()
+            profile.shapes[statement_shape(statement)] += 1
+
+        def on_begin(session, transaction, connection):
+            if not event.contains(connection, "before_cursor_execute", before):
+                event.listen(connection, "before_cursor_execute", before)
+                event.listen(connection, "after_cursor_execute", after)
+
+        # an AsyncSession runs its statements through a sync Session
+        session = getattr(session, "sync_session", session)
+        event.listen(session, "after_begin", on_begin)
+        if self.keep_profiles:
+            self.profiles.append(profile)
+        return profile
+
+    def finish(self, profile: QueryProfile):
+        problems = self.over_thresholds(profile)
+        if problems:
+            logger.warning(
+                "unit of work over its query thresholds (%s): %s",
+                ", ".join(problems),
+                profile.report(),
+            )
+
+    def over_thresholds(self, profile: QueryProfile) -> List[str]:
+        problems = []
+        statements, seconds, repeats = (
+            self.max_statements, self.max_seconds, self.max_repeats
+        )
+        if statements is not None and profile.statements > statements:
+            problems.append(f"more than {statements} statements")
+        if seconds is not None and profile.seconds > seconds:
+            problems.append(f"more than {seconds}s in the database")
+        if repeats is not None and profile.repeated(repeats):
+            problems.append(f"a statement repeated more than {repeats} times")
+        return problems
+
+
+@contextmanager
+def query_budget(
+        uow, statements: Optional[int] = None, repeats: Optional[int] = None
+):
+    # for tests: fails if what runs inside issues more than `statements` in
+    # total, or repeats one statement more than `repeats` times in a uow
+    profiler = QueryProfiler(keep_profiles=True)
+    previous, uow.profiler = uow.profiler, profiler
+    try:
+        yield profiler
+    finally:
+        uow.profiler = previous
+    issued = sum(p.statements for p in profiler.profiles)
+    if statements is not None and issued > statements:
+        raise AssertionError(
+            f"query budget of {statements} exceeded:\n"
+            + "\n".join(p.report() for p in profiler.profiles)
+        )
+    if repeats is not None:
+        for profile in profiler.profiles:
+            if profile.repeated(repeats):
+                raise AssertionError(
+                    f"statement repeated more than {repeats} times:\n"
+                    + profile.report()
+                )
@@ -1,9 +1,18 @@
 import abc
-from typing import Set, Protocol
+from typing import List, Set, Protocol
 
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+
+from allocation import instrumentation
 from allocation.adapters import orm
 from allocation.domain import model
 
+# how SqlAlchemyRepository loads a product's batches and their allocations
+LAZY = "lazy"  # one SELECT per relationship, on first access
+SELECTIN = "selectin"  # one SELECT per level of the aggregate, up front
+JOINED = "joined"  # a single SELECT with everything joined in
+
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
@@ -13,18 +22,40 @@ class AbstractRepository(abc.ABC):
         self._add(product)
         self.seen.add(product)
 
-    def get(self, sku) -> model.Product:
-        product = self._get(sku)
+    @instrumentation.timed("load")
+    def get(self, sku, allocations=True) -> model.Product:
+        if allocations:
+            product = self._get(sku)
+        else:
+            product = self._get_without_allocations(sku)
         if product:
             self.seen.add(product)
         return product
 
+    @instrumentation.timed("load")
     def get_by_batch_ref(self, batch_ref) -> model.Product:
         product = self._get_by_batch_ref(batch_ref)
         if product:
             self.seen.add(product)
         return product
 
+    @instrumentation.timed("load")
+    def get_for_order(self, sku, order_id) -> model.Product:
+        # the product with its batches, but only one order's lines in them:
+        # enough to deallocate the order, but not to allocate
+        product = self._get_for_order(sku, order_id)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def skus_for_order(self, order_id) -> List[str]:
+        # the products holding any of an order's lines, without loading them
+        return self._skus_for_order(order_id)
+
+    def known_skus(self, skus: List[str]) -> Set[str]:
+        # which of the skus have a product, without loading them
+        return self._known_skus(skus)
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -37,23 +68,149 @@ class AbstractRepository(abc.ABC):
     def _get_by_batch_ref(self, batch_ref) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _skus_for_order(self, order_id) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _known_skus(self, skus: List[str]) -> Set[str]:
+        raise NotImplementedError
+
+    def _get_without_allocations(self, sku) -> model.Product:
+        # for operations that never look at what is allocated, e.g. adding
+        # a batch; repositories that can skip loading allocations override it
+        return self._get(sku)
+
+    def _get_for_order(self, sku, order_id) -> model.Product:
+        return self._get(sku)
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    def __init__(self, session, load_strategy=SELECTIN, cache=None):
         super().__init__()
         self.session = session
+        self.load_strategy = load_strategy
+        self.cache = cache
+        # products taken out of the cache, for the unit of work to put back
+        self.from_cache = set()
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self._get_cached(sku) or self._query().filter_by(sku=sku).first()
 
-    def _get_by_batch_ref(self, batch_ref):
+    def _get_without_allocations(self, sku):
         return (
+            self._get_cached(sku)
+            or self._query(allocations=False).filter_by(sku=sku).first()
+        )
+
+    def _get_for_order(self, sku, order_id):
+        cached = self._get_cached(sku)
+        if cached is not None:
+            return cached
+        # loads the order's lines through ix_order_lines_order_id, rather
+        # than every line the product holds
+        lines = model.Batch._allocations.and_(model.OrderLine.order_id == order_id)
+        product = (
             self.session.query(model.Product)
+            .options(selectinload(model.Product.batches).selectinload(lines))
+            .filter_by(sku=sku)
+            .first()
+        )
+        if product is not None:
+            product.loaded_for_order = order_id
+        return product
+
+    def _get_by_batch_ref(self, batch_ref):
+        if self.cache is not None:
+            sku = self.session.execute(
+                "SELECT sku FROM batches WHERE reference = :ref", dict(ref=batch_ref)
+            ).scalar()
+            return self._get(sku) if sku is not None else None
+        return (
+            self._query()
             .join(model.Batch)
             .filter(orm.batches.c.reference == batch_ref)
             .first()
         )
 
+    def _skus_for_order(self, order_id):
+        return list(self.session.execute(
+            "SELECT DISTINCT l.sku FROM order_lines AS l"
+            " JOIN allocations AS a ON a.orderline_id = l.id"
+            " WHERE l.order_id = :order_id ORDER BY l.sku",
+            dict(order_id=order_id),
+        ).scalars())
+
+    def _known_skus(self, skus):
+        return set(self.session.execute(
+            select(orm.products.c.sku).where(orm.products.c.sku.in_(skus))
+        ).scalars())
+
+    def _get_cached(self, sku):
+        cached = self.cache.take(sku) if self.cache is not None else None
+        if cached is None:
+            return None
+        version = self.session.execute(
+            "SELECT version_number FROM products WHERE sku = :sku", dict(sku=sku)
+        ).scalar()
+        if version != cached.version_number:
+            self.cache.stale()
+            return None
+        self.cache.hit()
+        # the cached objects themselves rather than a merged copy of them, so
+        # a hit costs no copy and keeps the product's indexes
+        self.from_cache.add(cached)
+        self.session.add(cached)
+        return cached
+
+    def _query(self, allocations=True):
+        query = self.session.query(model.Product)
+        if self.load_strategy == SELECTIN:
+            batches = selectinload(model.Product.batches)
+            if allocations:
+                batches = batches.selectinload(model.Batch._allocations)
+            query = query.options(batches)
+        elif self.load_strategy == JOINED:
+            batches = joinedload(model.Product.batches)
+            if allocations:
+                batches = batches.joinedload(model.Batch._allocations)
+            query = query.options(batches)
+        return query
+
+
+class AsyncSqlAlchemyRepository:
+    # an AsyncSession cannot lazy load, so the whole aggregate comes up front
+    def __init__(self, session):
+        self.session = session
+        self.seen = set()
+
+    def add(self, product: model.Product):
+        self.session.add(product)
+        self.seen.add(product)
+
+    @instrumentation.timed_async("load")
+    async def get(self, sku) -> model.Product:
+        result = await self.session.execute(self._select().filter_by(sku=sku))
+        return self._seen(result.scalars().first())
+
+    @instrumentation.timed_async("load")
+    async def get_by_batch_ref(self, batch_ref) -> model.Product:
+        result = await self.session.execute(
+            self._select()
+            .join(model.Batch)
+            .filter(orm.batches.c.reference == batch_ref)
+        )
+        return self._seen(result.scalars().first())
+
+    def _seen(self, product):
+        if product:
+            self.seen.add(product)
+        return product
+
+    def _select(self):
+        return select(model.Product).options(
+            selectinload(model.Product.batches).selectinload(model.Batch._allocations)
+        )
@@ -0,0 +1,62 @@
+from dataclasses import asdict, fields
+from datetime import date
+from typing import Any, Dict, List, Optional, Type, get_args, get_origin
+
+from allocation.domain import events
+
+EVENT_TYPES = {
+    cls.__name__: cls for cls in events.Event.__subclasses__()
+}  # type: Dict[str, Type[events.Event]]
+
+
+def to_dict(event: events.Event) -> dict:
+    data = asdict(event)
+    for name, value in data.items():
+        if isinstance(value, date):
+            data[name] = value.isoformat()
+    return {"type": type(event).__name__, **data}
+
+
+def from_dict(data: dict) -> events.Event:
+    data = dict(data)
+    try:
+        event_type = EVENT_TYPES[data.pop("type")]
+    except KeyError as e:
+        raise ValueError(f"Unknown event type {e}")
+    return _build(event_type, data)
+
+
+def _build(event_type: Type[events.Event], data: dict) -> events.Event:
+    for field in fields(event_type):
+        value = data.get(field.name)
+        if field.type in (date, Optional[date]) and value:
+            data[field.name] = date.fromisoformat(value)
+        elif get_origin(field.type) is list and value:
+            # nested events, e.g. BulkAllocationRequired's lines, come back
+            # from asdict without their type, which the field gives instead
+            [item_type] = get_args(field.type)
+            if item_type in EVENT_TYPES.values():
+                data[field.name] = [_build(item_type, dict(item)) for item in value]
+    return event_type(**data)
+
+
+def to_row(event: events.Event) -> List[Any]:
+    # the type then the field values in declaration order, without the names.
+    # only for flat events: nested ones like BulkAllocationRequired need to_dict
+    row = [type(event).__name__]
+    for field in fields(event):
+        value = getattr(event, field.name)
+        row.append(value.isoformat() if isinstance(value, date) else value)
+    return row
+
+
+def from_row(row: List[Any]) -> events.Event:
+    try:
+        event_type = EVENT_TYPES[row[0]]
+    except KeyError as e:
+        raise ValueError(f"Unknown event type {e}")
+    values = list(row[1:])
+    for i, field in enumerate(fields(event_type)[:len(values)]):
+        if field.type in (date, Optional[date]) and values[i]:
+            values[i] = date.fromisoformat(values[i])
+    return event_type(*values)
@@ -0,0 +1,141 @@
+import abc
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from typing import Callable, Dict, Iterable, List
+
+from allocation.adapters import serialization
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+# a frame is a batch of events: its length, then a JSON list of event rows
+_LENGTH = struct.Struct("!I")
+
+
+def encode(batch: Iterable[events.Event]) -> bytes:
+    rows = [serialization.to_row(event) for event in batch]
+    return json.dumps(rows, separators=(",", ":")).encode()
+
+
+def decode(frame: bytes) -> List[events.Event]:
+    return [serialization.from_row(row) for row in json.loads(frame)]
+
+
+class AbstractTransport(abc.ABC):
+    @abc.abstractmethod
+    def send(self, frame: bytes):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def serve(self, on_frame: Callable[[bytes], None], stop: threading.Event):
+        # blocks, passing each frame received to on_frame, until stop is set
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class QueueTransport(AbstractTransport):
+    # over a multiprocessing.Queue: each frame reaches one consumer
+    def __init__(self, frames, poll_interval: float = 0.1):
+        self.frames = frames
+        self.poll_interval = poll_interval
+
+    def send(self, frame):
+        self.frames.put(frame)
+
+    def serve(self, on_frame, stop):
+        while not stop.is_set():
+            try:
+                frame = self.frames.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            on_frame(frame)
+
+
+class UnixSocketTransport(AbstractTransport):
+    # every replica listens on its own socket, and sends each frame to all
+    # of its peers'. a peer that is down misses the frame: this is for
+    # reacting quickly, the database stays the record
+    def __init__(self, path: str = None, peers: Iterable[str] = ()):
+        self.path = path
+        self.peers = list(peers)
+        self._connections = {}  # type: Dict[str, socket.socket]
+        self._lock = threading.Lock()
+
+    def send(self, frame):
+        data = _LENGTH.pack(len(frame)) + frame
+        with self._lock:
+            for peer in self.peers:
+                try:
+                    self._send_to(peer, data)
+                except OSError as e:
+                    logger.warning("could not send events to %s: %s", peer, e)
+
+    def _send_to(self, peer, data):
+        connection = self._connections.get(peer)
+        if connection is not None:
+            try:
+                connection.sendall(data)
+                return
+            except OSError:
+                # the peer restarted since we last wrote; reconnect once
+                self._disconnect(peer)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(peer)
+            connection.sendall(data)
+        except OSError:
+            connection.close()
+            raise
+        self._connections[peer] = connection
+
+    def _disconnect(self, peer):
+        connection = self._connections.pop(peer, None)
+        if connection is not None:
+            connection.close()
+
+    def serve(self, on_frame, stop):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left behind by an earlier run
+        server = _FrameServer(self.path, on_frame)
+
+        def shut_down_on_stop():
+            stop.wait()
+            server.shutdown()
+
+        threading.Thread(target=shut_down_on_stop, daemon=True).start()
+        try:
+            server.serve_forever(poll_interval=0.1)
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+
+    def close(self):
+        with self._lock:
+            for peer in list(self._connections):
+                self._disconnect(peer)
+
+
+class _FrameServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, on_frame):
+        super().__init__(path, _FrameHandler)
+        self.on_frame = on_frame
+
+
+class _FrameHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            [length] = _LENGTH.unpack(header)
+            self.server.on_frame(self.rfile.read(length))
@@ -9,7 +9,96 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_pool_settings():
+    # size these so that every process's pool_size + max_overflow, summed,
+    # stays under postgres' max_connections
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    )
+
+
+def get_postgres_async_uri():
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
+
+
+def get_product_cache_settings():
+    # PRODUCT_CACHE_MAX_PRODUCTS=0, the default, turns the cache off
+    return dict(
+        max_products=int(os.environ.get("PRODUCT_CACHE_MAX_PRODUCTS", 0)),
+        max_lines=int(os.environ.get("PRODUCT_CACHE_MAX_LINES", 1_000_000)),
+    )
+
+
+def get_email_host_and_port():
+    # without EMAIL_HOST, emails are only printed
+    host = os.environ.get("EMAIL_HOST")
+    port = int(os.environ.get("EMAIL_PORT", 11025 if host == "localhost" else 1025))
+    return dict(host=host, port=port)
+
+
+def get_notification_settings():
+    return dict(
+        workers=int(os.environ.get("NOTIFICATION_WORKERS", 2)),
+        max_queue=int(os.environ.get("NOTIFICATION_MAX_QUEUE", 1000)),
+        window=float(os.environ.get("NOTIFICATION_WINDOW_SECONDS", 1.0)),
+    )
+
+
+def get_partition_settings():
+    # ALLOCATION_PARTITIONS=0, the default, handles events in the web worker
+    return dict(
+        partitions=int(os.environ.get("ALLOCATION_PARTITIONS", 0)),
+        timeout=float(os.environ.get("ALLOCATION_PARTITION_TIMEOUT", 30)),
+    )
+
+
+def get_metrics_enabled():
+    return os.environ.get("METRICS_ENABLED", "1") == "1"
+
+
+def get_profiling_settings():
+    # SQL_PROFILE=1 logs units of work that go over these thresholds
+    if os.environ.get("SQL_PROFILE", "0") != "1":
+        return None
+    return dict(
+        max_statements=int(os.environ.get("SQL_PROFILE_MAX_STATEMENTS", 50)),
+        max_seconds=float(os.environ.get("SQL_PROFILE_MAX_SECONDS", 0.5)),
+        max_repeats=int(os.environ.get("SQL_PROFILE_MAX_REPEATS", 10)),
+    )
+
+
+def get_outbox_enabled():
+    # with OUTBOX_ENABLED=1, committed events also go to the outbox table for
+    # `python -m allocation.entry_points.relay` to publish
+    return os.environ.get("OUTBOX_ENABLED", "0") == "1"
+
+
+def get_event_channel_settings():
+    # EVENT_CHANNEL_SOCKET is the unix socket this process listens on, and
+    # EVENT_CHANNEL_PEERS the other processes' sockets it publishes to
+    path = os.environ.get("EVENT_CHANNEL_SOCKET")
+    peers = _comma_separated("EVENT_CHANNEL_PEERS")
+    if path is None and not peers:
+        return None
+    return dict(
+        path=path,
+        peers=peers,
+        # event type names, e.g. OutOfStock,BatchQuantityChanged
+        publish=_comma_separated("EVENT_CHANNEL_PUBLISH"),
+        subscribe=_comma_separated("EVENT_CHANNEL_SUBSCRIBE"),
+        max_batch=int(os.environ.get("EVENT_CHANNEL_MAX_BATCH", 100)),
+    )
+
+
+def _comma_separated(name):
+    return [item for item in os.environ.get(name, "").split(",") if item]
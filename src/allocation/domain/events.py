@@ -1,6 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import date
-from typing import Optional
+from typing import Optional, Dict, List
 
 
 class Event:
@@ -26,8 +26,48 @@ class AllocationRequired(Event):
     order_id: str
     sku: str
     qty: int
+    idempotency_key: Optional[str] = None
+
+
+@dataclass
+class DeallocationRequired(Event):
+    order_id: str
+    sku: str
+
+
+@dataclass
+class OrderCancelled(Event):
+    order_id: str
+
+
+@dataclass
+class Allocated(Event):
+    order_id: str
+    sku: str
+    qty: int
+    batch_ref: str
+
+
+@dataclass
+class Deallocated(Event):
+    order_id: str
+    sku: str
+    qty: int
+
+
+@dataclass
+class BulkAllocationRequired(Event):
+    lines: List[AllocationRequired]
 
 
 @dataclass
 class OutOfStock(Event):
     sku: str
+
+
+@dataclass
+class BatchRebalanced(Event):
+    ref: str
+    sku: str
+    reallocated: Dict[str, str] = field(default_factory=dict)
+    unallocated: List[str] = field(default_factory=list)
@@ -1,7 +1,9 @@
 from __future__ import annotations
+import bisect
+import sys
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Optional, List, Set, Dict, Callable, Iterable, Tuple
 from . import events
 from allocation.adapters import email
 
@@ -10,32 +12,169 @@ class OutOfStock(Exception):
     pass
 
 
+class PartiallyLoaded(Exception):
+    pass
+
+
+# eviction policies, for when a batch shrinks below what is allocated to it
+def largest_first(lines: Iterable[OrderLine]) -> List[OrderLine]:
+    # frees the shortfall by moving the fewest lines
+    return sorted(lines, key=lambda l: (l.qty, l.order_id), reverse=True)
+
+
+def smallest_first(lines: Iterable[OrderLine]) -> List[OrderLine]:
+    # disturbs the smallest orders, which are the easiest to place elsewhere
+    return sorted(lines, key=lambda l: (l.qty, l.order_id))
+
+
 class Product:
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events = []
+        self._batch_index = None
+        self._line_index = None
+        # set when only this order's lines were loaded, which is enough to
+        # deallocate it but not to work out what the batches have available
+        self.loaded_for_order = None
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._batch_index is not None:
+            self._batch_index.insert(batch)
+        if self._line_index is not None:
+            self._line_index.add_batch(batch)
+        self.version_number += 1
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            return batch.reference
-        except StopIteration:
+        self._check_fully_loaded()
+        batch, allocated = self._allocate(line)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        if not allocated:
+            return batch.reference
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(line.order_id, line.sku, line.qty, batch.reference)
+        )
+        return batch.reference
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
-        batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        self._check_fully_loaded()
+        refs = []
+        changed = False
+        for line in lines:
+            batch, allocated = self._allocate(line)
+            refs.append(batch.reference if batch is not None else None)
+            if allocated:
+                changed = True
+                self.events.append(events.Allocated(
+                    line.order_id, line.sku, line.qty, batch.reference
+                ))
+        if None in refs:
+            self.events.append(events.OutOfStock(self.sku))
+        if changed:
+            self.version_number += 1
+        return refs
+
+    def deallocate(self, order_id: str) -> List[str]:
+        # frees every line of the order for this sku; returns their batches.
+        # the product may hold only this order's lines, so the batch index is
+        # only kept up to date if it was built before, and batches only
+        # adjust an allocated quantity they have already counted
+        released = self._indexed_lines().pop(order_id)
+        index = self._batch_index
+        if index is not None and len(index) != len(self.batches):
+            index = self._batch_index = None
+        for line, batch in released:
+            batch.deallocate(line)
+            if index is not None:
+                index.update(batch)
             self.events.append(
-                events.AllocationRequired(line.order_id, line.sku, line.qty)
+                events.Deallocated(line.order_id, line.sku, line.qty)
+            )
+        if released:
+            self.version_number += 1
+        return [batch.reference for _, batch in released]
+
+    def change_batch_quantity(
+            self, ref: str, qty: int, evict: EvictionPolicy = largest_first
+    ):
+        self._check_fully_loaded()
+        index = self._ordered_batches()
+        batch = index.get(ref)
+        batch._purchased_quantity = qty
+        evicted = []
+        shortfall = -batch.available_quantity
+        if shortfall > 0:
+            for line in evict(batch._allocations):
+                evicted.append(line)
+                shortfall -= line.qty
+                if shortfall <= 0:
+                    break
+        for line in evicted:
+            batch.deallocate(line)
+            if self._line_index is not None:
+                self._line_index.remove(line, batch)
+        index.update(batch)
+        if evicted:
+            self._rebalance(ref, evicted)
+        self.version_number += 1
+
+    def _rebalance(self, ref: str, lines: List[OrderLine]):
+        reallocated, unallocated = {}, []
+        for line in lines:
+            batch, _ = self._allocate(line)
+            if batch is None:
+                unallocated.append(line.order_id)
+            else:
+                reallocated[line.order_id] = batch.reference
+        self.events.append(
+            events.BatchRebalanced(ref, self.sku, reallocated, unallocated)
+        )
+        if unallocated:
+            self.events.append(events.OutOfStock(self.sku))
+
+    def _allocate(self, line: OrderLine) -> Tuple[Optional[Batch], bool]:
+        # the batch for the line, and whether it was allocated just now rather
+        # than already held there. the holding batch may be full by now, so
+        # it is looked up by order rather than found by first fit
+        lines = self._indexed_lines()
+        held = lines.batch_holding(line)
+        if held is not None:
+            return held, False
+        index = self._ordered_batches()
+        batch = index.first_fit(line)
+        if batch is None:
+            return None, False
+        batch.allocate(line)
+        index.update(batch)
+        lines.add(line, batch)
+        return batch, True
+
+    def _check_fully_loaded(self):
+        if self.loaded_for_order is not None:
+            raise PartiallyLoaded(
+                f"{self.sku} holds only the lines of order {self.loaded_for_order}"
             )
 
+    def _ordered_batches(self) -> BatchIndex:
+        # batches appended straight onto the list (or by the ORM) change its
+        # length, which is our cue to rebuild rather than trust a stale index
+        index = self._batch_index
+        if index is None or len(index) != len(self.batches):
+            index = self._batch_index = BatchIndex(self.batches)
+        return index
+
+    def _indexed_lines(self) -> LineIndex:
+        # built on first use, then kept up to date by every (de)allocation
+        index = self._line_index
+        if index is None or index.batches != len(self.batches):
+            index = self._line_index = LineIndex(self.batches)
+        return index
+
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
@@ -43,6 +182,13 @@ class OrderLine:
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # a product's lines all carry its sku, so share one copy of the string
+        self.sku = sys.intern(self.sku)
+
+
+EvictionPolicy = Callable[[Iterable[OrderLine]], List[OrderLine]]
+
 
 def allocate(line: OrderLine, batches: List[Batch]) -> str:
     try:
@@ -69,6 +215,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()
+        self._allocated_quantity = 0
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -89,19 +236,29 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            # not counted yet is left for allocated_quantity to count
+            if self._allocated_quantity is not None:
+                self._allocated_quantity -= line.qty
             self._allocations.remove(line)
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None means "not counted yet", e.g. straight after the ORM loads us
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -109,3 +266,130 @@ class Batch:
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
+
+
+# which batch holds each of a product's order lines, by order id, so that
+# deallocating doesn't mean searching every batch's allocations
+class LineIndex:
+    def __init__(self, batches: List[Batch]):
+        self.batches = 0
+        self._lines = {}  # type: Dict[str, List[Tuple[OrderLine, Batch]]]
+        for batch in batches:
+            self.add_batch(batch)
+
+    def add_batch(self, batch: Batch):
+        self.batches += 1
+        for line in batch._allocations:
+            self.add(line, batch)
+
+    def add(self, line: OrderLine, batch: Batch):
+        self._lines.setdefault(line.order_id, []).append((line, batch))
+
+    def remove(self, line: OrderLine, batch: Batch):
+        held = self._lines.get(line.order_id, [])
+        if (line, batch) in held:
+            held.remove((line, batch))
+        if not held:
+            self._lines.pop(line.order_id, None)
+
+    def batch_holding(self, line: OrderLine) -> Optional[Batch]:
+        held = self._lines.get(line.order_id, [])
+        return next((batch for l, batch in held if l == line), None)
+
+    def pop(self, order_id: str) -> List[Tuple[OrderLine, Batch]]:
+        return self._lines.pop(order_id, [])
+
+
+def _eta_key(batch: Batch):
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+# Batches in allocation order (warehouse stock first, then by ETA) over a
+# max-segment-tree of their available quantity, so first-fit is O(log n).
+# Ties keep list order, exactly like the stable sorted(batches) it replaces.
+class BatchIndex:
+    def __init__(self, batches: List[Batch]):
+        self._batches = sorted(batches, key=_eta_key)
+        self._keys = [_eta_key(b) for b in self._batches]
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def get(self, ref: str) -> Batch:
+        return self._batches[self._positions[ref]]
+
+    def insert(self, batch: Batch):
+        key = _eta_key(batch)
+        position = bisect.bisect_right(self._keys, key)
+        self._batches.insert(position, batch)
+        self._keys.insert(position, key)
+        count = len(self._batches)
+        if count > self._size:
+            self._rebuild()
+            return
+        # shift the leaves after it along by one, then fix only their parents;
+        # batches usually arrive with the latest ETA, so there are few
+        tree, size = self._tree, self._size
+        first, last = size + position, size + count - 1
+        tree[first + 1:last + 1] = tree[first:last]
+        tree[first] = batch.available_quantity
+        for i in range(position, count):
+            self._positions[self._batches[i].reference] = i
+        first, last = first // 2, last // 2
+        while first:
+            for node in range(first, last + 1):
+                tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            first, last = first // 2, last // 2
+
+    def update(self, batch: Batch):
+        node = self._size + self._positions[batch.reference]
+        tree = self._tree
+        tree[node] = batch.available_quantity
+        node //= 2
+        while node:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        position = self._first_with_at_least(line.qty, 0)
+        while position is not None:
+            batch = self._batches[position]
+            if batch.can_allocate(line):
+                return batch
+            position = self._first_with_at_least(line.qty, position + 1)
+        return None
+
+    def _rebuild(self):
+        self._positions = {
+            b.reference: i for i, b in enumerate(self._batches)
+        }  # type: Dict[str, int]
+        size = 1
+        while size < len(self._batches):
+            size *= 2
+        self._size = size
+        tree = [float("-inf")] * (2 * size)
+        for i, batch in enumerate(self._batches):
+            tree[size + i] = batch.available_quantity
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self._tree = tree
+
+    def _first_with_at_least(self, qty: int, start: int) -> Optional[int]:
+        tree, size = self._tree, self._size
+        if start >= len(self._batches) or tree[1] < qty:
+            return None
+        stack = [(1, 0, size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if hi <= start or tree[node] < qty:
+                continue
+            if node >= size:
+                return lo
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return None
@@ -0,0 +1,108 @@
+import json
+from datetime import datetime
+
+from allocation import config
+from allocation.adapters import database, email, orm
+from allocation.domain import events
+from allocation.service_layer import message_bus, notifications, unit_of_work
+from allocation.service_layer.handlers import IdempotencyKeyReused, InvalidSku
+
+# a bare ASGI app, e.g. `uvicorn allocation.entry_points.asgi_app:app`,
+# serving the same routes as flask_app without a worker per request
+
+
+async def add_batch(body, uow, headers):
+    eta = body["eta"]
+    if eta is not None:
+        eta = datetime.fromisoformat(eta).date()
+    event = events.BatchCreated(body["ref"], body["sku"], body["qty"], eta)
+    await message_bus.handle_async(event, uow)
+    return 201, "OK"
+
+
+async def allocate(body, uow, headers):
+    try:
+        event = events.AllocationRequired(
+            body["order_id"], body["sku"], body["qty"], headers.get("idempotency-key")
+        )
+        results = await message_bus.handle_async(event, uow)
+        batch_ref = results.pop(0)
+    except InvalidSku as e:
+        return 400, {"message": str(e)}
+    except IdempotencyKeyReused as e:
+        return 422, {"message": str(e)}
+    return 201, {"batch_ref": batch_ref}
+
+
+async def pool_stats(body, uow, headers):
+    return 200, database.pool_stats(database.get_async_engine())
+
+
+ROUTES = {
+    ("POST", "/add-batch"): add_batch,
+    ("POST", "/allocate"): allocate,
+    ("GET", "/pool-stats"): pool_stats,
+}
+
+
+def create_app(make_uow=unit_of_work.AsyncSqlAlchemyUnitOfWork):
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+        route = ROUTES.get((scope["method"], scope["path"]))
+        if route is None:
+            await respond(send, 404, "not found")
+            return
+        body = json.loads(await read_body(receive) or b"null")
+        headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])
+        }
+        status, payload = await route(body, make_uow(), headers)
+        await respond(send, status, payload)
+
+    return app
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            orm.start_mappers()
+            notifications.start(email.send, **config.get_notification_settings())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            notifications.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def respond(send, status, payload):
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), b"text/html; charset=utf-8"
+    else:
+        body, content_type = json.dumps(payload).encode(), b"application/json"
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+app = create_app()
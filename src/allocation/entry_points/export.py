@@ -0,0 +1,125 @@
+import argparse
+import csv
+import sys
+from typing import Iterator, List, Sequence, TextIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from allocation.adapters import database, orm
+
+COLUMNS = ["batch_ref", "sku", "eta", "purchased_quantity", "order_id", "qty"]
+
+# every batch, with one row per line allocated to it, or one row of nulls
+# if there are none
+ALLOCATION_ROWS = (
+    select(
+        orm.batches.c.reference,
+        orm.batches.c.sku,
+        orm.batches.c.eta,
+        orm.batches.c._purchased_quantity,
+        orm.order_lines.c.order_id,
+        orm.order_lines.c.qty,
+    )
+    .select_from(orm.batches)
+    .outerjoin(orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id)
+    .outerjoin(
+        orm.order_lines, orm.order_lines.c.id == orm.allocations.c.orderline_id
+    )
+    .order_by(orm.batches.c.id, orm.allocations.c.id)
+)
+
+
+def allocation_rows(connection, chunk_size: int) -> Iterator[List[Sequence]]:
+    # a server-side cursor on postgres (sqlite steps through its results
+    # anyway), so only chunk_size rows are in memory at a time, however big
+    # the tables get
+    result = connection.execution_options(stream_results=True).execute(
+        ALLOCATION_ROWS
+    )
+    yield from result.partitions(chunk_size)
+
+
+def export(engine, writer, chunk_size: int = 10_000) -> int:
+    rows = 0
+    with engine.connect() as connection:
+        with connection.begin():
+            if connection.dialect.name == "postgresql":
+                # one consistent snapshot (the engine reads at REPEATABLE
+                # READ) that takes no row locks, so allocations carry on
+                # while the export streams
+                connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+            for chunk in allocation_rows(connection, chunk_size):
+                writer.write(chunk)
+                rows += len(chunk)
+    return rows
+
+
+class CsvWriter:
+    def __init__(self, output: TextIO):
+        self._csv = csv.writer(output)
+        self._csv.writerow(COLUMNS)
+
+    def write(self, chunk):
+        self._csv.writerows(chunk)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    # one row group per chunk, so the file is written as it streams
+    def __init__(self, path):
+        self._schema = pa.schema([
+            ("batch_ref", pa.string()),
+            ("sku", pa.string()),
+            ("eta", pa.date32()),
+            ("purchased_quantity", pa.int64()),
+            ("order_id", pa.string()),
+            ("qty", pa.int64()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, chunk):
+        columns = [list(column) for column in zip(*chunk)]
+        self._writer.write_table(
+            pa.Table.from_arrays(columns, schema=self._schema)
+        )
+
+    def close(self):
+        self._writer.close()
+
+
+def main(argv=None, stdout: TextIO = sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Stream every batch and its allocated lines to a file."
+    )
+    parser.add_argument("output", help="file to write, or - for CSV on stdout")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument(
+        "--chunk-size", type=int, default=10_000, help="rows fetched at a time"
+    )
+    parser.add_argument("--db-uri", default=None, help="defaults to the app database")
+    args = parser.parse_args(argv)
+    if args.format == "parquet" and args.output == "-":
+        parser.error("parquet needs an output file")
+
+    engine = database.make_engine(args.db_uri)
+    if args.format == "parquet":
+        writer = ParquetWriter(args.output)
+        output = None
+    else:
+        output = stdout if args.output == "-" else open(args.output, "w", newline="")
+        writer = CsvWriter(output)
+    try:
+        rows = export(engine, writer, chunk_size=args.chunk_size)
+    finally:
+        writer.close()
+        if output not in (None, stdout):
+            output.close()
+    print(f"exported {rows} rows", file=sys.stderr if output is stdout else stdout)
+
+
+if __name__ == "__main__":
+    main()
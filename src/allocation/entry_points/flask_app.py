@@ -1,18 +1,78 @@
+import atexit
+from dataclasses import asdict
 from datetime import datetime
 
-from flask import Flask, request
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Response, jsonify, request
 
-from allocation import config
+from allocation import config, instrumentation, views
 from allocation.domain import model, events
-from allocation.adapters import repository, orm, email
-from allocation.service_layer import handlers, unit_of_work, message_bus
-from allocation.service_layer.handlers import InvalidSku
+from allocation.adapters import (
+    repository, orm, email, cache, database, profiling, serialization, transports,
+)
+from allocation.entry_points import prometheus
+from allocation.service_layer import (
+    handlers, unit_of_work, message_bus, notifications, partitions, channels,
+)
+from allocation.service_layer.handlers import IdempotencyKeyReused, InvalidSku
 
 orm.start_mappers()
-get_session = sessionmaker(bind=create_engine(config.get_postgres_uri()))
 app = Flask(__name__)
+notifications.start(email.send, **config.get_notification_settings())
+atexit.register(notifications.stop)
+if config.get_metrics_enabled():
+    instrumentation.enable()
+
+cache_settings = config.get_product_cache_settings()
+product_cache = (
+    cache.ProductCache(**cache_settings) if cache_settings["max_products"] else None
+)
+profiling_settings = config.get_profiling_settings()
+profiler = (
+    profiling.QueryProfiler(**profiling_settings) if profiling_settings else None
+)
+
+partition_settings = config.get_partition_settings()
+partitioned_bus = (
+    partitions.PartitionedBus(partition_settings["partitions"])
+    if partition_settings["partitions"] else None
+)
+if partitioned_bus is not None:
+    atexit.register(partitioned_bus.close)
+
+
+def make_uow():
+    return unit_of_work.SqlAlchemyUnitOfWork(cache=product_cache, profiler=profiler)
+
+
+channel_settings = config.get_event_channel_settings()
+subscriber = None
+if channel_settings is not None:
+    transport = transports.UnixSocketTransport(
+        channel_settings["path"], channel_settings["peers"]
+    )
+    channels.start(
+        transport,
+        [serialization.EVENT_TYPES[name] for name in channel_settings["publish"]],
+        max_batch=channel_settings["max_batch"],
+    )
+    atexit.register(channels.stop)
+    subscribed = channel_settings["subscribe"]
+    if channel_settings["path"] and subscribed:
+        subscriber = channels.Subscriber(
+            transport,
+            [serialization.EVENT_TYPES[name] for name in subscribed],
+            lambda batch: message_bus.handle_all(
+                batch, make_uow(), from_channel=True
+            ),
+        )
+        atexit.register(subscriber.close)
+
+
+def handle(event):
+    if partitioned_bus is not None and isinstance(event, partitions.PARTITIONED):
+        future = partitioned_bus.submit(event)
+        return future.result(timeout=partition_settings["timeout"])
+    return message_bus.handle(event, make_uow())
 
 
 def is_valid_sku(sku, batches):
@@ -27,7 +87,7 @@ def add_batch():
     event = events.BatchCreated(
         request.json["ref"], request.json["sku"], request.json["qty"], eta
     )
-    message_bus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
+    handle(event)
     return "OK", 201
 
 
@@ -37,14 +97,74 @@ def allocate_endpoint():
         event = events.AllocationRequired(
             request.json["order_id"],
             request.json["sku"],
-            request.json["qty"]
+            request.json["qty"],
+            request.headers.get("Idempotency-Key"),
         )
-        results = message_bus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
+        results = handle(event)
         batch_ref = results.pop(0)
     except InvalidSku as e:
         return {"message": str(e)}, 400
+    except IdempotencyKeyReused as e:
+        return {"message": str(e)}, 422
     return {"batch_ref": batch_ref}, 201
 
 
+@app.route("/allocate-bulk", methods=["POST"])
+def allocate_bulk_endpoint():
+    event = events.BulkAllocationRequired(
+        [
+            events.AllocationRequired(line["order_id"], line["sku"], line["qty"])
+            for line in request.json["lines"]
+        ]
+    )
+    results = message_bus.handle(event, make_uow())
+    allocations = results.pop(0)
+    return {"results": [asdict(allocation) for allocation in allocations]}, 200
+
+
+@app.route("/deallocate", methods=["POST"])
+def deallocate_endpoint():
+    event = events.DeallocationRequired(request.json["order_id"], request.json["sku"])
+    try:
+        batch_refs = handle(event).pop(0)
+    except InvalidSku as e:
+        return {"message": str(e)}, 400
+    return {"batch_refs": batch_refs}, 200
+
+
+@app.route("/cancel-order", methods=["POST"])
+def cancel_order_endpoint():
+    event = events.OrderCancelled(request.json["order_id"])
+    released = message_bus.handle(event, make_uow()).pop(0)
+    return {"released": released}, 200
+
+
+@app.route("/allocations/<order_id>", methods=["GET"])
+def allocations_view_endpoint(order_id):
+    result = views.allocations(order_id, make_uow())
+    if not result:
+        return "not found", 404
+    return jsonify(result), 200
+
+
+@app.route("/stock/<sku>", methods=["GET"])
+def stock_view_endpoint(sku):
+    result = views.stock(sku, make_uow())
+    if not result:
+        return "not found", 404
+    return jsonify(result), 200
+
+
+@app.route("/pool-stats", methods=["GET"])
+def pool_stats_endpoint():
+    return jsonify(database.pool_stats(database.get_engine())), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    text = prometheus.render(product_cache, database.get_engine())
+    return Response(text, mimetype=prometheus.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0.0", port=8005, debug=True)
\ No newline at end of file
@@ -0,0 +1,24 @@
+import argparse
+import sys
+from typing import TextIO
+
+from allocation.adapters import database, migrations
+
+
+def main(argv=None, stdout: TextIO = sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Create missing tables and apply pending schema migrations."
+    )
+    parser.add_argument("--db-uri", default=None, help="defaults to the app database")
+    args = parser.parse_args(argv)
+
+    engine = database.make_engine(args.db_uri)
+    for migration in migrations.migrate(engine):
+        print(f"applied {migration.version}: {migration.description}", file=stdout)
+    with engine.connect() as connection:
+        version = migrations.current_version(connection)
+    print(f"schema at version {version}", file=stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+from typing import Dict, Iterable, List, Optional
+
+from allocation import instrumentation
+from allocation.adapters import database
+from allocation.adapters.cache import ProductCache
+from allocation.service_layer import notifications, retries
+
+# the prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render(product_cache: Optional[ProductCache] = None, engine=None) -> str:
+    lines = []  # type: List[str]
+    metrics = instrumentation.METRICS
+    if metrics is not None:
+        _bus(lines, metrics)
+    _retries(lines, retries.STATS)
+    if product_cache is not None:
+        _cache(lines, product_cache)
+    if engine is not None:
+        _pool(lines, database.pool_stats(engine))
+    if notifications.DISPATCHER is not None:
+        _notifications(lines, notifications.DISPATCHER)
+    return "\n".join(lines) + "\n"
+
+
+def _bus(lines, metrics):
+    _histograms(
+        lines, "allocation_event_seconds",
+        "Time to handle an event, including all its handlers",
+        {(("event", event),): h for event, h in metrics.events.items()},
+    )
+    _histograms(
+        lines, "allocation_handler_seconds", "Time spent in each handler",
+        {
+            (("event", event), ("handler", handler)): h
+            for (event, handler), h in metrics.handlers.items()
+        },
+    )
+    _histograms(
+        lines, "allocation_stage_seconds",
+        "Time spent loading aggregates and committing",
+        {(("stage", stage),): h for stage, h in metrics.stages.items()},
+    )
+    _histograms(
+        lines, "allocation_bus_queue_depth",
+        "Deepest the event queue got in each handle call",
+        {(): metrics.queue_depth},
+    )
+    _metric(
+        lines, "allocation_cascaded_events_total", "counter",
+        "Events raised by handlers and queued behind the one being handled",
+        [((("event", event),), count) for event, count in metrics.cascaded.items()],
+    )
+
+
+def _retries(lines, stats):
+    for name, counter, help_ in (
+        ("conflicts", stats.conflicts, "Commits that hit a version conflict"),
+        ("retries", stats.retries, "Conflicting operations retried"),
+        ("retry_failures", stats.failures, "Operations that ran out of retries"),
+    ):
+        _metric(
+            lines, f"allocation_{name}_total", "counter", help_,
+            [((), sum(counter.values()))],
+        )
+
+
+def _cache(lines, cache):
+    stats = cache.stats
+    for name, value, help_ in (
+        ("hits", stats.hits, "Products served from the cache"),
+        ("misses", stats.misses, "Products loaded from the database"),
+        ("stale", stats.stale, "Cached products found out of date"),
+        ("evictions", stats.evictions, "Products evicted to stay under the caps"),
+    ):
+        _metric(lines, f"allocation_product_cache_{name}_total", "counter", help_,
+                [((), value)])
+    _metric(lines, "allocation_product_cache_products", "gauge",
+            "Products in the cache", [((), len(cache))])
+    _metric(lines, "allocation_product_cache_lines", "gauge",
+            "Allocated lines held by cached products", [((), cache.lines)])
+
+
+def _pool(lines, stats):
+    for name, help_ in (
+        ("size", "Connections the pool keeps open"),
+        ("checked_in", "Idle connections in the pool"),
+        ("checked_out", "Connections in use"),
+        ("overflow", "Connections open beyond the pool size"),
+    ):
+        _metric(lines, f"allocation_db_pool_{name}", "gauge", help_,
+                [((), stats[name])])
+    if "checkouts" in stats:
+        _metric(lines, "allocation_db_pool_checkouts_total", "counter",
+                "Connections taken from the pool", [((), stats["checkouts"])])
+        _metric(lines, "allocation_db_pool_timeouts_total", "counter",
+                "Checkouts that gave up waiting", [((), stats["timeouts"])])
+        _metric(lines, "allocation_db_pool_wait_seconds_total", "counter",
+                "Time spent waiting for a connection",
+                [((), stats["total_wait_seconds"])])
+        _metric(lines, "allocation_db_pool_max_wait_seconds", "gauge",
+                "Longest wait for a connection", [((), stats["max_wait_seconds"])])
+
+
+def _notifications(lines, dispatcher):
+    stats = dispatcher.stats
+    for name, help_ in (
+        ("submitted", "Notifications handed to the dispatcher"),
+        ("coalesced", "Notifications merged into one already waiting"),
+        ("dropped", "Notifications dropped because the queue was full"),
+        ("sent", "Notifications sent"),
+        ("failed", "Notifications that failed to send"),
+        ("flushed", "Notifications sent early by a flush"),
+    ):
+        _metric(lines, f"allocation_notifications_{name}_total", "counter", help_,
+                [((), getattr(stats, name))])
+    _metric(lines, "allocation_notifications_queue_depth", "gauge",
+            "Notifications waiting to be sent", [((), dispatcher.depth)])
+
+
+def _histograms(
+        lines, name, help_, histograms: Dict[tuple, instrumentation.Histogram]
+):
+    lines.append(f"# HELP {name} {help_}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        for bound, count in histogram.cumulative():
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram.sum!r}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+
+def _metric(lines, name, kind, help_, samples: Iterable[tuple]):
+    lines.append(f"# HELP {name} {help_}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in sorted(samples, key=lambda sample: sample[0]):
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
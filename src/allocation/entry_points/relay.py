@@ -0,0 +1,67 @@
+import argparse
+import signal
+import sys
+import threading
+from typing import TextIO
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import database, migrations, outbox
+
+
+def make_sink(args) -> outbox.AbstractSink:
+    if args.file:
+        return outbox.FileSink(args.file)
+    host, _, port = args.socket.rpartition(":")
+    return outbox.SocketSink(host or "localhost", int(port))
+
+
+def main(argv=None, stdout: TextIO = sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Publish events from the outbox table to a sink, in batches."
+    )
+    sinks = parser.add_mutually_exclusive_group(required=True)
+    sinks.add_argument("--file", help="append events to this JSONL file")
+    sinks.add_argument("--socket", help="send events to this host:port over TCP")
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="events per published batch"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="seconds between polls when idle"
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="publish what is there now, then exit"
+    )
+    parser.add_argument("--db-uri", default=None, help="defaults to the app database")
+    parser.add_argument(
+        "--create-schema", action="store_true", help="migrate the schema first"
+    )
+    args = parser.parse_args(argv)
+
+    engine = database.make_engine(args.db_uri)
+    if args.create_schema:
+        migrations.migrate(engine)
+    sink = make_sink(args)
+    relay = outbox.Relay(sessionmaker(bind=engine), sink, batch_size=args.batch_size)
+
+    try:
+        if args.once:
+            while relay.publish_batch():
+                pass
+        else:
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+            try:
+                relay.run(args.interval, stop)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        sink.close()
+    print(
+        f"published {relay.stats.published} events in {relay.stats.batches} batches",
+        file=stdout,
+    )
+
+
+if __name__ == "__main__":
+    main()
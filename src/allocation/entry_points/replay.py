@@ -0,0 +1,150 @@
+import argparse
+import itertools
+import json
+import random
+import sys
+import time
+from typing import Iterable, Iterator, List, TextIO
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import database, migrations, orm, serialization
+from allocation.domain import events
+from allocation.service_layer import handlers, message_bus, unit_of_work
+
+REPLAYABLE = (
+    events.BatchCreated,
+    events.AllocationRequired,
+    events.BatchQuantityChanged,
+)
+
+
+def read_events(lines: Iterable[str]) -> Iterator[events.Event]:
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            event = serialization.from_dict(json.loads(line))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"line {number}: {e}") from e
+        if not isinstance(event, REPLAYABLE):
+            raise ValueError(f"line {number}: cannot replay {type(event).__name__}")
+        yield event
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LatencySample:
+    # a fixed-size reservoir, so percentiles cost the same memory for any file
+    def __init__(self, size=10_000, seed=None):
+        self.size = size
+        self.count = 0
+        self.samples = []  # type: List[float]
+        self._random = random.Random(seed)
+
+    def add(self, seconds: float):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(seconds)
+        else:
+            slot = self._random.randrange(self.count)
+            if slot < self.size:
+                self.samples[slot] = seconds
+
+    def percentile(self, pct: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class ReplayReport:
+    def __init__(self):
+        self.events = 0
+        self.out_of_stock = 0
+        self.invalid_sku = 0
+        self.elapsed = 0.0
+        self.latency = LatencySample()
+
+    @property
+    def throughput(self) -> float:
+        return self.events / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        p50, p95, p99 = (self.latency.percentile(p) * 1000 for p in (50, 95, 99))
+        return (
+            f"replayed {self.events} events in {self.elapsed:.1f}s"
+            f" ({self.throughput:.0f} events/s)\n"
+            f"batch latency p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms\n"
+            f"out of stock: {self.out_of_stock}, invalid sku: {self.invalid_sku}"
+        )
+
+
+def _as_messages(chunk: List[events.Event]) -> Iterator[events.Event]:
+    # runs of allocations go through the bulk handler, which reports invalid
+    # skus per line instead of abandoning the rest of the chunk
+    for is_allocation, run in itertools.groupby(
+        chunk, key=lambda e: isinstance(e, events.AllocationRequired)
+    ):
+        if is_allocation:
+            yield events.BulkAllocationRequired(list(run))
+        else:
+            yield from run
+
+
+def replay(
+        lines: Iterable[str],
+        uow: unit_of_work.AbstractUnitOfWork,
+        batch_size: int = 100,
+) -> ReplayReport:
+    report = ReplayReport()
+    started = time.perf_counter()
+    for chunk in chunked(read_events(lines), batch_size):
+        chunk_started = time.perf_counter()
+        results = message_bus.handle_all(_as_messages(chunk), uow, batched=True)
+        report.latency.add(time.perf_counter() - chunk_started)
+        report.events += len(chunk)
+        for result in results:
+            if isinstance(result, list):  # from allocate_bulk
+                statuses = [line.status for line in result]
+                report.out_of_stock += statuses.count(handlers.OUT_OF_STOCK)
+                report.invalid_sku += statuses.count(handlers.INVALID_SKU)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def main(argv=None, stdout: TextIO = sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Stream a JSONL file of events through the message bus."
+    )
+    parser.add_argument("path", help="JSONL file of events, or - for stdin")
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="events per commit batch"
+    )
+    parser.add_argument("--db-uri", default=None, help="defaults to the app database")
+    parser.add_argument(
+        "--create-schema", action="store_true", help="migrate the schema first"
+    )
+    args = parser.parse_args(argv)
+
+    engine = database.make_engine(args.db_uri)
+    if args.create_schema:
+        migrations.migrate(engine)
+    orm.start_mappers()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+
+    source = sys.stdin if args.path == "-" else open(args.path)
+    with source:
+        report = replay(source, uow, batch_size=args.batch_size)
+    print(report.summary(), file=stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+# upper bounds in seconds, from a cached read up to a commit stuck on a lock
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+DEPTH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class BusMetrics:
+    def __init__(self):
+        self.events = {}  # type: Dict[str, Histogram]
+        self.handlers = {}  # type: Dict[Tuple[str, str], Histogram]
+        self.stages = {}  # type: Dict[str, Histogram]
+        self.cascaded = Counter()
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self._lock = threading.Lock()
+
+    def event_handled(self, event_type: str, seconds: float):
+        with self._lock:
+            self._histogram(self.events, event_type).observe(seconds)
+
+    def handler_ran(self, event_type: str, handler: str, seconds: float):
+        with self._lock:
+            self._histogram(self.handlers, (event_type, handler)).observe(seconds)
+
+    def stage_ran(self, stage: str, seconds: float):
+        # the parts of a handler: loading an aggregate, committing
+        with self._lock:
+            self._histogram(self.stages, stage).observe(seconds)
+
+    def events_cascaded(self, new_events):
+        with self._lock:
+            self.cascaded.update(type(event).__name__ for event in new_events)
+
+    def handle_finished(self, max_queue_depth: int):
+        with self._lock:
+            self.queue_depth.observe(max_queue_depth)
+
+    @staticmethod
+    def _histogram(histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        return histogram
+
+
+# None, the default, leaves the bus with one `is None` check per event
+METRICS = None  # type: Optional[BusMetrics]
+
+
+def enable() -> BusMetrics:
+    global METRICS
+    METRICS = BusMetrics()
+    return METRICS
+
+
+def disable():
+    global METRICS
+    METRICS = None
+
+
+def timed(stage: str):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            metrics = METRICS
+            if metrics is None:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.stage_ran(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def timed_async(stage: str):
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            metrics = METRICS
+            if metrics is None:
+                return await function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                metrics.stage_ran(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
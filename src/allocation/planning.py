@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import bindparam, text
+
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+# dry runs of allocation: where forecast demand would land if it were
+# allocated now, in order, without touching the products
+
+
+@dataclass
+class Snapshot:
+    # one sku's batches in allocation order, and what each has left
+    sku: str
+    batch_refs: List[str]
+    available: np.ndarray
+
+
+@dataclass
+class Plan:
+    batch_refs: List[Optional[str]]  # per demand line; None if nothing fits
+    leftover: Dict[str, int]  # per batch, once the demand is allocated
+
+
+LOAD_SNAPSHOTS = text(
+    "SELECT b.sku, b.reference,"
+    " b._purchased_quantity - COALESCE(SUM(l.qty), 0) AS available"
+    " FROM batches AS b"
+    " LEFT JOIN allocations AS a ON a.batch_id = b.id"
+    " LEFT JOIN order_lines AS l ON l.id = a.orderline_id"
+    " WHERE b.sku IN :skus"
+    " GROUP BY b.id, b.sku, b.reference, b.eta, b._purchased_quantity"
+    " ORDER BY b.sku, b.eta IS NOT NULL, b.eta, b.id"
+).bindparams(bindparam("skus", expanding=True))
+
+
+def snapshot(product: model.Product) -> Snapshot:
+    batches = sorted(product.batches)  # the order Product.allocate uses
+    return Snapshot(
+        product.sku,
+        [b.reference for b in batches],
+        np.array([b.available_quantity for b in batches], dtype=np.int64),
+    )
+
+
+def load_snapshots(
+        skus: Iterable[str], uow: unit_of_work.SqlAlchemyUnitOfWork
+) -> List[Snapshot]:
+    # straight from the tables, without loading the products. ties on eta
+    # are broken by id, the order the batches were added in
+    with uow:
+        rows = uow.session.execute(LOAD_SNAPSHOTS, dict(skus=list(set(skus)))).all()
+    grouped = {}  # type: Dict[str, List]
+    for row in rows:
+        grouped.setdefault(row.sku, []).append(row)
+    return [
+        Snapshot(
+            sku,
+            [row.reference for row in batches],
+            np.array([row.available for row in batches], dtype=np.int64),
+        )
+        for sku, batches in grouped.items()
+    ]
+
+
+def plan(
+        snapshots: Iterable[Snapshot], skus: Sequence[str], quantities: Sequence[int]
+) -> Plan:
+    # demand line i is quantities[i] of skus[i]; lines are allocated in order
+    quantities = np.asarray(quantities, dtype=np.int64)
+    lines_by_sku = _group(skus)
+    batch_refs = np.full(len(quantities), None, dtype=object)
+    leftover = {}
+    for stock in snapshots:
+        lines = lines_by_sku.get(stock.sku, np.arange(0))
+        left = stock.available.copy()
+        positions = first_fit(left, quantities[lines])
+        placed = positions >= 0
+        batch_refs[lines[placed]] = np.array(stock.batch_refs, dtype=object)[
+            positions[placed]
+        ]
+        leftover.update(zip(stock.batch_refs, left.tolist()))
+    return Plan(batch_refs.tolist(), leftover)
+
+
+def _group(skus: Sequence[str]) -> Dict[str, np.ndarray]:
+    # each sku's demand line positions, in order
+    names, codes = np.unique(np.asarray(skus, dtype=str), return_inverse=True)
+    in_order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[in_order], np.arange(len(names) + 1))
+    return {
+        name: in_order[start:end]
+        for name, start, end in zip(names.tolist(), bounds[:-1], bounds[1:])
+    }
+
+
+def first_fit(left: np.ndarray, quantities: np.ndarray) -> np.ndarray:
+    # gives each line, in order, to the first batch with room for it, like
+    # Product.allocate. returns each line's batch position (-1 for none) and
+    # takes the quantities allocated off `left`.
+    #
+    # which lines a batch takes depends only on the lines before them that it
+    # took, so batches can be filled one at a time from the lines the earlier
+    # ones didn't take. within a batch, every line up to the first one whose
+    # running total overflows is taken; that line can't fit any more, and
+    # neither can any later line bigger than what is left, so drop those and
+    # repeat. each repeat skips a line smaller than the one before, so there
+    # are at most as many as there are distinct quantities
+    positions = np.full(len(quantities), -1, dtype=np.int64)
+    pending = np.arange(len(quantities))
+    for batch in range(len(left)):
+        candidates = pending
+        while candidates.size:
+            candidates = candidates[quantities[candidates] <= left[batch]]
+            if not candidates.size:
+                break
+            running = np.cumsum(quantities[candidates])
+            taken = np.searchsorted(running, left[batch], side="right")
+            positions[candidates[:taken]] = batch
+            left[batch] -= running[taken - 1]
+            candidates = candidates[taken:]
+        pending = pending[positions[pending] < 0]
+        if not pending.size:
+            break
+    return positions
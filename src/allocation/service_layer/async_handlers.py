@@ -0,0 +1,134 @@
+from __future__ import annotations
+import asyncio
+from typing import TYPE_CHECKING
+from allocation.adapters import email
+from allocation.domain import events, model
+from allocation.domain.model import OrderLine
+from . import notifications
+from .handlers import (
+    ADD_TO_READ_MODEL,
+    MOVE_IN_READ_MODEL,
+    REMOVE_FROM_READ_MODEL,
+    InvalidSku,
+    idempotency_key,
+    new_record,
+    rebalances,
+    recorded_batch_ref,
+)
+
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+
+async def add_batch(
+        event: events.BatchCreated,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    async with uow:
+        product = await uow.products.get(sku=event.sku)
+        if product is None:
+            product = model.Product(event.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(
+            model.Batch(event.ref, event.sku, event.qty, event.eta)
+        )
+        await uow.commit()
+
+
+async def allocate(
+        event: events.AllocationRequired,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    line = OrderLine(event.order_id, event.sku, event.qty)
+    key = idempotency_key(event)
+    async with uow:
+        record = await uow.idempotency_keys.get(key)
+        if record is not None:
+            return recorded_batch_ref(record, event)
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        batch_ref = product.allocate(line)
+        if batch_ref is not None:
+            await uow.idempotency_keys.add(new_record(key, event, batch_ref))
+        await uow.commit()
+        return batch_ref
+
+
+async def change_batch_quantity(
+        event: events.BatchQuantityChanged,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    async with uow:
+        product = await uow.products.get_by_batch_ref(batch_ref=event.ref)
+        product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        keys = uow.idempotency_keys
+        for rebalanced in rebalances(product):
+            for order_id, batch_ref in rebalanced.reallocated.items():
+                await keys.reassign(order_id, rebalanced.sku, batch_ref)
+            for order_id in rebalanced.unallocated:
+                await keys.remove(order_id, rebalanced.sku)
+        await uow.commit()
+
+
+async def send_out_of_stock_notification(
+        event: events.OutOfStock,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    message = ("stock@made.com", f"Out of stock for {event.sku}")
+    if notifications.DISPATCHER is None:
+        # the email adapter blocks, so keep it off the event loop
+        await asyncio.to_thread(email.send, *message)
+    else:
+        notifications.DISPATCHER.dispatch(("out_of_stock", event.sku), *message)
+
+
+async def add_allocation_to_read_model(
+        event: events.Allocated,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    async with uow:
+        await uow.session.execute(
+            ADD_TO_READ_MODEL,
+            dict(
+                order_id=event.order_id,
+                sku=event.sku,
+                qty=event.qty,
+                batch_ref=event.batch_ref,
+            ),
+        )
+        await uow.commit()
+
+
+async def remove_allocation_from_read_model(
+        event: events.Deallocated,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    async with uow:
+        await uow.session.execute(
+            REMOVE_FROM_READ_MODEL,
+            dict(order_id=event.order_id, sku=event.sku),
+        )
+        await uow.commit()
+
+
+async def update_read_model_after_rebalance(
+        event: events.BatchRebalanced,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    async with uow:
+        if event.reallocated:
+            await uow.session.execute(
+                MOVE_IN_READ_MODEL,
+                [
+                    dict(order_id=order_id, sku=event.sku, batch_ref=batch_ref)
+                    for order_id, batch_ref in event.reallocated.items()
+                ],
+            )
+        if event.unallocated:
+            await uow.session.execute(
+                REMOVE_FROM_READ_MODEL,
+                [dict(order_id=o, sku=event.sku) for o in event.unallocated],
+            )
+        await uow.commit()
@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+from typing import Callable, Iterable, List, Optional, Type
+
+from allocation.adapters import transports
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelStats:
+    def __init__(self):
+        self.published = 0
+        self.dropped = 0  # turned away because the queue was full
+        self.batches = 0
+        self.failed = 0  # batches the transport raised on
+
+
+class EventChannel:
+    # sends the selected event types to other processes, off the request
+    # path. a sender thread sends whatever has queued up while it was busy,
+    # up to max_batch events, as one frame
+    def __init__(
+            self,
+            transport: transports.AbstractTransport,
+            topics: Iterable[Type[events.Event]],
+            max_batch: int = 100,
+            max_queue: int = 10_000,
+    ):
+        self.transport = transport
+        self.topics = frozenset(topics)
+        self.max_batch = max_batch
+        self.stats = ChannelStats()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._sender = threading.Thread(target=self._send, daemon=True)
+        self._sender.start()
+
+    def publish(self, new_events: Iterable[events.Event]):
+        for event in new_events:
+            if type(event) not in self.topics:
+                continue
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.stats.dropped += 1
+            else:
+                self.stats.published += 1
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._sender.join()
+        self.transport.close()
+
+    def _send(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            try:
+                if batch:
+                    self.transport.send(transports.encode(batch))
+                    self.stats.batches += 1
+            except Exception:
+                logger.exception("failed to send %d events", len(batch))
+                self.stats.failed += 1
+            finally:
+                for _ in range(len(batch) + closing):
+                    self._queue.task_done()
+            if closing:
+                return
+
+
+class Subscriber:
+    # hands the selected event types received from other processes to
+    # `handle`, a frame's worth at a time
+    def __init__(
+            self,
+            transport: transports.AbstractTransport,
+            topics: Iterable[Type[events.Event]],
+            handle: Callable[[List[events.Event]], object],
+    ):
+        self.transport = transport
+        self.topics = frozenset(topics)
+        self.handle = handle
+        self.received = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=transport.serve, args=(self._on_frame, self._stop), daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _on_frame(self, frame: bytes):
+        try:
+            batch = [e for e in transports.decode(frame) if type(e) in self.topics]
+            if batch:
+                self.received += len(batch)
+                self.handle(batch)
+        except Exception:
+            logger.exception("failed to handle events from the channel")
+
+
+CHANNEL = None  # type: Optional[EventChannel]
+
+
+def start(
+        transport: transports.AbstractTransport, topics, **settings
+) -> EventChannel:
+    global CHANNEL
+    CHANNEL = EventChannel(transport, topics, **settings)
+    return CHANNEL
+
+
+def stop():
+    global CHANNEL
+    if CHANNEL is not None:
+        CHANNEL.close()
+        CHANNEL = None
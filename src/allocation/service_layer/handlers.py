@@ -1,8 +1,12 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
 from allocation.adapters import email
+from allocation.adapters.idempotency import IdempotencyRecord
 from allocation.domain import events, model
 from allocation.domain.model import OrderLine
+from . import notifications, retries
 
 
 if TYPE_CHECKING:
@@ -13,35 +17,306 @@ class InvalidSku(Exception):
     pass
 
 
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+ALLOCATED = "allocated"
+OUT_OF_STOCK = "out_of_stock"
+INVALID_SKU = "invalid_sku"
+DUPLICATE = "duplicate"  # the same order line, or key, as an earlier line
+KEY_REUSED = "key_reused"  # its key was recorded for another request
+
+
+# the allocations read model, shared with async_handlers
+ADD_TO_READ_MODEL = (
+    "INSERT INTO allocations_view (order_id, sku, qty, batch_ref)"
+    " VALUES (:order_id, :sku, :qty, :batch_ref)"
+)
+REMOVE_FROM_READ_MODEL = (
+    "DELETE FROM allocations_view WHERE order_id = :order_id AND sku = :sku"
+)
+MOVE_IN_READ_MODEL = (
+    "UPDATE allocations_view SET batch_ref = :batch_ref"
+    " WHERE order_id = :order_id AND sku = :sku"
+)
+
+
+@dataclass
+class LineAllocation:
+    order_id: str
+    sku: str
+    qty: int
+    status: str
+    batch_ref: Optional[str] = None
+
+
 def add_batch(
         event: events.BatchCreated,
         uow: unit_of_work.AbstractUnitOfWork
 ):
     with uow:
-        product = uow.products.get(sku=event.sku)
+        product = uow.products.get(sku=event.sku, allocations=False)
         if product is None:
             product = model.Product(event.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(
+        product.add_batch(
             model.Batch(event.ref, event.sku, event.qty, event.eta)
         )
         uow.commit()
 
 
+def add_batches(
+        batch_events: List[events.BatchCreated],
+        uow: unit_of_work.AbstractUnitOfWork
+):
+    return retries.retry_on_conflict(lambda: _add_batches(batch_events, uow))
+
+
+def _add_batches(
+        batch_events: List[events.BatchCreated],
+        uow: unit_of_work.AbstractUnitOfWork
+):
+    products = {}
+    with uow:
+        for event in batch_events:
+            product = products.get(event.sku) or uow.products.get(
+                sku=event.sku, allocations=False
+            )
+            if product is None:
+                product = model.Product(event.sku, batches=[])
+                uow.products.add(product)
+            products[event.sku] = product
+            product.add_batch(
+                model.Batch(event.ref, event.sku, event.qty, event.eta)
+            )
+        uow.commit()
+    return [None] * len(batch_events)
+
+
 def allocate(
         event: events.AllocationRequired,
         uow: unit_of_work.AbstractUnitOfWork
 ):
     line = OrderLine(event.order_id, event.sku, event.qty)
+    key = idempotency_key(event)
     with uow:
+        # a retry is answered from its key, without loading the product
+        record = uow.idempotency_keys.get(key)
+        if record is not None:
+            return recorded_batch_ref(record, event)
         product = uow.products.get(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
         batch_ref = product.allocate(line)
+        if batch_ref is not None:
+            uow.idempotency_keys.add(new_record(key, event, batch_ref))
         uow.commit()
         return batch_ref
 
 
+def allocate_many(
+        allocations: List[events.AllocationRequired],
+        uow: unit_of_work.AbstractUnitOfWork
+) -> List[Optional[str]]:
+    batch_refs = [None] * len(allocations)
+    by_sku = _group_by_sku(allocations)
+    # checked up front, since each sku commits on its own and an unknown sku
+    # or reused key found halfway would lose the results of those before it
+    with uow:
+        known = uow.products.known_skus(list(by_sku))
+        recorded = uow.idempotency_keys.get_many(
+            idempotency_key(a) for a in allocations
+        )
+    for sku in by_sku:
+        if sku not in known:
+            raise InvalidSku(f"Invalid sku {sku}")
+    for allocation in allocations:
+        # a key is reused if it was recorded, or used earlier in the run, for
+        # another request
+        key = idempotency_key(allocation)
+        record = recorded.setdefault(key, new_record(key, allocation, None))
+        recorded_batch_ref(record, allocation)
+    for sku, (positions, requests) in by_sku.items():
+        outcome = retries.retry_on_conflict(
+            lambda: _allocate_sku(sku, requests, uow)
+        )
+        if outcome is None:
+            raise InvalidSku(f"Invalid sku {sku}")
+        refs, reused = outcome
+        if reused:
+            # recorded by another request since the check above
+            key = idempotency_key(requests[min(reused)])
+            raise IdempotencyKeyReused(
+                f"Idempotency key {key} was used for another request"
+            )
+        for position, batch_ref in zip(positions, refs):
+            batch_refs[position] = batch_ref
+    return batch_refs
+
+
+def allocate_bulk(
+        event: events.BulkAllocationRequired,
+        uow: unit_of_work.AbstractUnitOfWork
+) -> List[LineAllocation]:
+    results = [None] * len(event.lines)
+    # an order holds one line per sku, so a line repeating an earlier one
+    # is turned away rather than allocated, or answered, twice
+    lines, seen = [], set()
+    for position, request in enumerate(event.lines):
+        line = (request.order_id, request.sku)
+        key = idempotency_key(request)
+        if line in seen or key in seen:
+            results[position] = LineAllocation(
+                request.order_id, request.sku, request.qty, DUPLICATE
+            )
+        else:
+            lines.append((position, request))
+            seen.update([line, key])
+    for sku, (indexes, requests) in _group_by_sku([r for _, r in lines]).items():
+        positions = [lines[i][0] for i in indexes]
+        outcome = retries.retry_on_conflict(
+            lambda: _allocate_sku(sku, requests, uow)
+        )
+        refs, reused = outcome or ([None] * len(requests), set())
+        for index, (position, request, batch_ref) in enumerate(
+            zip(positions, requests, refs)
+        ):
+            if outcome is None:
+                status = INVALID_SKU
+            elif index in reused:
+                status = KEY_REUSED
+            elif batch_ref is None:
+                status = OUT_OF_STOCK
+            else:
+                status = ALLOCATED
+            results[position] = LineAllocation(
+                request.order_id, request.sku, request.qty, status, batch_ref
+            )
+    return results
+
+
+def _allocate_sku(
+        sku: str,
+        requests: List[events.AllocationRequired],
+        uow: unit_of_work.AbstractUnitOfWork
+) -> Optional[Tuple[List[Optional[str]], Set[int]]]:
+    # one transaction per sku, so that a conflict only retries that sku.
+    # returns each request's batch ref, and which requests reused a key
+    # recorded for another request; None if the sku is unknown
+    keys = [idempotency_key(r) for r in requests]
+    with uow:
+        recorded = uow.idempotency_keys.get_many(keys)
+        batch_refs = [None] * len(requests)  # type: List[Optional[str]]
+        reused = set()  # type: Set[int]
+
+        def answer(position):
+            record, request = recorded[keys[position]], requests[position]
+            if _answers(record, request):
+                batch_refs[position] = record.batch_ref
+            else:
+                reused.add(position)
+
+        for position, key in enumerate(keys):
+            if key in recorded:
+                answer(position)
+        pending = [i for i, key in enumerate(keys) if key not in recorded]
+        if not pending:
+            return batch_refs, reused
+        product = uow.products.get(sku=sku)
+        if product is None:
+            return None
+        # a key repeated within the run is a retry of its first request, and
+        # is answered once that one has been allocated
+        first = {}  # type: Dict[str, int]
+        for position in pending:
+            first.setdefault(keys[position], position)
+        new = list(first.values())
+        allocated = product.allocate_many([
+            OrderLine(requests[i].order_id, requests[i].sku, requests[i].qty)
+            for i in new
+        ])
+        for position, batch_ref in zip(new, allocated):
+            batch_refs[position] = batch_ref
+            if batch_ref is not None:
+                key = keys[position]
+                recorded[key] = new_record(key, requests[position], batch_ref)
+                uow.idempotency_keys.add(recorded[key])
+        for position in pending:
+            key = keys[position]
+            if first[key] != position and key in recorded:
+                answer(position)
+        uow.commit()
+        return batch_refs, reused
+
+
+def idempotency_key(event: events.AllocationRequired) -> str:
+    # without a client key, an order line is only ever allocated once
+    return event.idempotency_key or f"{event.order_id}:{event.sku}"
+
+
+def new_record(
+        key: str, event: events.AllocationRequired, batch_ref: str
+) -> IdempotencyRecord:
+    return IdempotencyRecord(key, event.order_id, event.sku, event.qty, batch_ref)
+
+
+def recorded_batch_ref(
+        record: IdempotencyRecord, event: events.AllocationRequired
+) -> str:
+    if not _answers(record, event):
+        raise IdempotencyKeyReused(
+            f"Idempotency key {record.key} was used for another request"
+        )
+    return record.batch_ref
+
+
+def _answers(record: IdempotencyRecord, event: events.AllocationRequired) -> bool:
+    # whether the record is of this request, rather than another under its key
+    request = (event.order_id, event.sku, event.qty)
+    return (record.order_id, record.sku, record.qty) == request
+
+
+def _group_by_sku(
+        allocations: List[events.AllocationRequired]
+) -> Dict[str, Tuple[List[int], List[events.AllocationRequired]]]:
+    grouped = defaultdict(lambda: ([], []))
+    for position, event in enumerate(allocations):
+        positions, requests = grouped[event.sku]
+        positions.append(position)
+        requests.append(event)
+    return grouped
+
+
+def deallocate(
+        event: events.DeallocationRequired,
+        uow: unit_of_work.AbstractUnitOfWork
+) -> List[str]:
+    with uow:
+        product = uow.products.get_for_order(event.sku, event.order_id)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {event.sku}")
+        batch_refs = product.deallocate(event.order_id)
+        if batch_refs:
+            uow.idempotency_keys.remove(event.order_id, event.sku)
+        uow.commit()
+        return batch_refs
+
+
+def cancel_order(
+        event: events.OrderCancelled,
+        uow: unit_of_work.AbstractUnitOfWork
+) -> Dict[str, List[str]]:
+    # one transaction per sku, like bulk allocation
+    with uow:
+        skus = uow.products.skus_for_order(event.order_id)
+    released = {}
+    for sku in skus:
+        request = events.DeallocationRequired(event.order_id, sku)
+        released[sku] = retries.retry_on_conflict(lambda: deallocate(request, uow))
+    return released
+
+
 def change_batch_quantity(
         event: events.BatchQuantityChanged,
         uow: unit_of_work.AbstractUnitOfWork
@@ -49,14 +324,82 @@ def change_batch_quantity(
     with uow:
         product = uow.products.get_by_batch_ref(batch_ref=event.ref)
         product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        for rebalanced in rebalances(product):
+            for order_id, batch_ref in rebalanced.reallocated.items():
+                uow.idempotency_keys.reassign(order_id, rebalanced.sku, batch_ref)
+            for order_id in rebalanced.unallocated:
+                uow.idempotency_keys.remove(order_id, rebalanced.sku)
         uow.commit()
 
 
+def rebalances(product: model.Product) -> List[events.BatchRebalanced]:
+    # the lines a rebalance moved or dropped must not be answered from their
+    # old records, so these are applied in the same transaction
+    return [e for e in product.events if isinstance(e, events.BatchRebalanced)]
+
+
 def send_out_of_stock_notification(
         event: events.OutOfStock,
         uow: unit_of_work.AbstractUnitOfWork
 ):
-    email.send(
-        "stock@made.com",
-        f"Out of stock for {event.sku}"
-    )
\ No newline at end of file
+    message = ("stock@made.com", f"Out of stock for {event.sku}")
+    if notifications.DISPATCHER is None:
+        email.send(*message)
+    else:
+        notifications.DISPATCHER.dispatch(("out_of_stock", event.sku), *message)
+
+
+def add_allocation_to_read_model(
+        event: events.Allocated,
+        uow: unit_of_work.SqlAlchemyUnitOfWork
+):
+    add_allocations_to_read_model([event], uow)
+
+
+def add_allocations_to_read_model(
+        allocated: List[events.Allocated],
+        uow: unit_of_work.SqlAlchemyUnitOfWork
+):
+    with uow:
+        uow.session.execute(
+            ADD_TO_READ_MODEL,
+            [
+                dict(order_id=e.order_id, sku=e.sku, qty=e.qty, batch_ref=e.batch_ref)
+                for e in allocated
+            ],
+        )
+        uow.commit()
+    return [None] * len(allocated)
+
+
+def remove_allocation_from_read_model(
+        event: events.Deallocated,
+        uow: unit_of_work.SqlAlchemyUnitOfWork
+):
+    with uow:
+        uow.session.execute(
+            REMOVE_FROM_READ_MODEL,
+            dict(order_id=event.order_id, sku=event.sku),
+        )
+        uow.commit()
+
+
+def update_read_model_after_rebalance(
+        event: events.BatchRebalanced,
+        uow: unit_of_work.SqlAlchemyUnitOfWork
+):
+    with uow:
+        if event.reallocated:
+            uow.session.execute(
+                MOVE_IN_READ_MODEL,
+                [
+                    dict(order_id=order_id, sku=event.sku, batch_ref=batch_ref)
+                    for order_id, batch_ref in event.reallocated.items()
+                ],
+            )
+        if event.unallocated:
+            uow.session.execute(
+                REMOVE_FROM_READ_MODEL,
+                [dict(order_id=o, sku=event.sku) for o in event.unallocated],
+            )
+        uow.commit()
@@ -1,8 +1,11 @@
 from __future__ import annotations
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+import time
+from collections import deque
+from typing import List, Dict, Callable, Iterable, Type, TYPE_CHECKING
+from allocation import instrumentation
 from allocation.adapters import email
 from allocation.domain import events
-from . import handlers
+from . import async_handlers, channels, handlers, retries
 
 if TYPE_CHECKING:
     from . import unit_of_work
@@ -10,21 +13,147 @@ if TYPE_CHECKING:
 
 def handle(
         event: events.Event,
-        uow: unit_of_work.AbstractUnitOfWork
+        uow: unit_of_work.AbstractUnitOfWork,
+        batched: bool = False
 ):
+    return handle_all([event], uow, batched=batched)
+
+
+def handle_all(
+        messages: Iterable[events.Event],
+        uow: unit_of_work.AbstractUnitOfWork,
+        batched: bool = False,
+        from_channel: bool = False,
+):
+    metrics = instrumentation.METRICS
+    channel = channels.CHANNEL
     results = []
-    queue = [event]
+    queue = deque(messages)
+    max_depth = len(queue)
+    # events that came in over the channel are not sent back out on it,
+    # though the events handling them raises are
+    received = {id(message) for message in queue} if from_channel else set()
     while queue:
-        event = queue.pop(0)
-        for handler in HANDLERS[type(event)]:
-            results.append(handler(event, uow=uow))
-            queue.extend(uow.collect_new_events())
+        event = queue.popleft()
+        started = time.perf_counter() if metrics is not None else 0.0
+        bulk_handler = BULK_HANDLERS.get(type(event)) if batched else None
+        run = [event]
+        if bulk_handler is not None:
+            # drain the run of same-type events behind this one into one call;
+            # bulk handlers retry conflicts themselves, per transaction
+            while queue and type(queue[0]) is type(event):
+                run.append(queue.popleft())
+            results.extend(_timed(metrics, event, bulk_handler, run, uow))
+        else:
+            for handler in HANDLERS[type(event)]:
+                if handler in RETRIES_ITSELF:
+                    results.append(_timed(metrics, event, handler, event, uow))
+                    continue
+                results.append(
+                    retries.retry_on_conflict(
+                        lambda: _timed(metrics, event, handler, event, uow)
+                    )
+                )
+        if channel is not None:
+            channel.publish(e for e in run if id(e) not in received)
+        new_events = list(uow.collect_new_events())
+        if metrics is not None:
+            metrics.events_cascaded(new_events)
+            metrics.event_handled(type(event).__name__, time.perf_counter() - started)
+        queue.extend(new_events)
+        max_depth = max(max_depth, len(queue))
+    if metrics is not None:
+        metrics.handle_finished(max_depth)
     return results
 
 
+def _timed(metrics, event, handler, message, uow):
+    if metrics is None:
+        return handler(message, uow=uow)
+    started = time.perf_counter()
+    try:
+        return handler(message, uow=uow)
+    finally:
+        metrics.handler_ran(
+            type(event).__name__, handler.__name__, time.perf_counter() - started
+        )
+
+
+async def handle_async(
+        event: events.Event,
+        uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+):
+    metrics = instrumentation.METRICS
+    channel = channels.CHANNEL
+    results = []
+    queue = deque([event])
+    max_depth = 1
+    while queue:
+        event = queue.popleft()
+        started = time.perf_counter() if metrics is not None else 0.0
+        for handler in ASYNC_HANDLERS[type(event)]:
+            results.append(
+                await retries.retry_on_conflict_async(
+                    lambda: _timed_async(metrics, event, handler, uow)
+                )
+            )
+        if channel is not None:
+            channel.publish([event])
+        new_events = list(uow.collect_new_events())
+        if metrics is not None:
+            metrics.events_cascaded(new_events)
+            metrics.event_handled(type(event).__name__, time.perf_counter() - started)
+        queue.extend(new_events)
+        max_depth = max(max_depth, len(queue))
+    if metrics is not None:
+        metrics.handle_finished(max_depth)
+    return results
+
+
+async def _timed_async(metrics, event, handler, uow):
+    if metrics is None:
+        return await handler(event, uow=uow)
+    started = time.perf_counter()
+    try:
+        return await handler(event, uow=uow)
+    finally:
+        metrics.handler_ran(
+            type(event).__name__, handler.__name__, time.perf_counter() - started
+        )
+
+
 HANDLERS = {
     events.BatchCreated: [handlers.add_batch],
     events.OutOfStock: [handlers.send_out_of_stock_notification],
     events.AllocationRequired: [handlers.allocate],
-    events.BatchQuantityChanged: [handlers.change_batch_quantity]
+    events.BulkAllocationRequired: [handlers.allocate_bulk],
+    events.DeallocationRequired: [handlers.deallocate],
+    events.OrderCancelled: [handlers.cancel_order],
+    events.BatchQuantityChanged: [handlers.change_batch_quantity],
+    events.BatchRebalanced: [handlers.update_read_model_after_rebalance],
+    events.Allocated: [handlers.add_allocation_to_read_model],
+    events.Deallocated: [handlers.remove_allocation_from_read_model],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+
+# handlers that commit one unit of work per sku and retry each of those
+# themselves; retrying them whole would replay the skus already committed
+RETRIES_ITSELF = {handlers.allocate_bulk, handlers.cancel_order}
+
+
+BULK_HANDLERS = {
+    events.BatchCreated: handlers.add_batches,
+    events.Allocated: handlers.add_allocations_to_read_model,
+    events.AllocationRequired: handlers.allocate_many,
+}  # type: Dict[Type[events.Event], Callable]
+
+
+ASYNC_HANDLERS = {
+    events.BatchCreated: [async_handlers.add_batch],
+    events.OutOfStock: [async_handlers.send_out_of_stock_notification],
+    events.AllocationRequired: [async_handlers.allocate],
+    events.BatchQuantityChanged: [async_handlers.change_batch_quantity],
+    events.BatchRebalanced: [async_handlers.update_read_model_after_rebalance],
+    events.Allocated: [async_handlers.add_allocation_to_read_model],
+    events.Deallocated: [async_handlers.remove_allocation_from_read_model],
 }  # type: Dict[Type[events.Event], List[Callable]]
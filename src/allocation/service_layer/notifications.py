@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DispatcherStats:
+    def __init__(self):
+        self.submitted = 0
+        self.coalesced = 0  # merged into a message already waiting to go
+        self.dropped = 0  # turned away because the queue was full
+        self.sent = 0
+        self.failed = 0
+        self.flushed = 0  # sent before their window closed, on flush()
+
+
+class NotificationDispatcher:
+    # sends notifications on a pool of worker threads, off the request path.
+    # a message waits `window` seconds before going out, and any message with
+    # the same key submitted in the meantime is merged into it
+    def __init__(
+            self,
+            send: Callable,
+            workers: int = 2,
+            max_queue: int = 1000,
+            window: float = 1.0,
+    ):
+        self.send = send
+        self.window = window
+        self.stats = DispatcherStats()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._flushing = threading.Event()
+        self._workers = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]  # type: List[threading.Thread]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def dispatch(self, key: Hashable, *args):
+        with self._lock:
+            self.stats.submitted += 1
+            if key in self._pending:
+                self.stats.coalesced += 1
+                return
+            try:
+                self._queue.put_nowait((time.monotonic() + self.window, key, args))
+            except queue.Full:
+                self.stats.dropped += 1
+                return
+            self._pending.add(key)
+
+    def flush(self):
+        # send everything queued now, without waiting out the windows
+        self._flushing.set()
+        try:
+            self._queue.join()
+        finally:
+            self._flushing.clear()
+
+    def close(self):
+        self.flush()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._deliver(*item)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, due, key, args):
+        remaining = due - time.monotonic()
+        if remaining > 0 and self._flushing.wait(remaining):
+            with self._lock:
+                self.stats.flushed += 1
+        with self._lock:
+            # from here on, a new message for this key opens a new window
+            self._pending.discard(key)
+        try:
+            self.send(*args)
+        except Exception:
+            logger.exception("failed to send notification for %s", key)
+            with self._lock:
+                self.stats.failed += 1
+        else:
+            with self._lock:
+                self.stats.sent += 1
+
+
+DISPATCHER = None  # type: Optional[NotificationDispatcher]
+
+
+def start(send: Callable, **settings) -> NotificationDispatcher:
+    global DISPATCHER
+    DISPATCHER = NotificationDispatcher(send, **settings)
+    return DISPATCHER
+
+
+def stop():
+    global DISPATCHER
+    if DISPATCHER is not None:
+        DISPATCHER.close()
+        DISPATCHER = None
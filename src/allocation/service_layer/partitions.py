@@ -0,0 +1,106 @@
+import itertools
+import multiprocessing
+import pickle
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import database, orm
+from allocation.domain import events
+from . import message_bus, unit_of_work
+
+# events that name their sku, and so can be routed to the partition owning it
+PARTITIONED = (
+    events.AllocationRequired, events.BatchCreated, events.DeallocationRequired
+)
+
+
+def partition_for(sku: str, partitions: int) -> int:
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(sku.encode()) % partitions
+
+
+class PartitionedBus:
+    # one worker process per partition, each handling the events for its skus
+    # one at a time and in order, so no two workers ever write the same product
+    def __init__(self, partitions: int, db_uri: Optional[str] = None):
+        context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self._inboxes = [context.Queue() for _ in range(partitions)]
+        self._workers = [
+            context.Process(
+                target=_work,
+                args=(inbox, self._results, db_uri),
+                name=f"allocation-partition-{partition}",
+                daemon=True,
+            )
+            for partition, inbox in enumerate(self._inboxes)
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._ids = itertools.count()
+        self._futures = {}  # type: Dict[int, Future]
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, event: events.Event) -> Future:
+        if not isinstance(event, PARTITIONED):
+            raise ValueError(f"cannot partition {type(event).__name__}")
+        future = Future()
+        with self._lock:
+            message_id = next(self._ids)
+            self._futures[message_id] = future
+        partition = partition_for(event.sku, len(self._inboxes))
+        self._inboxes[partition].put((message_id, event))
+        return future
+
+    def close(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def _collect(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            message_id, value, error = result
+            with self._lock:
+                future = self._futures.pop(message_id)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+
+
+def _work(inbox, results, db_uri):
+    orm.start_mappers()
+    if db_uri is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+    else:
+        engine = database.make_engine(db_uri)
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    while True:
+        message = inbox.get()
+        if message is None:
+            return
+        message_id, event = message
+        try:
+            results.put((message_id, message_bus.handle(event, uow), None))
+        except Exception as e:
+            results.put((message_id, None, _picklable(e)))
+
+
+def _picklable(error: Exception) -> Exception:
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
@@ -0,0 +1,67 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+from .unit_of_work import ConcurrencyError
+
+T = TypeVar("T")
+
+
+@dataclass
+class RetryPolicy:
+    retries: int = 5
+    base_delay: float = 0.005
+    max_delay: float = 0.2
+
+    def backoff(self, retry: int) -> float:
+        # "full jitter", so that clients who collided once don't collide again
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+class ConflictStats:
+    def __init__(self):
+        self.conflicts = Counter()
+        self.retries = Counter()
+        self.failures = Counter()
+
+
+POLICY = RetryPolicy()
+STATS = ConflictStats()
+
+
+def retry_on_conflict(operation: Callable[[], T], policy: RetryPolicy = None) -> T:
+    # the operation must start its own unit of work, so each attempt reloads
+    policy = policy or POLICY
+    retry = 0
+    while True:
+        try:
+            return operation()
+        except ConcurrencyError as e:
+            STATS.conflicts.update(e.skus)
+            if retry >= policy.retries:
+                STATS.failures.update(e.skus)
+                raise
+            STATS.retries.update(e.skus)
+            time.sleep(policy.backoff(retry))
+            retry += 1
+
+
+async def retry_on_conflict_async(
+        operation: Callable[[], Awaitable[T]], policy: RetryPolicy = None
+) -> T:
+    policy = policy or POLICY
+    retry = 0
+    while True:
+        try:
+            return await operation()
+        except ConcurrencyError as e:
+            STATS.conflicts.update(e.skus)
+            if retry >= policy.retries:
+                STATS.failures.update(e.skus)
+                raise
+            STATS.retries.update(e.skus)
+            await asyncio.sleep(policy.backoff(retry))
+            retry += 1
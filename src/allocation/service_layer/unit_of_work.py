@@ -1,14 +1,46 @@
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-from allocation import config
-from allocation.adapters import repository
+from typing import Iterable
+
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+from allocation import config, instrumentation
+from allocation.adapters import database, idempotency, outbox, profiling, repository
+from allocation.adapters.cache import ProductCache, is_cacheable
+
+# postgres' serialization_failure and deadlock_detected
+CONFLICT_PGCODES = {"40001", "40P01"}
+UNIQUE_VIOLATION = "23505"
+
+
+class ConcurrencyError(Exception):
+    def __init__(self, message: str, skus: Iterable[str] = ()):
+        super().__init__(message)
+        self.skus = list(skus)
+
+
+def is_conflict(error: Exception) -> bool:
+    if isinstance(error, StaleDataError):
+        return True
+    # asyncpg reports the sqlstate under another name than psycopg2
+    orig = getattr(error, "orig", None)
+    pgcode = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    if pgcode in CONFLICT_PGCODES:
+        return True
+    # another request under the same idempotency key committed first; on a
+    # retry this one is answered from its record
+    message = str(orig)
+    return (
+        isinstance(error, IntegrityError)
+        and "idempotency_keys" in message
+        and (pgcode == UNIQUE_VIOLATION or "UNIQUE constraint failed" in message)
+    )
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    idempotency_keys: idempotency.AbstractIdempotencyStore
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -16,13 +48,14 @@ class AbstractUnitOfWork(abc.ABC):
     def __exit__(self, *args):
         self.rollback()
 
+    @instrumentation.timed("commit")
     def commit(self):
         self._commit()
 
     def collect_new_events(self):
         for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+            new_events, product.events = product.events, []
+            yield from new_events
 
     @abc.abstractmethod
     def _commit(self):
@@ -33,29 +66,163 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
-)
-
-
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
-        self.session_factory = session_factory
+    def __init__(
+            self,
+            session_factory=None,
+            load_strategy=repository.SELECTIN,
+            cache: ProductCache = None,
+            profiler: profiling.QueryProfiler = None,
+            use_outbox: bool = None,
+    ):
+        self.session_factory = session_factory or database.get_session_factory()
+        self.load_strategy = load_strategy
+        self.cache = cache
+        self.profiler = profiler
+        if use_outbox is None:
+            use_outbox = config.get_outbox_enabled()
+        self.use_outbox = use_outbox
+        # products committed in earlier sessions whose events are not yet
+        # collected, since each `with uow` starts a new repository
+        self._committed = set()
+        # how many of each product's events are already in the outbox
+        self._outboxed = {}
+        # events of products already back in the cache
+        self._cached_events = []
 
     def __enter__(self):
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        self.products = repository.SqlAlchemyRepository(
+            self.session, load_strategy=self.load_strategy, cache=self.cache
+        )
+        self.idempotency_keys = idempotency.SqlAlchemyIdempotencyStore(self.session)
+        self.outbox = outbox.SqlAlchemyOutbox(self.session)
+        self._to_cache = {}
+        self._profiling = None
+        if self.profiler is not None:
+            self._profiling = (self.profiler, self.profiler.start(self.session))
+        if self.cache is not None:
+            # committed aggregates must stay loaded to be cached
+            self.session.expire_on_commit = False
         return super().__enter__()
 
     def __exit__(self, *args):
+        if self.cache is not None:
+            self._return_to_cache(failed=args[0] is not None)
         super().__exit__(*args)
         self.session.close()
+        if self._profiling is not None:
+            profiler, profile = self._profiling
+            profiler.finish(profile)
+
+    def collect_new_events(self):
+        cached_events, self._cached_events = self._cached_events, []
+        yield from cached_events
+        self._committed.update(self.products.seen)
+        products, self._committed = self._committed, set()
+        for product in products:
+            self._outboxed.pop(product, None)
+            new_events, product.events = product.events, []
+            yield from new_events
 
     def _commit(self):
-        self.session.commit()
+        products = {product.sku: product for product in self.products.seen}
+        if self.use_outbox:
+            for product in self.products.seen:
+                self.outbox.add(product.events[self._outboxed.get(product, 0):])
+        try:
+            # the product's UPDATE, and its version check, before the new
+            # idempotency records
+            self.session.flush()
+            self.idempotency_keys.flush()
+            self.session.commit()
+        except (StaleDataError, DBAPIError) as e:
+            self._invalidate(products)
+            if not is_conflict(e):
+                raise
+            raise ConcurrencyError(str(e), products) from e
+        if self.use_outbox:
+            for product in self.products.seen:
+                self._outboxed[product] = len(product.events)
+        self._committed.update(self.products.seen)
+        self._to_cache.update(products)
+
+    def _return_to_cache(self, failed):
+        products = dict(self._to_cache)
+        taken = {product.sku: product for product in self.products.from_cache}
+        session = self.session
+        if failed or session.new or session.dirty or session.deleted:
+            self._invalidate(products.keys() | taken.keys())
+            return
+        products.update(taken)
+        # detached before the rollback, which would expire them
+        session.expunge_all()
+        for sku, product in products.items():
+            if not is_cacheable(product):
+                self.cache.invalidate(sku)
+                continue
+            # its events stay here, not with the next session to take it
+            self._cached_events.extend(product.events)
+            product.events = []
+            self._committed.discard(product)
+            self._outboxed.pop(product, None)
+            self.products.seen.discard(product)
+            self.cache.put(product)
+
+    def _invalidate(self, skus):
+        if self.cache is not None:
+            for sku in skus:
+                self.cache.invalidate(sku)
 
     def rollback(self):
         self.session.rollback()
+
+
+class AsyncSqlAlchemyUnitOfWork:
+    def __init__(
+            self, session_factory=None, profiler: profiling.QueryProfiler = None
+    ):
+        self.session_factory = session_factory or database.get_async_session_factory()
+        self.profiler = profiler
+        self._committed = set()
+
+    async def __aenter__(self):
+        self.session = self.session_factory()
+        self.products = repository.AsyncSqlAlchemyRepository(self.session)
+        self.idempotency_keys = idempotency.AsyncSqlAlchemyIdempotencyStore(
+            self.session
+        )
+        self._profiling = None
+        if self.profiler is not None:
+            self._profiling = (self.profiler, self.profiler.start(self.session))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+        await self.session.close()
+        if self._profiling is not None:
+            profiler, profile = self._profiling
+            profiler.finish(profile)
+
+    @instrumentation.timed_async("commit")
+    async def commit(self):
+        skus = {product.sku for product in self.products.seen}
+        try:
+            await self.session.flush()
+            await self.idempotency_keys.flush()
+            await self.session.commit()
+        except (StaleDataError, DBAPIError) as e:
+            if not is_conflict(e):
+                raise
+            raise ConcurrencyError(str(e), skus) from e
+        self._committed.update(self.products.seen)
+
+    async def rollback(self):
+        await self.session.rollback()
+
+    def collect_new_events(self):
+        self._committed.update(self.products.seen)
+        products, self._committed = self._committed, set()
+        for product in products:
+            new_events, product.events = product.events, []
+            yield from new_events
@@ -0,0 +1,36 @@
+from allocation.service_layer import unit_of_work
+
+
+def allocations(order_id: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    with uow:
+        results = list(
+            uow.session.execute(
+                "SELECT sku, qty, batch_ref FROM allocations_view"
+                " WHERE order_id = :order_id ORDER BY sku",
+                dict(order_id=order_id),
+            )
+        )
+    return [dict(r) for r in results]
+
+
+def stock(sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    with uow:
+        results = list(
+            uow.session.execute(
+                "SELECT b.reference AS batch_ref, b.eta,"
+                " b._purchased_quantity AS purchased,"
+                " COALESCE(SUM(v.qty), 0) AS allocated,"
+                " COUNT(v.id) AS lines"
+                " FROM batches AS b"
+                " LEFT JOIN allocations_view AS v"
+                " ON v.batch_ref = b.reference AND v.sku = b.sku"
+                " WHERE b.sku = :sku"
+                " GROUP BY b.reference, b.eta, b._purchased_quantity"
+                " ORDER BY b.eta IS NOT NULL, b.eta, b.reference",
+                dict(sku=sku),
+            )
+        )
+    return [
+        dict(r, eta=r.eta and str(r.eta), available=r.purchased - r.allocated)
+        for r in results
+    ]
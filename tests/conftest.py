@@ -1,3 +1,5 @@
+import socketserver
+import threading
 import time
 from pathlib import Path
 
@@ -8,6 +10,7 @@ from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker, clear_mappers
 
 from allocation import config
+from allocation.adapters import migrations
 from allocation.adapters.orm import metadata, start_mappers
 
 
@@ -57,7 +60,7 @@ def wait_for_webapp_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri())
     wait_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    migrations.migrate(engine)
     return engine
 
 
@@ -107,6 +110,12 @@ def add_stock(postgres_session):
         postgres_session.execute(
             "DELETE FROM order_lines WHERE sku=:sku", dict(sku=sku),
         )
+        postgres_session.execute(
+            "DELETE FROM allocations_view WHERE sku=:sku", dict(sku=sku),
+        )
+        postgres_session.execute(
+            "DELETE FROM idempotency_keys WHERE sku=:sku", dict(sku=sku),
+        )
     postgres_session.commit()
 
 
@@ -116,3 +125,60 @@ def restart_api():
     time.sleep(0.5)
     wait_for_webapp_to_come_up()
 
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):
+    # just enough SMTP for smtplib.sendmail, remembering what it was sent
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), SmtpHandler)
+        self.host, self.port = self.server_address
+        self.connections = 0
+        self.messages = []
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost stand-in")
+        envelope = {}
+        while True:
+            line = self.rfile.readline().decode()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ("HELO", "EHLO", "NOOP", "RSET"):
+                self.reply("250 OK")
+            elif command == "MAIL":
+                envelope = dict(to=[], sender=line.split(":", 1)[1].strip())
+                self.reply("250 OK")
+            elif command == "RCPT":
+                envelope["to"].append(line.split(":", 1)[1].strip().strip("<>"))
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 end with .")
+                body = []
+                for data in iter(self.rfile.readline, b".\r\n"):
+                    body.append(data.decode())
+                envelope["body"] = "".join(body)
+                self.server.messages.append(envelope)
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+
+@pytest.fixture
+def smtp_server():
+    server = SmtpStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
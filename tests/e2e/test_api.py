@@ -47,3 +47,108 @@ def test_unhappy_path_returns_400_and_error_message():
     r = requests.post(f"{url}/allocate", json=data)
     assert r.status_code == 400
     assert r.json()["message"] == f"Invalid sku {unknown_sku}"
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocation_returns_a_result_per_line(add_stock):
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    add_stock([(batch, sku, 10, None)])
+    order_id = random_orderid()
+    data = {
+        "lines": [
+            {"order_id": order_id, "sku": sku, "qty": 6},
+            {"order_id": order_id, "sku": unknown_sku, "qty": 1},
+            {"order_id": order_id, "sku": sku, "qty": 6},
+        ]
+    }
+    url = config.get_api_url()
+
+    r = requests.post(f"{url}/allocate-bulk", json=data)
+
+    assert r.status_code == 200
+    assert [(l["status"], l["batch_ref"]) for l in r.json()["results"]] == [
+        ("allocated", batch),
+        ("invalid_sku", None),
+        ("out_of_stock", None),
+    ]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_allocations_can_be_looked_up_by_order(add_stock):
+    sku, batch, order_id = random_sku(), random_batchref(), random_orderid()
+    add_stock([(batch, sku, 10, None)])
+    url = config.get_api_url()
+    requests.post(
+        f"{url}/allocate", json={"order_id": order_id, "sku": sku, "qty": 3}
+    )
+
+    r = requests.get(f"{url}/allocations/{order_id}")
+
+    assert r.status_code == 200
+    assert r.json() == [{"sku": sku, "qty": 3, "batch_ref": batch}]
+    assert requests.get(f"{url}/allocations/{random_orderid()}").status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_retried_allocate_requests_get_the_same_answer(add_stock):
+    sku, batch, order_id = random_sku(), random_batchref(), random_orderid()
+    add_stock([(batch, sku, 10, None)])
+    url = config.get_api_url()
+    data = {"order_id": order_id, "sku": sku, "qty": 6}
+    headers = {"Idempotency-Key": order_id}
+
+    first = requests.post(f"{url}/allocate", json=data, headers=headers)
+    retried = requests.post(f"{url}/allocate", json=data, headers=headers)
+    reused = requests.post(
+        f"{url}/allocate", json={**data, "qty": 1}, headers=headers
+    )
+
+    assert first.status_code == retried.status_code == 201
+    assert first.json() == retried.json() == {"batch_ref": batch}
+    assert reused.status_code == 422
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_deallocating_and_cancelling_orders(add_stock):
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    order_id = random_orderid()
+    add_stock([(batch, sku, 10, None), (otherbatch, othersku, 10, None)])
+    url = config.get_api_url()
+    for line_sku in (sku, othersku):
+        data = {"order_id": order_id, "sku": line_sku, "qty": 4}
+        assert requests.post(f"{url}/allocate", json=data).status_code == 201
+
+    deallocated = requests.post(
+        f"{url}/deallocate", json={"order_id": order_id, "sku": sku}
+    )
+    cancelled = requests.post(f"{url}/cancel-order", json={"order_id": order_id})
+
+    assert deallocated.status_code == 200
+    assert deallocated.json() == {"batch_refs": [batch]}
+    assert cancelled.status_code == 200
+    assert cancelled.json() == {"released": {othersku: [otherbatch]}}
+    assert requests.get(f"{url}/allocations/{order_id}").status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_are_served_in_prometheus_format(add_stock):
+    sku, batch, order_id = random_sku(), random_batchref(), random_orderid()
+    add_stock([(batch, sku, 10, None)])
+    url = config.get_api_url()
+    requests.post(
+        f"{url}/allocate", json={"order_id": order_id, "sku": sku, "qty": 3}
+    )
+
+    r = requests.get(f"{url}/metrics")
+
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'handler="allocate"' in r.text
+    assert "allocation_db_pool_checked_out" in r.text
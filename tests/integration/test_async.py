@@ -0,0 +1,212 @@
+import asyncio
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import events, model
+from allocation.entry_points.asgi_app import create_app
+from allocation.service_layer import message_bus, unit_of_work
+from allocation.service_layer.handlers import InvalidSku
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+
+@pytest.fixture
+def sqlite_file(tmp_path):
+    path = tmp_path / "allocation.db"
+    metadata.create_all(create_engine(f"sqlite:///{path}"))
+    start_mappers()
+    yield path
+    clear_mappers()
+
+
+@pytest.fixture
+def async_session_factory(sqlite_file):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{sqlite_file}")
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def sync_session(sqlite_file):
+    return sessionmaker(bind=create_engine(f"sqlite:///{sqlite_file}"))()
+
+
+def make_uow(async_session_factory):
+    return unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+
+
+def test_allocations_are_committed_and_reach_the_read_model(
+        async_session_factory, sync_session
+):
+    sku, batch_ref, order_id = random_sku(), random_batchref(), random_orderid()
+
+    async def scenario():
+        uow = make_uow(async_session_factory)
+        await message_bus.handle_async(
+            events.BatchCreated(batch_ref, sku, 100, date.today()), uow
+        )
+        return await message_bus.handle_async(
+            events.AllocationRequired(order_id, sku, 10), uow
+        )
+
+    results = asyncio.run(scenario())
+
+    assert results[0] == batch_ref
+    assert list(sync_session.execute(
+        "SELECT order_id, sku, qty, batch_ref FROM allocations_view"
+    )) == [(order_id, sku, 10, batch_ref)]
+
+
+def test_invalid_sku_is_reported(async_session_factory):
+    async def scenario():
+        await message_bus.handle_async(
+            events.AllocationRequired(random_orderid(), "NOPE", 10),
+            make_uow(async_session_factory),
+        )
+
+    with pytest.raises(InvalidSku, match="Invalid sku NOPE"):
+        asyncio.run(scenario())
+
+
+def test_commit_fails_if_the_product_version_moved_on(
+        async_session_factory, sync_session
+):
+    sku = random_sku()
+    sync_session.execute(
+        "INSERT INTO products (sku, version_number) VALUES (:sku, 1)", dict(sku=sku)
+    )
+    sync_session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('batch1', :sku, 100, NULL)",
+        dict(sku=sku),
+    )
+    sync_session.commit()
+
+    async def scenario():
+        uow = make_uow(async_session_factory)
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            sync_session.execute(
+                "UPDATE products SET version_number = 2 WHERE sku = :sku",
+                dict(sku=sku),
+            )
+            sync_session.commit()
+            product.allocate(model.OrderLine("o1", sku, 10))
+            await uow.commit()
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        asyncio.run(scenario())
+
+
+def test_concurrent_requests_on_one_sku_are_all_allocated(
+        async_session_factory, sync_session
+):
+    sku, batch_ref = random_sku(), random_batchref()
+    order_ids = [random_orderid(str(i)) for i in range(10)]
+
+    async def scenario():
+        await message_bus.handle_async(
+            events.BatchCreated(batch_ref, sku, 100, None),
+            make_uow(async_session_factory),
+        )
+        await asyncio.gather(*[
+            message_bus.handle_async(
+                events.AllocationRequired(order_id, sku, 1),
+                make_uow(async_session_factory),
+            )
+            for order_id in order_ids
+        ])
+
+    asyncio.run(scenario())
+
+    [[allocated]] = sync_session.execute(
+        "SELECT count(*) FROM allocations_view WHERE sku = :sku", dict(sku=sku)
+    )
+    assert allocated == len(order_ids)
+
+
+def test_retried_allocations_are_answered_from_their_idempotency_key(
+        async_session_factory, sync_session
+):
+    sku, batch_ref = random_sku(), random_batchref()
+    event = events.AllocationRequired(random_orderid(), sku, 10, "client-key")
+
+    async def scenario():
+        await message_bus.handle_async(
+            events.BatchCreated(batch_ref, sku, 100, None),
+            make_uow(async_session_factory),
+        )
+        first = await message_bus.handle_async(
+            event, make_uow(async_session_factory)
+        )
+        retried = await message_bus.handle_async(
+            event, make_uow(async_session_factory)
+        )
+        return first, retried
+
+    first, retried = asyncio.run(scenario())
+
+    assert first[0] == retried[0] == batch_ref
+    assert retried == [batch_ref]  # and no second Allocated event
+    [[allocated]] = sync_session.execute("SELECT count(*) FROM allocations_view")
+    assert allocated == 1
+
+
+async def call(app, method, path, body=None, headers=()):
+    messages = [{"type": "http.request", "body": json.dumps(body).encode()}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+    await app(scope, receive, send)
+    start, response = sent
+    return start["status"], response["body"]
+
+
+def test_asgi_app_serves_add_batch_and_allocate(async_session_factory):
+    sku, batch_ref, order_id = random_sku(), random_batchref(), random_orderid()
+    app = create_app(lambda: make_uow(async_session_factory))
+
+    async def scenario():
+        added = await call(
+            app, "POST", "/add-batch",
+            dict(ref=batch_ref, sku=sku, qty=100, eta="2011-01-02"),
+        )
+        allocated = await call(
+            app, "POST", "/allocate", dict(order_id=order_id, sku=sku, qty=3),
+            headers=[(b"idempotency-key", order_id.encode())],
+        )
+        retried = await call(
+            app, "POST", "/allocate", dict(order_id=order_id, sku=sku, qty=3),
+            headers=[(b"idempotency-key", order_id.encode())],
+        )
+        reused = await call(
+            app, "POST", "/allocate", dict(order_id=order_id, sku=sku, qty=4),
+            headers=[(b"idempotency-key", order_id.encode())],
+        )
+        invalid = await call(
+            app, "POST", "/allocate", dict(order_id=order_id, sku="NOPE", qty=3)
+        )
+        missing = await call(app, "GET", "/nowhere")
+        return added, allocated, retried, reused, invalid, missing
+
+    added, allocated, retried, reused, invalid, missing = asyncio.run(scenario())
+
+    assert added == (201, b"OK")
+    assert allocated[0] == 201
+    assert json.loads(allocated[1]) == {"batch_ref": batch_ref}
+    assert retried == allocated
+    assert reused[0] == 422
+    assert invalid[0] == 400
+    assert json.loads(invalid[1]) == {"message": "Invalid sku NOPE"}
+    assert missing[0] == 404
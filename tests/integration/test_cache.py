@@ -0,0 +1,124 @@
+from allocation.adapters import cache
+from allocation.domain import events, model
+from allocation.service_layer import message_bus, unit_of_work
+
+
+def test_committed_products_are_served_from_the_cache(session_factory):
+    product_cache = cache.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 100, None), uow)
+    message_bus.handle(events.AllocationRequired("o1", "LEAFY-PLANT", 10), uow)
+    assert len(product_cache) == 1
+
+    [batch_ref] = message_bus.handle(
+        events.AllocationRequired("o2", "LEAFY-PLANT", 10), uow
+    )[:1]
+
+    assert batch_ref == "b1"
+    assert product_cache.stats.hits == 2
+    assert product_cache.stats.misses == 1
+    with uow:
+        [batch] = uow.products.get("LEAFY-PLANT").batches
+        assert batch.available_quantity == 80
+
+
+def test_a_stale_product_is_never_used_to_allocate(session_factory):
+    product_cache = cache.ProductCache()
+    cached_uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, cache=product_cache
+    )
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 10, None), cached_uow)
+    message_bus.handle(events.AllocationRequired("o1", "LEAFY-PLANT", 5), cached_uow)
+
+    # another process takes the rest of the stock behind the cache's back
+    message_bus.handle(events.AllocationRequired("o2", "LEAFY-PLANT", 5), other_uow)
+    hits = product_cache.stats.hits
+    [batch_ref] = message_bus.handle(
+        events.AllocationRequired("o3", "LEAFY-PLANT", 5), cached_uow
+    )[:1]
+
+    assert batch_ref is None
+    assert product_cache.stats.stale == 1
+    assert product_cache.stats.hits == hits
+
+
+def test_products_are_evicted_beyond_the_caps(session_factory):
+    product_cache = cache.ProductCache(max_products=2, max_lines=3)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    for sku in ["SKU1", "SKU2", "SKU3"]:
+        message_bus.handle(events.BatchCreated(f"{sku}-b", sku, 100, None), uow)
+        message_bus.handle(events.AllocationRequired("o1", sku, 1), uow)
+    assert len(product_cache) == 2
+    assert "SKU1" not in product_cache
+
+    message_bus.handle(events.AllocationRequired("o2", "SKU3", 1), uow)
+    message_bus.handle(events.AllocationRequired("o3", "SKU3", 1), uow)
+    assert product_cache.lines <= 3
+    assert "SKU2" not in product_cache
+
+
+def test_products_loaded_to_deallocate_an_order_are_not_cached(session_factory):
+    product_cache = cache.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 100, None), uow)
+    message_bus.handle(events.AllocationRequired("o1", "LEAFY-PLANT", 10), uow)
+    message_bus.handle(events.AllocationRequired("o2", "LEAFY-PLANT", 10), uow)
+    product_cache.invalidate("LEAFY-PLANT")
+
+    message_bus.handle(events.DeallocationRequired("o1", "LEAFY-PLANT"), uow)
+
+    assert "LEAFY-PLANT" not in product_cache
+    with uow:
+        [batch] = uow.products.get("LEAFY-PLANT").batches
+        assert batch.available_quantity == 90
+
+
+def test_a_hit_lends_out_the_cached_product_itself(session_factory):
+    product_cache = cache.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 100, None), uow)
+    with uow:
+        product = uow.products.get("LEAFY-PLANT")
+        assert "LEAFY-PLANT" not in product_cache
+        with unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, cache=product_cache
+        ) as other_uow:
+            assert other_uow.products.get("LEAFY-PLANT") is not product
+
+    assert "LEAFY-PLANT" in product_cache
+    with uow:
+        assert uow.products.get("LEAFY-PLANT") is product
+
+
+def test_a_product_left_with_uncommitted_changes_is_not_put_back(session_factory):
+    product_cache = cache.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 100, None), uow)
+    with uow:
+        product = uow.products.get("LEAFY-PLANT")
+        product.allocate(model.OrderLine("o1", "LEAFY-PLANT", 10))
+
+    assert "LEAFY-PLANT" not in product_cache
+    with uow:
+        [batch] = uow.products.get("LEAFY-PLANT").batches
+        assert batch.available_quantity == 100
+
+
+def test_events_of_a_product_put_back_stay_with_its_unit_of_work(session_factory):
+    product_cache = cache.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache=product_cache)
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, cache=product_cache
+    )
+    message_bus.handle(events.BatchCreated("b1", "LEAFY-PLANT", 100, None), uow)
+    with uow:
+        product = uow.products.get("LEAFY-PLANT")
+        product.allocate(model.OrderLine("o1", "LEAFY-PLANT", 10))
+        uow.commit()
+    with other_uow:
+        assert other_uow.products.get("LEAFY-PLANT") is product
+
+    assert list(other_uow.collect_new_events()) == []
+    [allocated] = uow.collect_new_events()
+    assert allocated.order_id == "o1"
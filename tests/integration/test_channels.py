@@ -0,0 +1,218 @@
+import multiprocessing
+import threading
+import time
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import serialization, transports
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import events
+from allocation.service_layer import channels, message_bus, unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+
+class FakeTransport(transports.AbstractTransport):
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(frame)
+
+    def serve(self, on_frame, stop):
+        stop.wait()
+
+    def sent(self):
+        return [event for frame in self.frames for event in transports.decode(frame)]
+
+
+class Received:
+    def __init__(self):
+        self.batches = []
+        self._condition = threading.Condition()
+
+    def __call__(self, batch):
+        with self._condition:
+            self.batches.append(batch)
+            self._condition.notify_all()
+
+    def wait_for(self, count, timeout=10):
+        with self._condition:
+            assert self._condition.wait_for(
+                lambda: sum(len(b) for b in self.batches) >= count, timeout
+            )
+        return [event for batch in self.batches for event in batch]
+
+
+@pytest.fixture
+def fake_channel():
+    transport = FakeTransport()
+    channel = channels.start(transport, [events.AllocationRequired, events.Allocated])
+    yield channel, transport
+    channels.stop()
+
+
+@pytest.fixture
+def file_session_factory(tmp_path):
+    # the subscriber handles events on its own thread, which an in-memory
+    # database would give a connection of its own, with no tables
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def wait_for_socket(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        assert time.monotonic() < deadline, f"nothing listening on {path}"
+        time.sleep(0.01)
+
+
+def test_events_round_trip_through_the_compact_rows():
+    batch = [
+        events.BatchCreated("b1", "RED-CHAIR", 10, date(2011, 1, 2)),
+        events.Allocated("o1", "RED-CHAIR", 2, "b1"),
+        events.BatchRebalanced("b1", "RED-CHAIR", {"o1": "b2"}, ["o2"]),
+    ]
+
+    frame = transports.encode(batch)
+
+    assert transports.decode(frame) == batch
+    assert len(frame) < len(str([serialization.to_dict(e) for e in batch]))
+
+
+def test_the_bus_publishes_what_it_handled_and_the_events_that_raised(
+        session_factory, fake_channel
+):
+    channel, transport = fake_channel
+    sku, order_id = random_sku(), random_orderid()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated(random_batchref(), sku, 10), uow)
+    message_bus.handle(events.AllocationRequired(order_id, sku, 1), uow)
+
+    channel.flush()
+
+    assert [type(e) for e in transport.sent()] == [
+        events.AllocationRequired, events.Allocated
+    ]
+
+
+def test_the_bus_does_not_send_events_back_out_on_the_channel_they_came_from(
+        session_factory, fake_channel
+):
+    channel, transport = fake_channel
+    sku = random_sku()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated(random_batchref(), sku, 10), uow)
+
+    message_bus.handle_all(
+        [events.AllocationRequired(random_orderid(), sku, 1)], uow, from_channel=True
+    )
+    channel.flush()
+
+    assert [type(e) for e in transport.sent()] == [events.Allocated]
+
+
+def test_events_queued_while_sending_go_out_together():
+    transport = FakeTransport()
+    sending = threading.Event()
+    release = threading.Event()
+    send = transport.send
+
+    def slow_send(frame):
+        sending.set()
+        release.wait()
+        send(frame)
+
+    transport.send = slow_send
+    channel = channels.EventChannel(transport, [events.OutOfStock], max_batch=3)
+    channel.publish([events.OutOfStock("SKU-0")])
+    sending.wait()
+    channel.publish([events.OutOfStock(f"SKU-{i}") for i in range(1, 6)])
+    release.set()
+    channel.close()
+
+    assert [len(transports.decode(f)) for f in transport.frames] == [1, 3, 2]
+    assert (channel.stats.published, channel.stats.batches) == (6, 3)
+
+
+def test_unix_sockets_fan_events_out_to_every_peer(tmp_path):
+    paths = [tmp_path / "replica-1.sock", tmp_path / "replica-2.sock"]
+    received = [Received(), Received()]
+    subscribers = [
+        channels.Subscriber(
+            transports.UnixSocketTransport(str(path)), [events.OutOfStock], handle
+        )
+        for path, handle in zip(paths, received)
+    ]
+    for path in paths:
+        wait_for_socket(path)
+    channel = channels.EventChannel(
+        transports.UnixSocketTransport(peers=[str(p) for p in paths]),
+        [events.OutOfStock, events.Allocated],
+    )
+
+    channel.publish(
+        [events.OutOfStock("LAMP"), events.Allocated("o", "LAMP", 1, "b")]
+    )
+    channel.publish([events.OutOfStock("CHAIR")])
+    channel.close()
+
+    for handle in received:
+        # the subscribers only take the event types they asked for
+        assert handle.wait_for(2) == [
+            events.OutOfStock("LAMP"), events.OutOfStock("CHAIR")
+        ]
+    for subscriber in subscribers:
+        subscriber.close()
+    assert not any(path.exists() for path in paths)
+
+
+def test_a_peer_that_is_down_misses_events_without_failing_the_sender(tmp_path):
+    transport = transports.UnixSocketTransport(peers=[str(tmp_path / "gone.sock")])
+    channel = channels.EventChannel(transport, [events.OutOfStock])
+
+    channel.publish([events.OutOfStock("LAMP")])
+    channel.close()
+
+    assert (channel.stats.batches, channel.stats.failed) == (1, 0)
+
+
+def publish_from_another_process(frames, sku, batch_ref):
+    channel = channels.EventChannel(
+        transports.QueueTransport(frames), [events.BatchCreated]
+    )
+    channel.publish([events.BatchCreated(batch_ref, sku, 100)])
+    channel.close()
+
+
+def test_events_from_another_process_are_handled_by_the_message_bus(
+        file_session_factory
+):
+    sku, batch_ref = random_sku(), random_batchref()
+    context = multiprocessing.get_context("spawn")
+    frames = context.Queue()
+    received = Received()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(file_session_factory)
+
+    def handle(batch):
+        message_bus.handle_all(batch, uow, from_channel=True)
+        received(batch)
+
+    subscriber = channels.Subscriber(
+        transports.QueueTransport(frames), [events.BatchCreated], handle
+    )
+    publisher = context.Process(
+        target=publish_from_another_process, args=(frames, sku, batch_ref)
+    )
+    publisher.start()
+    publisher.join(timeout=60)
+    received.wait_for(1)
+    subscriber.close()
+
+    with uow:
+        assert uow.products.get(sku).batches[0].reference == batch_ref
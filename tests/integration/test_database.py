@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from allocation.adapters import database
+
+
+@pytest.fixture
+def tiny_pool(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "1")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.5")
+
+
+def test_engines_take_their_pool_settings_from_config(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "2")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "60")
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+
+    assert isinstance(engine.pool, database.TimedQueuePool)
+    assert engine.pool.size() == 3
+    assert engine.pool._max_overflow == 2
+    assert engine.pool._recycle == 60
+    assert engine.pool._pre_ping
+
+
+def test_pool_stats_report_checked_out_connections(tmp_path):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+    with engine.connect():
+        stats = database.pool_stats(engine)
+
+    assert stats["checked_out"] == 1
+    assert stats["checkouts"] == 1
+    assert database.pool_stats(engine)["checked_out"] == 0
+
+
+def test_pool_stats_record_time_spent_waiting_for_a_connection(tmp_path, tiny_pool):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+    held = engine.connect()
+    threading.Timer(0.2, held.close).start()
+
+    with engine.connect():
+        pass
+
+    stats = database.pool_stats(engine)
+    assert stats["checkouts"] == 2
+    assert stats["max_wait_seconds"] >= 0.15
+    assert stats["timeouts"] == 0
+
+
+def test_pool_stats_count_checkout_timeouts(tmp_path, tiny_pool):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+    with engine.connect():
+        with pytest.raises(PoolTimeout):
+            engine.connect()
+
+    assert database.pool_stats(engine)["timeouts"] == 1
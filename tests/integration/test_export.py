@@ -0,0 +1,93 @@
+import csv
+import io
+from datetime import date
+
+import pyarrow.parquet as parquet
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import migrations
+from allocation.adapters.orm import start_mappers
+from allocation.domain import events
+from allocation.entry_points import export
+from allocation.service_layer import message_bus, unit_of_work
+
+today = date.today()
+
+
+class ChunkRecorder:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    # the export entry point makes its own engine, so it needs a file
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    engine = create_engine(uri)
+    migrations.migrate(engine)
+    start_mappers()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    for event in [
+        events.BatchCreated("b1", "LAMP", 10, None),
+        events.BatchCreated("b2", "LAMP", 10, today),
+        events.BatchCreated("b3", "CHAIR", 5, None),
+        events.AllocationRequired("o1", "LAMP", 6),
+        events.AllocationRequired("o2", "LAMP", 6),
+        events.AllocationRequired("o3", "LAMP", 3),
+    ]:
+        message_bus.handle(event, uow)
+    clear_mappers()
+    yield uri
+
+
+EXPECTED = [
+    ("b1", "LAMP", None, 10, "o1", 6),
+    ("b1", "LAMP", None, 10, "o3", 3),
+    ("b2", "LAMP", today, 10, "o2", 6),
+    ("b3", "CHAIR", None, 5, None, None),
+]
+
+
+def test_streams_batches_and_their_lines_in_chunks(db_uri):
+    recorder = ChunkRecorder()
+
+    rows = export.export(create_engine(db_uri), recorder, chunk_size=3)
+
+    assert rows == 4
+    assert [len(chunk) for chunk in recorder.chunks] == [3, 1]
+    assert [row for chunk in recorder.chunks for row in chunk] == EXPECTED
+
+
+def test_cli_writes_csv(db_uri, tmp_path):
+    path = tmp_path / "allocations.csv"
+    stdout = io.StringIO()
+
+    export.main([str(path), "--db-uri", db_uri, "--chunk-size", "2"], stdout=stdout)
+
+    with open(path, newline="") as f:
+        exported = list(csv.reader(f))
+    assert exported[0] == export.COLUMNS
+    assert exported[1:] == [
+        ["" if value is None else str(value) for value in row] for row in EXPECTED
+    ]
+    assert stdout.getvalue() == "exported 4 rows\n"
+
+
+def test_cli_writes_parquet_a_row_group_per_chunk(db_uri, tmp_path):
+    path = tmp_path / "allocations.parquet"
+
+    export.main(
+        [str(path), "--format", "parquet", "--db-uri", db_uri, "--chunk-size", "2"],
+        stdout=io.StringIO(),
+    )
+
+    exported = parquet.ParquetFile(path)
+    assert exported.metadata.num_row_groups == 2
+    assert exported.read().to_pylist() == [
+        dict(zip(export.COLUMNS, row)) for row in EXPECTED
+    ]
@@ -0,0 +1,193 @@
+import io
+
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from allocation.adapters import idempotency, migrations, repository
+from allocation.adapters.orm import metadata
+from allocation.domain import model
+from allocation.entry_points import migrate
+from ..random_refs import random_sku, random_orderid
+
+LEGACY_INDEXES = [
+    "ux_batches_reference",
+    "ix_batches_sku",
+    "ix_order_lines_order_id",
+    "ix_allocations_orderline_id",
+    "ix_allocations_batch_line",
+    "ix_idempotency_keys_order_line",
+]
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    return f"sqlite:///{tmp_path / 'allocation.db'}"
+
+
+def make_legacy_schema(engine):
+    # the tables as metadata.create_all used to make them, before migrations
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for index in LEGACY_INDEXES:
+            connection.execute(text(f"DROP INDEX {index}"))
+        connection.execute(
+            text("CREATE INDEX ix_allocations_batch_id ON allocations (batch_id)")
+        )
+        connection.execute(text("DROP TABLE schema_version"))
+
+
+def index_names(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def schema_version(engine):
+    with engine.connect() as connection:
+        return migrations.current_version(connection)
+
+
+def test_a_new_database_is_created_at_the_latest_version(db_uri):
+    engine = create_engine(db_uri)
+
+    assert migrations.migrate(engine) == []
+
+    assert schema_version(engine) == migrations.HEAD
+    assert "ux_batches_reference" in index_names(engine, "batches")
+    assert migrations.migrate(engine) == []
+
+
+def test_an_existing_database_gets_the_pending_migrations(db_uri):
+    engine = create_engine(db_uri)
+    make_legacy_schema(engine)
+
+    applied = migrations.migrate(engine)
+
+    assert applied == migrations.MIGRATIONS
+    assert schema_version(engine) == migrations.HEAD
+    assert index_names(engine, "allocations") == {
+        "ix_allocations_orderline_id", "ix_allocations_batch_line"
+    }
+    assert index_names(engine, "batches") == {
+        "ux_batches_reference", "ix_batches_sku"
+    }
+
+
+def test_a_failed_migration_leaves_the_schema_as_it_was(db_uri):
+    engine = create_engine(db_uri)
+    make_legacy_schema(engine)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO products (sku) VALUES ('LAMP')"))
+        for _ in range(2):
+            connection.execute(text(
+                "INSERT INTO batches (reference, sku, _purchased_quantity)"
+                " VALUES ('twin', 'LAMP', 10)"
+            ))
+
+    with pytest.raises(IntegrityError):
+        migrations.migrate(engine)
+
+    assert schema_version(engine) == 0
+    assert "ix_batches_sku" not in index_names(engine, "batches")
+
+
+def test_migrate_cli_reports_the_version(db_uri):
+    make_legacy_schema(create_engine(db_uri))
+    stdout = io.StringIO()
+
+    migrate.main(["--db-uri", db_uri], stdout=stdout)
+
+    assert stdout.getvalue().splitlines() == [
+        "applied 1: index the hot lookup paths",
+        f"schema at version {migrations.HEAD}",
+    ]
+
+
+def record_statements(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine, "before_cursor_execute", record)
+
+
+@pytest.fixture
+def executed(in_memory_db):
+    yield from record_statements(in_memory_db)
+
+
+@pytest.fixture
+def postgres_executed(postgres_db):
+    yield from record_statements(postgres_db)
+
+
+def query_plans(session, statements):
+    # what the database would do for each statement the code under test ran
+    statements = list(statements)  # explaining them runs statements too
+    connection = session.connection()
+    if connection.dialect.name == "postgresql":
+        # on tables this small a sequential scan would win anyway
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        explain = "EXPLAIN "
+    else:
+        explain = "EXPLAIN QUERY PLAN "
+    plans = []
+    for statement, parameters in statements:
+        rows = connection.exec_driver_sql(explain + statement, parameters).all()
+        plans.append(" ".join(str(value) for row in rows for value in row))
+    return plans
+
+
+def add_product(session, sku, order_id):
+    product = model.Product(sku, batches=[])
+    for b in range(3):
+        batch = model.Batch(f"{sku}-batch{b}", sku, 10, eta=None)
+        batch.allocate(model.OrderLine(order_id, sku, 1))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+    session.close()
+
+
+def check_repository_queries_use_indexes(session, statements):
+    sku, order_id = random_sku(), random_orderid()
+    add_product(session, sku, order_id)
+    repo = repository.SqlAlchemyRepository(
+        session, load_strategy=repository.SELECTIN
+    )
+
+    statements.clear()
+    repo.get(sku)
+    [_, batches, lines] = query_plans(session, statements)
+    assert "ix_batches_sku" in batches
+    assert "ix_allocations_batch_line" in lines
+    session.rollback()
+
+    statements.clear()
+    repo.get_by_batch_ref(f"{sku}-batch1")
+    assert "ux_batches_reference" in query_plans(session, statements)[0]
+    session.rollback()
+
+    statements.clear()
+    assert repo.skus_for_order(order_id) == [sku]
+    [plan] = query_plans(session, statements)
+    assert "ix_order_lines_order_id" in plan
+    assert "ix_allocations_orderline_id" in plan
+    session.rollback()
+
+    statements.clear()
+    idempotency.SqlAlchemyIdempotencyStore(session).remove(order_id, sku)
+    assert "ix_idempotency_keys_order_line" in query_plans(session, statements)[0]
+    session.rollback()
+
+
+def test_repository_queries_use_indexes_on_sqlite(session, executed):
+    check_repository_queries_use_indexes(session, executed)
+
+
+def test_repository_queries_use_indexes_on_postgres(
+        postgres_session, postgres_executed
+):
+    check_repository_queries_use_indexes(postgres_session, postgres_executed)
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+from allocation.adapters.email import SmtpSender
+from allocation.domain import events
+from allocation.service_layer import message_bus, notifications
+from allocation.service_layer.notifications import NotificationDispatcher
+from ..unit.test_handlers import FakeUnitOfWork
+
+
+def test_smtp_sender_reuses_its_connection(smtp_server):
+    sender = SmtpSender(smtp_server.host, smtp_server.port)
+    for sku in ("RED-CHAIR", "BLUE-CHAIR", "GREEN-CHAIR"):
+        sender.send("stock@made.com", f"Out of stock for {sku}")
+    sender.close()
+
+    assert smtp_server.connections == 1
+    assert [m["to"] for m in smtp_server.messages] == [["stock@made.com"]] * 3
+    assert "Out of stock for GREEN-CHAIR" in smtp_server.messages[-1]["body"]
+
+
+def test_smtp_sender_reconnects_after_the_server_hangs_up(smtp_server):
+    sender = SmtpSender(smtp_server.host, smtp_server.port)
+    sender.send("stock@made.com", "first")
+    sender._connection().close()  # as smtplib does when the server goes away
+    sender.send("stock@made.com", "second")
+    sender.close()
+
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 2
+
+
+def test_duplicates_within_the_window_become_one_email(smtp_server):
+    sender = SmtpSender(smtp_server.host, smtp_server.port)
+    dispatcher = NotificationDispatcher(sender.send, workers=2, window=0.2)
+    for _ in range(5):
+        dispatcher.dispatch(
+            "RED-CHAIR", "stock@made.com", "Out of stock for RED-CHAIR"
+        )
+    dispatcher.dispatch("BLUE-CHAIR", "stock@made.com", "Out of stock for BLUE-CHAIR")
+    time.sleep(0.5)
+    dispatcher.close()
+
+    bodies = sorted(m["body"].strip().splitlines()[-1] for m in smtp_server.messages)
+    assert bodies == ["Out of stock for BLUE-CHAIR", "Out of stock for RED-CHAIR"]
+    assert dispatcher.stats.submitted == 6
+    assert dispatcher.stats.coalesced == 4
+    assert dispatcher.stats.sent == 2
+    assert dispatcher.stats.flushed == 0
+
+
+def test_a_key_can_be_sent_again_once_its_window_closed():
+    sent = []
+    dispatcher = NotificationDispatcher(lambda *args: sent.append(args), window=0.05)
+    dispatcher.dispatch("RED-CHAIR", "first")
+    time.sleep(0.2)
+    dispatcher.dispatch("RED-CHAIR", "second")
+    dispatcher.close()
+
+    assert sent == [("first",), ("second",)]
+
+
+def test_full_queue_drops_and_flush_sends_without_waiting():
+    sent = []
+    dispatcher = NotificationDispatcher(
+        lambda *args: sent.append(args), workers=1, max_queue=2, window=60
+    )
+    dispatcher.dispatch("A", "A")
+    time.sleep(0.1)  # the worker holds A until its window closes
+    for sku in ("B", "C", "D"):
+        dispatcher.dispatch(sku, sku)
+    start = time.monotonic()
+    dispatcher.close()
+
+    assert time.monotonic() - start < 5
+    assert dispatcher.stats.dropped == 1
+    assert sorted(sent) == [("A",), ("B",), ("C",)]
+    assert dispatcher.stats.flushed == 3
+    assert dispatcher.depth == 0
+
+
+def test_failed_sends_are_counted_and_do_not_stop_the_workers():
+    sent = []
+
+    def flaky(message):
+        if message == "bad":
+            raise ConnectionRefusedError()
+        sent.append(message)
+
+    dispatcher = NotificationDispatcher(flaky, workers=1, window=0)
+    dispatcher.dispatch("A", "bad")
+    dispatcher.dispatch("B", "good")
+    dispatcher.close()
+
+    assert dispatcher.stats.failed == 1
+    assert sent == ["good"]
+
+
+@pytest.fixture
+def release_emails(smtp_server):
+    sender = SmtpSender(smtp_server.host, smtp_server.port)
+    release = threading.Event()
+
+    def slow_send(*args):
+        release.wait(5)
+        sender.send(*args)
+
+    notifications.start(slow_send, window=0.05)
+    yield release
+    notifications.stop()
+
+
+def test_out_of_stock_emails_do_not_block_the_message_bus(
+        smtp_server, release_emails
+):
+    uow = FakeUnitOfWork()
+    message_bus.handle(events.BatchCreated("b1", "POPULAR-CURTAINS", 9, None), uow)
+    for order_id in ("o1", "o2", "o3"):
+        message_bus.handle(
+            events.AllocationRequired(order_id, "POPULAR-CURTAINS", 10), uow
+        )
+    assert smtp_server.messages == []
+
+    release_emails.set()
+    notifications.DISPATCHER.flush()
+
+    [message] = smtp_server.messages
+    assert "Out of stock for POPULAR-CURTAINS" in message["body"]
+    assert notifications.DISPATCHER.stats.coalesced == 2
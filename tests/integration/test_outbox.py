@@ -0,0 +1,218 @@
+import io
+import json
+import socketserver
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import outbox, serialization
+from allocation.adapters.orm import metadata
+from allocation.domain import events, model
+from allocation.entry_points import relay
+from allocation.service_layer import message_bus, unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+
+def outbox_rows(session_factory):
+    session = session_factory()
+    return [
+        (type_, json.loads(payload))
+        for type_, payload in session.execute(
+            "SELECT type, payload FROM outbox ORDER BY id"
+        )
+    ]
+
+
+def test_nested_events_survive_a_round_trip():
+    event = events.BulkAllocationRequired([
+        events.AllocationRequired("o1", "SKU-1", 10),
+        events.AllocationRequired("o2", "SKU-2", 5, "key-2"),
+    ])
+
+    payload = json.loads(json.dumps(serialization.to_dict(event)))
+
+    assert serialization.from_dict(payload) == event
+
+
+def add_batch_and_allocate(uow, sku, *order_ids, qty=10):
+    message_bus.handle(events.BatchCreated(random_batchref(), sku, 15, None), uow)
+    for order_id in order_ids:
+        message_bus.handle(events.AllocationRequired(order_id, sku, qty), uow)
+
+
+class ListSink(outbox.AbstractSink):
+    def __init__(self):
+        self.batches = []
+
+    def publish(self, messages):
+        self.batches.append(messages)
+
+
+class FailingSink(outbox.AbstractSink):
+    def publish(self, messages):
+        raise ConnectionError("broker down")
+
+
+def test_committed_events_are_written_to_the_outbox(session_factory):
+    sku, order_id = random_sku(), random_orderid()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=True)
+
+    add_batch_and_allocate(uow, sku, order_id, random_orderid())
+
+    [(type_, payload), (out_of_stock, _)] = outbox_rows(session_factory)
+    assert type_ == "Allocated"
+    assert serialization.from_dict(payload).order_id == order_id
+    assert out_of_stock == "OutOfStock"
+
+
+def test_nothing_is_written_without_the_outbox(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=False)
+
+    add_batch_and_allocate(uow, random_sku(), random_orderid())
+
+    assert outbox_rows(session_factory) == []
+
+
+def test_events_are_written_once_however_often_a_handler_commits(session_factory):
+    sku = random_sku()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=True)
+    add_batch_and_allocate(uow, sku)
+
+    with uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine("o1", sku, 1))
+        uow.commit()
+        product.allocate(model.OrderLine("o2", sku, 1))
+        uow.commit()
+    list(uow.collect_new_events())
+
+    assert [payload["order_id"] for _, payload in outbox_rows(session_factory)] == [
+        "o1", "o2"
+    ]
+
+
+def test_events_of_a_failed_commit_are_not_written(session_factory):
+    sku = random_sku()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=True)
+    add_batch_and_allocate(uow, sku)
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        with uow:
+            product = uow.products.get(sku)
+            product.allocate(model.OrderLine("o1", sku, 1))
+            session = session_factory()
+            session.execute(
+                "UPDATE products SET version_number = 99 WHERE sku = :sku",
+                dict(sku=sku),
+            )
+            session.commit()
+            uow.commit()
+
+    assert outbox_rows(session_factory) == []
+
+
+def test_relay_publishes_in_batches_oldest_first_and_clears_the_outbox(
+        session_factory
+):
+    sku = random_sku()
+    order_ids = [random_orderid(str(i)) for i in range(5)]
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=True)
+    add_batch_and_allocate(uow, sku, *order_ids, qty=1)
+    sink = ListSink()
+    relay_ = outbox.Relay(session_factory, sink, batch_size=2)
+
+    while relay_.publish_batch():
+        pass
+
+    assert [len(batch) for batch in sink.batches] == [2, 2, 1]
+    published = [json.loads(m) for batch in sink.batches for m in batch]
+    assert [p["order_id"] for p in published] == order_ids
+    assert outbox_rows(session_factory) == []
+    assert (relay_.stats.batches, relay_.stats.published) == (3, 5)
+
+
+def test_relay_keeps_events_the_sink_failed_to_take(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, use_outbox=True)
+    add_batch_and_allocate(uow, random_sku(), random_orderid())
+
+    with pytest.raises(ConnectionError):
+        outbox.Relay(session_factory, FailingSink()).publish_batch()
+
+    assert len(outbox_rows(session_factory)) == 1
+
+
+class LineCollector(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), LineHandler)
+        self.host, self.port = self.server_address
+        self.connections = 0
+        self.lines = []
+        self.received = threading.Condition()
+
+    def wait_for(self, count, timeout=5):
+        with self.received:
+            assert self.received.wait_for(lambda: len(self.lines) >= count, timeout)
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        for line in self.rfile:
+            with self.server.received:
+                self.server.lines.append(json.loads(line))
+                self.server.received.notify_all()
+
+
+@pytest.fixture
+def collector():
+    server = LineCollector()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_socket_sink_sends_lines_and_reconnects(collector):
+    sink = outbox.SocketSink(collector.host, collector.port)
+    sink.publish([json.dumps({"n": 1}), json.dumps({"n": 2})])
+    collector.wait_for(2)
+
+    sink._socket.close()  # as if the consumer had hung up
+    sink.publish([json.dumps({"n": 3})])
+    collector.wait_for(3)
+    sink.close()
+
+    assert [line["n"] for line in collector.lines] == [1, 2, 3]
+    assert collector.connections == 2
+
+
+def test_relay_cli_publishes_everything_to_a_file(tmp_path):
+    db_uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    metadata.create_all(create_engine(db_uri))
+    session_factory = sessionmaker(bind=create_engine(db_uri))
+    session = session_factory()
+    session.execute(
+        "INSERT INTO outbox (type, payload, created_at)"
+        " VALUES ('OutOfStock', :payload, '2011-01-02 00:00:00')",
+        [dict(payload=json.dumps({"type": "OutOfStock", "sku": f"SKU-{i}"}))
+         for i in range(3)],
+    )
+    session.commit()
+    path, stdout = tmp_path / "events.jsonl", io.StringIO()
+
+    relay.main(
+        ["--file", str(path), "--once", "--batch-size", "2", "--db-uri", db_uri],
+        stdout=stdout,
+    )
+
+    lines = path.read_text().splitlines()
+    assert [serialization.from_dict(json.loads(line)) for line in lines] == [
+        events.OutOfStock(f"SKU-{i}") for i in range(3)
+    ]
+    assert "published 3 events in 2 batches" in stdout.getvalue()
+    assert outbox_rows(session_factory) == []
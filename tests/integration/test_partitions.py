@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import create_engine
+
+from allocation.adapters.orm import metadata
+from allocation.domain import events
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.partitions import PartitionedBus, partition_for
+
+
+@pytest.fixture
+def partitioned_bus(tmp_path):
+    db_uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    engine = create_engine(db_uri)
+    metadata.create_all(engine)
+    bus = PartitionedBus(3, db_uri)
+    yield bus, engine
+    bus.close()
+
+
+def test_partitions_are_stable_and_spread_skus_out():
+    skus = [f"SKU-{i}" for i in range(300)]
+    assignment = [partition_for(sku, 4) for sku in skus]
+
+    assert assignment == [partition_for(sku, 4) for sku in skus]
+    assert set(assignment) == {0, 1, 2, 3}
+
+
+def test_events_for_a_sku_are_handled_in_the_order_they_were_submitted(
+        partitioned_bus
+):
+    bus, engine = partitioned_bus
+    skus = [f"SKU-{i}" for i in range(6)]
+    added = [bus.submit(events.BatchCreated(f"{sku}-batch", sku, 10)) for sku in skus]
+    for future in added:
+        future.result(timeout=60)
+
+    allocations = {
+        (sku, i): bus.submit(events.AllocationRequired(f"{sku}-order-{i}", sku, 4))
+        for i in range(3)
+        for sku in skus
+    }
+    refs = {key: future.result(timeout=60)[0] for key, future in allocations.items()}
+
+    for sku in skus:
+        # only the first two of three orders for 4 fit into a batch of 10
+        assert [refs[sku, i] for i in range(3)] == [f"{sku}-batch"] * 2 + [None]
+    with engine.connect() as connection:
+        [[allocated]] = connection.execute("SELECT count(*) FROM allocations_view")
+    assert allocated == 2 * len(skus)
+
+
+def test_handler_errors_come_back_through_the_future(partitioned_bus):
+    bus, _ = partitioned_bus
+    future = bus.submit(events.AllocationRequired("o1", "NONEXISTENTSKU", 10))
+
+    with pytest.raises(InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+        future.result(timeout=60)
+
+
+def test_only_events_naming_a_sku_can_be_submitted(partitioned_bus):
+    bus, _ = partitioned_bus
+    with pytest.raises(ValueError):
+        bus.submit(events.BatchQuantityChanged("batch1", 10))
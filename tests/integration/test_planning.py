@@ -0,0 +1,30 @@
+from datetime import date
+
+from allocation import planning
+from allocation.domain import events
+from allocation.service_layer import message_bus, unit_of_work
+
+today = date.today()
+
+
+def test_snapshots_loaded_from_the_tables_match_the_products(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    for ref, sku, qty, eta in [
+        ("later", "LAMP", 50, today),
+        ("in-stock", "LAMP", 20, None),
+        ("same-day", "LAMP", 30, today),
+        ("chair", "CHAIR", 10, None),
+        ("table", "TABLE", 10, None),
+    ]:
+        message_bus.handle(events.BatchCreated(ref, sku, qty, eta), uow)
+    message_bus.handle(events.AllocationRequired("o1", "LAMP", 15), uow)
+    message_bus.handle(events.AllocationRequired("o2", "LAMP", 10), uow)
+
+    loaded = planning.load_snapshots(["LAMP", "CHAIR"], uow)
+
+    with uow:
+        expected = [planning.snapshot(uow.products.get(s)) for s in ("CHAIR", "LAMP")]
+    assert [(s.sku, s.batch_refs, s.available.tolist()) for s in loaded] == [
+        (s.sku, s.batch_refs, s.available.tolist()) for s in expected
+    ]
+    assert loaded[1].available.tolist() == [5, 40, 30]
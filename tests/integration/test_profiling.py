@@ -0,0 +1,100 @@
+import logging
+
+import pytest
+
+from allocation.adapters import profiling, repository
+from allocation.domain import events
+from allocation.service_layer import handlers, unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+
+def add_allocated_batches(session_factory, sku, batches):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    for _ in range(batches):
+        handlers.add_batch(events.BatchCreated(random_batchref(), sku, 10, None), uow)
+        handlers.allocate(events.AllocationRequired(random_orderid(), sku, 10), uow)
+
+
+def walk_allocations(uow, sku):
+    with uow:
+        product = uow.products.get(sku=sku)
+        return [b.allocated_quantity for b in product.batches]
+
+
+def test_statement_shapes_collapse_parameter_lists():
+    assert profiling.statement_shape(
+        "SELECT a FROM t\n  WHERE x IN (?, ?, ?) AND y = ?"
+    ) == "SELECT a FROM t WHERE x IN (...) AND y = ?"
+    assert profiling.statement_shape(
+        "SELECT a FROM t WHERE x IN (%(p1)s, %(p2)s)"
+    ) == "SELECT a FROM t WHERE x IN (...)"
+
+
+def test_profiles_count_the_statements_of_each_unit_of_work(session_factory):
+    sku = random_sku()
+    add_allocated_batches(session_factory, sku, 3)
+    profiler = profiling.QueryProfiler(keep_profiles=True)
+
+    for _ in range(2):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, profiler=profiler)
+        walk_allocations(uow, sku)
+
+    first, second = profiler.profiles
+    assert first.statements == second.statements == 3
+    assert first.repeated() == []
+
+
+def test_lazy_loads_in_a_loop_show_up_as_repeated_statements(session_factory):
+    sku = random_sku()
+    add_allocated_batches(session_factory, sku, 5)
+    profiler = profiling.QueryProfiler(keep_profiles=True)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, load_strategy=repository.LAZY, profiler=profiler
+    )
+
+    walk_allocations(uow, sku)
+
+    [profile] = profiler.profiles
+    [(shape, times)] = profile.repeated()
+    assert times == 5
+    assert "FROM order_lines, allocations" in shape
+
+
+def test_units_of_work_over_the_thresholds_are_logged(session_factory, caplog):
+    sku = random_sku()
+    add_allocated_batches(session_factory, sku, 5)
+    profiler = profiling.QueryProfiler(max_statements=4, max_repeats=2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, load_strategy=repository.LAZY, profiler=profiler
+    )
+
+    with caplog.at_level(logging.WARNING, logger=profiling.__name__):
+        walk_allocations(uow, sku)
+
+    [record] = caplog.records
+    assert "more than 4 statements" in record.getMessage()
+    assert "repeated more than 2 times" in record.getMessage()
+
+
+def test_query_budget_holds_allocate_to_a_fixed_number_of_statements(session_factory):
+    sku = random_sku()
+    add_allocated_batches(session_factory, sku, 5)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with profiling.query_budget(uow, statements=12, repeats=1):
+        handlers.add_batch(events.BatchCreated(random_batchref(), sku, 10, None), uow)
+        handlers.allocate(events.AllocationRequired(random_orderid(), sku, 1), uow)
+
+    assert uow.profiler is None
+
+
+def test_query_budget_fails_on_an_n_plus_one(session_factory):
+    sku = random_sku()
+    add_allocated_batches(session_factory, sku, 5)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, load_strategy=repository.LAZY
+    )
+
+    with pytest.raises(AssertionError, match="repeated more than 1 times"):
+        with profiling.query_budget(uow, repeats=1):
+            walk_allocations(uow, sku)
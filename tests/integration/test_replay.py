@@ -0,0 +1,44 @@
+import io
+import json
+
+import pytest
+
+from allocation.entry_points import replay
+from allocation.service_layer import unit_of_work
+from .test_uow import get_allocated_batch_ref
+
+
+def to_jsonl(*records):
+    return io.StringIO("".join(json.dumps(r) + "\n" for r in records))
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 100])
+def test_replays_events_through_the_message_bus(session_factory, batch_size):
+    lines = to_jsonl(
+        {"type": "BatchCreated", "ref": "b1", "sku": "RUSTY-KETTLE", "qty": 10},
+        {"type": "BatchCreated", "ref": "b2", "sku": "RUSTY-KETTLE", "qty": 10,
+         "eta": "2030-01-01"},
+        {"type": "AllocationRequired", "order_id": "o1", "sku": "RUSTY-KETTLE",
+         "qty": 8},
+        {"type": "AllocationRequired", "order_id": "o2", "sku": "NONEXISTENTSKU",
+         "qty": 1},
+        {"type": "BatchQuantityChanged", "ref": "b1", "qty": 5},
+        {"type": "AllocationRequired", "order_id": "o3", "sku": "RUSTY-KETTLE",
+         "qty": 6},
+    )
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    report = replay.replay(lines, uow, batch_size=batch_size)
+
+    assert report.events == 6
+    assert (report.invalid_sku, report.out_of_stock) == (1, 1)
+    assert report.latency.count == -(-6 // batch_size)
+    session = session_factory()
+    assert get_allocated_batch_ref(session, "o1", "RUSTY-KETTLE") == "b2"
+
+
+def test_rejects_events_that_cannot_be_replayed(session_factory):
+    lines = to_jsonl({"type": "OutOfStock", "sku": "RUSTY-KETTLE"})
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with pytest.raises(ValueError, match="line 1: cannot replay OutOfStock"):
+        replay.replay(lines, uow)
@@ -0,0 +1,136 @@
+import pytest
+from sqlalchemy import event
+
+from allocation.adapters import repository
+from allocation.domain import model
+
+
+@pytest.fixture
+def statements(in_memory_db):
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    yield executed
+    event.remove(in_memory_db, "before_cursor_execute", record)
+
+
+@pytest.fixture
+def loaded_lines():
+    loaded = []
+
+    def record(line, _):
+        loaded.append(line)
+
+    event.listen(model.OrderLine, "load", record)
+    yield loaded
+    event.remove(model.OrderLine, "load", record)
+
+
+def insert_product(session, sku, batch_count, lines_per_batch):
+    product = model.Product(sku, batches=[])
+    for b in range(batch_count):
+        batch = model.Batch(f"{sku}-batch{b}", sku, lines_per_batch, eta=None)
+        for i in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"order{b}-{i}", sku, 1))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+    session.close()
+
+
+def load_everything(product):
+    return sum(batch.available_quantity for batch in product.batches)
+
+
+@pytest.mark.parametrize(
+    "strategy, expected_queries",
+    [(repository.LAZY, 22), (repository.SELECTIN, 3), (repository.JOINED, 1)],
+)
+def test_query_count_per_aggregate_load(
+        session, statements, strategy, expected_queries
+):
+    insert_product(session, "CHUNKY-BENCH", batch_count=20, lines_per_batch=3)
+    statements.clear()
+
+    repo = repository.SqlAlchemyRepository(session, load_strategy=strategy)
+    product = repo.get("CHUNKY-BENCH")
+    assert load_everything(product) == 0
+
+    assert len(statements) == expected_queries
+
+
+def test_batch_ref_lookups_load_the_whole_aggregate(session, statements):
+    insert_product(session, "CHUNKY-BENCH", batch_count=20, lines_per_batch=3)
+    statements.clear()
+
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get_by_batch_ref("CHUNKY-BENCH-batch7")
+    assert load_everything(product) == 0
+
+    assert len(statements) == 3
+
+
+def test_can_skip_loading_allocations(session, statements):
+    insert_product(session, "CHUNKY-BENCH", batch_count=20, lines_per_batch=3)
+    statements.clear()
+
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get("CHUNKY-BENCH", allocations=False)
+    assert len(product.batches) == 20
+
+    assert len(statements) == 2
+
+
+def test_deallocating_an_order_loads_only_its_lines(
+        session, statements, loaded_lines
+):
+    insert_product(session, "CHUNKY-BENCH", batch_count=20, lines_per_batch=3)
+    statements.clear()
+
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get_for_order("CHUNKY-BENCH", "order7-1")
+    assert product.deallocate("order7-1") == ["CHUNKY-BENCH-batch7"]
+
+    assert [line.order_id for line in loaded_lines] == ["order7-1"]
+    assert len(statements) == 3
+    session.commit()
+    session.close()
+    product = repo.get("CHUNKY-BENCH")
+    assert load_everything(product) == 1
+
+
+def test_a_product_loaded_for_one_order_cannot_allocate(session):
+    insert_product(session, "CHUNKY-BENCH", batch_count=1, lines_per_batch=3)
+
+    product = repository.SqlAlchemyRepository(session).get_for_order(
+        "CHUNKY-BENCH", "order0-1"
+    )
+    product.deallocate("order0-1")
+
+    with pytest.raises(model.PartiallyLoaded, match="order0-1"):
+        product.allocate(model.OrderLine("big", "CHUNKY-BENCH", 3))
+    with pytest.raises(model.PartiallyLoaded):
+        product.change_batch_quantity("CHUNKY-BENCH-batch0", 1)
+
+
+def test_can_check_which_skus_exist_without_loading_them(session, statements):
+    insert_product(session, "CHUNKY-BENCH", batch_count=20, lines_per_batch=3)
+    statements.clear()
+
+    repo = repository.SqlAlchemyRepository(session)
+    assert repo.known_skus(["CHUNKY-BENCH", "NOPE"]) == {"CHUNKY-BENCH"}
+
+    assert len(statements) == 1
+
+
+def test_loaded_lines_share_one_copy_of_their_sku(session):
+    insert_product(session, "SHARED-SKU-LAMP", 2, 3)
+
+    product = repository.SqlAlchemyRepository(session).get("SHARED-SKU-LAMP")
+    lines = [line for batch in product.batches for line in batch._allocations]
+
+    assert len({id(line.sku) for line in lines}) == 1
+    assert not session.dirty
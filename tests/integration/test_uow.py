@@ -3,8 +3,10 @@ import time
 import traceback
 from typing import List
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from sqlalchemy import event as sa_event
+from allocation.adapters import idempotency
+from allocation.domain import events, model
+from allocation.service_layer import handlers, message_bus, unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
 
@@ -74,6 +76,27 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
+def test_commit_fails_if_the_product_version_moved_on(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CONTESTED-LAMP", 100, None, product_version=1)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with pytest.raises(unit_of_work.ConcurrencyError) as conflict:
+        with uow:
+            product = uow.products.get(sku="CONTESTED-LAMP")
+            # someone else commits first, between our read and our write
+            uow.session.execute(
+                "UPDATE products SET version_number=2 WHERE sku='CONTESTED-LAMP'"
+            )
+            product.allocate(model.OrderLine("o1", "CONTESTED-LAMP", 10))
+            uow.commit()
+
+    assert conflict.value.skus == ["CONTESTED-LAMP"]
+    rows = list(session.execute("SELECT * FROM allocations"))
+    assert rows == []
+
+
 def try_to_allocate(orderid, sku, exceptions):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -121,4 +144,113 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     )
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
-        uow.session.execute("select 1")
\ No newline at end of file
+        uow.session.execute("select 1")
+
+
+def test_allocated_quantity_is_counted_correctly_after_loading(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "SHINY-STOOL", 100, None)
+    session.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku="SHINY-STOOL")
+        product.allocate(model.OrderLine("o1", "SHINY-STOOL", 10))
+        product.allocate(model.OrderLine("o2", "SHINY-STOOL", 15))
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        [batch] = uow.products.get(sku="SHINY-STOOL").batches
+        assert batch.available_quantity == 75
+        batch.deallocate(model.OrderLine("o1", "SHINY-STOOL", 10))
+        assert batch.available_quantity == 85
+        uow.rollback()
+        assert batch.available_quantity == 75
+
+
+def test_retried_allocation_is_answered_from_its_idempotency_key(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "RETRIED-SOFA", 100, None)
+    session.commit()
+    event = events.AllocationRequired("o1", "RETRIED-SOFA", 10, "client-key")
+
+    first = handlers.allocate(
+        event, unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    )
+    retried = handlers.allocate(
+        event, unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    )
+
+    assert first == retried == "batch1"
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='RETRIED-SOFA'"
+    )
+    assert version == 2
+    assert list(session.execute("SELECT key, batch_ref FROM idempotency_keys")) == [
+        ("client-key", "batch1")
+    ]
+
+
+def test_idempotency_records_are_inserted_after_the_product_update(
+        session_factory, in_memory_db
+):
+    session = session_factory()
+    insert_batch(session, "batch1", "RETRIED-SOFA", 100, None)
+    session.commit()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement.split()[0:3])
+
+    sa_event.listen(in_memory_db, "before_cursor_execute", record)
+    try:
+        handlers.allocate(
+            events.AllocationRequired("o1", "RETRIED-SOFA", 10, "client-key"),
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+    finally:
+        sa_event.remove(in_memory_db, "before_cursor_execute", record)
+
+    writes = [s for s in statements if s[0] in ("INSERT", "UPDATE")]
+    assert writes.index(["UPDATE", "products", "SET"]) < writes.index(
+        ["INSERT", "INTO", "idempotency_keys"]
+    )
+
+
+def test_a_key_recorded_while_its_retry_was_in_flight_answers_the_retry(
+        session_factory, monkeypatch
+):
+    session = session_factory()
+    insert_batch(session, "batch1", "RETRIED-SOFA", 100, None)
+    session.commit()
+    get_many = idempotency.SqlAlchemyIdempotencyStore.get_many
+
+    def first_request_commits_meanwhile(store, keys):
+        # the retry finds no record, then the first request records its key
+        # before the retry commits
+        monkeypatch.setattr(
+            idempotency.SqlAlchemyIdempotencyStore, "get_many", get_many
+        )
+        other = session_factory()
+        other.execute(
+            "INSERT INTO idempotency_keys (key, order_id, sku, qty, batch_ref)"
+            " VALUES ('client-key', 'o1', 'RETRIED-SOFA', 10, 'batch1')"
+        )
+        other.commit()
+        return {}
+
+    monkeypatch.setattr(
+        idempotency.SqlAlchemyIdempotencyStore,
+        "get_many",
+        first_request_commits_meanwhile,
+    )
+
+    [batch_ref, *_] = message_bus.handle(
+        events.AllocationRequired("o1", "RETRIED-SOFA", 10, "client-key"),
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+    )
+
+    assert batch_ref == "batch1"
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='RETRIED-SOFA'"
+    )
+    assert version == 1
@@ -0,0 +1,97 @@
+from datetime import date
+
+from allocation import views
+from allocation.domain import events
+from allocation.service_layer import message_bus, unit_of_work
+
+today = date.today()
+
+
+def test_allocations_view(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("sku1batch", "sku1", 50, None), uow)
+    message_bus.handle(events.BatchCreated("sku2batch", "sku2", 50, today), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku1", 20), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku2", 20), uow)
+    # add a spurious batch and order to make sure we're getting the right ones
+    message_bus.handle(events.BatchCreated("sku1batch-later", "sku1", 50, today), uow)
+    message_bus.handle(events.AllocationRequired("otherorder", "sku1", 30), uow)
+
+    assert views.allocations("order1", uow) == [
+        {"sku": "sku1", "qty": 20, "batch_ref": "sku1batch"},
+        {"sku": "sku2", "qty": 20, "batch_ref": "sku2batch"},
+    ]
+
+
+def test_view_follows_rebalancing(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b1", "sku1", 50, None), uow)
+    message_bus.handle(events.BatchCreated("b2", "sku1", 50, today), uow)
+    message_bus.handle_all(
+        [
+            events.AllocationRequired("order1", "sku1", 20),
+            events.AllocationRequired("order2", "sku1", 20),
+        ],
+        uow,
+        batched=True,
+    )
+    message_bus.handle(events.BatchQuantityChanged("b1", 25), uow)
+
+    [order1] = views.allocations("order1", uow)
+    [order2] = views.allocations("order2", uow)
+    assert sorted([order1["batch_ref"], order2["batch_ref"]]) == ["b1", "b2"]
+
+
+def test_stock_summary(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b1", "sku1", 50, None), uow)
+    message_bus.handle(events.BatchCreated("b2", "sku1", 50, today), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku1", 20), uow)
+    message_bus.handle(events.AllocationRequired("order2", "sku1", 40), uow)
+
+    assert views.stock("sku1", uow) == [
+        dict(batch_ref="b1", eta=None, purchased=50, allocated=20, lines=1,
+             available=30),
+        dict(batch_ref="b2", eta=str(today), purchased=50, allocated=40, lines=1,
+             available=10),
+    ]
+
+
+def test_cancelling_an_order_removes_it_from_the_view(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("sku1batch", "sku1", 50, None), uow)
+    message_bus.handle(events.BatchCreated("sku2batch", "sku2", 50, None), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku1", 20), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku2", 20), uow)
+    message_bus.handle(events.AllocationRequired("order2", "sku1", 10), uow)
+
+    with uow:
+        assert uow.products.skus_for_order("order1") == ["sku1", "sku2"]
+    message_bus.handle(events.OrderCancelled("order1"), uow)
+
+    assert views.allocations("order1", uow) == []
+    assert views.allocations("order2", uow) == [
+        {"sku": "sku1", "qty": 10, "batch_ref": "sku1batch"}
+    ]
+    with uow:
+        assert uow.products.skus_for_order("order1") == []
+        assert uow.products.get("sku1").batches[0].available_quantity == 40
+
+
+def test_a_line_dropped_by_a_rebalance_can_be_allocated_again(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b1", "sku1", 10, None), uow)
+    message_bus.handle(events.AllocationRequired("order1", "sku1", 5), uow)
+    message_bus.handle(events.BatchQuantityChanged("b1", 0), uow)
+    message_bus.handle(events.BatchCreated("b2", "sku1", 10, None), uow)
+
+    [batch_ref, *_] = message_bus.handle(
+        events.AllocationRequired("order1", "sku1", 5), uow
+    )
+
+    assert batch_ref == "b2"
+    assert views.allocations("order1", uow) == [
+        {"sku": "sku1", "qty": 5, "batch_ref": "b2"}
+    ]
+    with uow:
+        assert uow.idempotency_keys.get("order1:sku1").batch_ref == "b2"
@@ -56,4 +56,11 @@ def test_deallocate():
 def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
     batch.deallocate(unallocated_line)
-    assert batch.available_quantity == 20
\ No newline at end of file
+    assert batch.available_quantity == 20
+
+
+def test_order_lines_share_one_copy_of_their_sku():
+    sku = "".join(["SHARED-", "TABLE"])  # built at runtime, so not interned
+    line = OrderLine("order-ref", sku, 2)
+
+    assert line.sku is OrderLine("other-order-ref", "SHARED-TABLE", 2).sku
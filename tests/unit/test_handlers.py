@@ -1,8 +1,9 @@
+import dataclasses
 from datetime import date
 from unittest import mock
 import pytest
-from allocation.adapters import repository
-from allocation.service_layer import handlers, unit_of_work, message_bus
+from allocation.adapters import idempotency, repository
+from allocation.service_layer import handlers, unit_of_work, message_bus, retries
 from allocation.domain import events
 
 
@@ -23,17 +24,92 @@ class FakeRepository(repository.AbstractRepository):
             None
         )
 
+    def _skus_for_order(self, order_id):
+        return sorted(
+            p.sku for p in self._products
+            if any(l.order_id == order_id for b in p.batches for l in b._allocations)
+        )
+
+    def _known_skus(self, skus):
+        return {p.sku for p in self._products if p.sku in skus}
+
+
+class FakeIdempotencyStore(idempotency.AbstractIdempotencyStore):
+    def __init__(self):
+        self.records = {}
+        self.uncommitted = {}
+
+    def get_many(self, keys):
+        records = {**self.records, **self.uncommitted}
+        return {key: records[key] for key in keys if key in records}
+
+    def add(self, record):
+        self.uncommitted[record.key] = record
+
+    def remove(self, order_id, sku):
+        for records in (self.records, self.uncommitted):
+            for key, record in list(records.items()):
+                if (record.order_id, record.sku) == (order_id, sku):
+                    del records[key]
+
+    def reassign(self, order_id, sku, batch_ref):
+        for records in (self.records, self.uncommitted):
+            for key, record in list(records.items()):
+                if (record.order_id, record.sku) == (order_id, sku):
+                    records[key] = dataclasses.replace(record, batch_ref=batch_ref)
+
+    def commit(self):
+        self.records.update(self.uncommitted)
+        self.uncommitted = {}
+
+    def rollback(self):
+        self.uncommitted = {}
+
+
+class FakeSession:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
         self.products = FakeRepository([])
+        self.idempotency_keys = FakeIdempotencyStore()
+        self.session = FakeSession()
         self.committed = False
 
     def _commit(self):
+        self.idempotency_keys.commit()
         self.committed = True
 
     def rollback(self):
-        pass
+        self.idempotency_keys.rollback()
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise unit_of_work.ConcurrencyError(
+                "version changed", [p.sku for p in self.products.seen]
+            )
+        super()._commit()
+
+
+@pytest.fixture
+def retry_stats(monkeypatch):
+    monkeypatch.setattr(
+        retries, "POLICY", retries.RetryPolicy(retries=2, base_delay=0)
+    )
+    monkeypatch.setattr(retries, "STATS", retries.ConflictStats())
+    return retries.STATS
 
 
 class TestAddBatch:
@@ -73,6 +149,51 @@ class TestAllocate:
         message_bus.handle(events.AllocationRequired("o1", "OMINOUS-MIRROR", 10), uow)
         assert uow.committed
 
+    def test_batched_mode_allocates_a_run_of_events_in_bulk(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "TALL-LAMP", 20, None), uow)
+        message_bus.handle(events.BatchCreated("b2", "SHORT-LAMP", 5, None), uow)
+        results = message_bus.handle_all(
+            [
+                events.AllocationRequired("o1", "TALL-LAMP", 10),
+                events.AllocationRequired("o2", "SHORT-LAMP", 10),
+                events.AllocationRequired("o3", "TALL-LAMP", 10),
+            ],
+            uow,
+            batched=True,
+        )
+        assert results[:3] == ["b1", None, "b1"]
+        assert uow.committed
+
+    def test_batched_mode_errors_for_invalid_sku(self):
+        uow = FakeUnitOfWork()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            message_bus.handle(
+                events.AllocationRequired("o1", "NONEXISTENTSKU", 10),
+                uow,
+                batched=True,
+            )
+
+    def test_batched_mode_allocates_nothing_if_any_sku_is_invalid(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "TALL-LAMP", 20, None), uow)
+        uow.committed = False
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            message_bus.handle_all(
+                [
+                    events.AllocationRequired("o1", "TALL-LAMP", 10),
+                    events.AllocationRequired("o2", "NONEXISTENTSKU", 10),
+                ],
+                uow,
+                batched=True,
+            )
+
+        [batch] = uow.products.get("TALL-LAMP").batches
+        assert batch.available_quantity == 20
+        assert not uow.committed
+        assert not uow.idempotency_keys.records
+
     def test_sends_email_on_out_of_stock_error(self):
         uow = FakeUnitOfWork()
         message_bus.handle(events.BatchCreated("b1", "POPULAR-CURTAINS", 9, None), uow)
@@ -86,6 +207,297 @@ class TestAllocate:
             )
 
 
+class TestAllocateBulk:
+    def test_reports_a_result_for_every_line(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "CURLY-SOFA", 15, None), uow)
+        message_bus.handle(events.BatchCreated("b2", "STRAIGHT-SOFA", 5, None), uow)
+        [results, *_] = message_bus.handle(
+            events.BulkAllocationRequired(
+                [
+                    events.AllocationRequired("o1", "CURLY-SOFA", 10),
+                    events.AllocationRequired("o1", "NONEXISTENTSKU", 1),
+                    events.AllocationRequired("o2", "CURLY-SOFA", 10),
+                    events.AllocationRequired("o2", "STRAIGHT-SOFA", 5),
+                ]
+            ),
+            uow,
+        )
+        assert [(r.order_id, r.sku, r.status, r.batch_ref) for r in results] == [
+            ("o1", "CURLY-SOFA", handlers.ALLOCATED, "b1"),
+            ("o1", "NONEXISTENTSKU", handlers.INVALID_SKU, None),
+            ("o2", "CURLY-SOFA", handlers.OUT_OF_STOCK, None),
+            ("o2", "STRAIGHT-SOFA", handlers.ALLOCATED, "b2"),
+        ]
+        assert uow.committed
+
+
+class TestIdempotency:
+    def test_a_retried_request_gets_the_recorded_batch_ref(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 100, None), uow)
+        first = message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow
+        )
+        uow.products = FakeRepository([])  # a retry must not need the product
+
+        retried = message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow
+        )
+
+        assert retried == ["b1"]
+        assert first[0] == "b1"
+
+    def test_client_keys_cannot_be_reused_for_another_request(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 100, None), uow)
+        message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10, "key-1"), uow
+        )
+
+        with pytest.raises(handlers.IdempotencyKeyReused, match="key-1"):
+            message_bus.handle(
+                events.AllocationRequired("o2", "RETRIED-LAMP", 10, "key-1"), uow
+            )
+
+    def test_out_of_stock_answers_are_not_recorded(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 5, None), uow)
+        [result, *_] = message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow
+        )
+        assert result is None
+        message_bus.handle(events.BatchCreated("b2", "RETRIED-LAMP", 50, None), uow)
+
+        [result, *_] = message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow
+        )
+
+        assert result == "b2"
+
+    def test_bulk_allocation_answers_recorded_lines_from_their_keys(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 15, None), uow)
+        message_bus.handle(events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow)
+
+        [results, *_] = message_bus.handle(
+            events.BulkAllocationRequired([
+                events.AllocationRequired("o1", "RETRIED-LAMP", 10),
+                events.AllocationRequired("o2", "RETRIED-LAMP", 5),
+            ]),
+            uow,
+        )
+
+        assert [(r.status, r.batch_ref) for r in results] == [
+            (handlers.ALLOCATED, "b1"),
+            (handlers.ALLOCATED, "b1"),
+        ]
+        assert set(uow.idempotency_keys.records) == {
+            "o1:RETRIED-LAMP", "o2:RETRIED-LAMP"
+        }
+
+    def test_bulk_allocation_reports_lines_whose_key_was_reused(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 20, None), uow)
+        message_bus.handle(events.BatchCreated("b2", "RETRIED-DESK", 20, None), uow)
+        message_bus.handle(events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow)
+
+        [results, *_] = message_bus.handle(
+            events.BulkAllocationRequired([
+                events.AllocationRequired("o2", "RETRIED-DESK", 5),
+                events.AllocationRequired("o2", "RETRIED-LAMP", 5),
+                events.AllocationRequired("o1", "RETRIED-LAMP", 3),
+            ]),
+            uow,
+        )
+
+        assert [(r.status, r.batch_ref) for r in results] == [
+            (handlers.ALLOCATED, "b2"),
+            (handlers.ALLOCATED, "b1"),
+            (handlers.KEY_REUSED, None),
+        ]
+        [batch] = uow.products.get("RETRIED-LAMP").batches
+        assert batch.available_quantity == 5
+
+    def test_batched_run_with_a_reused_key_allocates_nothing(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 20, None), uow)
+        message_bus.handle(events.BatchCreated("b2", "RETRIED-DESK", 20, None), uow)
+        message_bus.handle(events.AllocationRequired("o1", "RETRIED-LAMP", 10), uow)
+
+        with pytest.raises(handlers.IdempotencyKeyReused, match="o1:RETRIED-LAMP"):
+            message_bus.handle_all(
+                [
+                    events.AllocationRequired("o2", "RETRIED-DESK", 5),
+                    events.AllocationRequired("o1", "RETRIED-LAMP", 3),
+                ],
+                uow,
+                batched=True,
+            )
+
+        [batch] = uow.products.get("RETRIED-DESK").batches
+        assert batch.available_quantity == 20
+
+    def test_batched_run_reusing_a_key_within_itself_allocates_nothing(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 20, None), uow)
+
+        with pytest.raises(handlers.IdempotencyKeyReused, match="key-1"):
+            message_bus.handle_all(
+                [
+                    events.AllocationRequired("o1", "RETRIED-LAMP", 5, "key-1"),
+                    events.AllocationRequired("o2", "RETRIED-LAMP", 5, "key-1"),
+                ],
+                uow,
+                batched=True,
+            )
+
+        [batch] = uow.products.get("RETRIED-LAMP").batches
+        assert batch.available_quantity == 20
+
+    def test_bulk_allocation_turns_away_repeated_order_lines(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 15, None), uow)
+
+        [results, *_] = message_bus.handle(
+            events.BulkAllocationRequired([
+                events.AllocationRequired("o1", "RETRIED-LAMP", 2),
+                events.AllocationRequired("o1", "RETRIED-LAMP", 3),
+                events.AllocationRequired("o2", "RETRIED-LAMP", 4),
+                events.AllocationRequired("o2", "RETRIED-LAMP", 4),
+            ]),
+            uow,
+        )
+
+        assert [(r.status, r.batch_ref) for r in results] == [
+            (handlers.ALLOCATED, "b1"),
+            (handlers.DUPLICATE, None),
+            (handlers.ALLOCATED, "b1"),
+            (handlers.DUPLICATE, None),
+        ]
+        [batch] = uow.products.get("RETRIED-LAMP").batches
+        assert batch.available_quantity == 9
+
+    def test_a_repeated_request_in_a_batched_run_is_answered_as_a_retry(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 15, None), uow)
+
+        results = message_bus.handle_all(
+            [
+                events.AllocationRequired("o1", "RETRIED-LAMP", 4),
+                events.AllocationRequired("o1", "RETRIED-LAMP", 4),
+            ],
+            uow,
+            batched=True,
+        )
+
+        assert results[:2] == ["b1", "b1"]
+        [batch] = uow.products.get("RETRIED-LAMP").batches
+        assert batch.available_quantity == 11
+
+    def test_lines_a_rebalance_drops_are_allocated_afresh(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 10, None), uow)
+        allocate = events.AllocationRequired("o1", "RETRIED-LAMP", 5)
+        message_bus.handle(allocate, uow)
+        message_bus.handle(events.BatchQuantityChanged("b1", 0), uow)
+
+        [result, *_] = message_bus.handle(allocate, uow)
+        assert result is None
+        message_bus.handle(events.BatchCreated("b2", "RETRIED-LAMP", 10, None), uow)
+        [result, *_] = message_bus.handle(allocate, uow)
+
+        assert result == "b2"
+        assert uow.products.get("RETRIED-LAMP").batches[1].available_quantity == 5
+
+    def test_a_line_under_a_new_key_is_not_allocated_twice(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("a", "RETRIED-LAMP", 10, None), uow)
+        message_bus.handle(
+            events.BatchCreated("b", "RETRIED-LAMP", 10, date.today()), uow
+        )
+        message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10, "k1"), uow
+        )
+
+        [result, *_] = message_bus.handle(
+            events.AllocationRequired("o1", "RETRIED-LAMP", 10, "k2"), uow
+        )
+
+        assert result == "a"
+        a, b = uow.products.get("RETRIED-LAMP").batches
+        assert (a.available_quantity, b.available_quantity) == (0, 10)
+
+    def test_retries_of_lines_a_rebalance_moved_get_their_new_batch(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "RETRIED-LAMP", 10, None), uow)
+        message_bus.handle(
+            events.BatchCreated("b2", "RETRIED-LAMP", 10, date.today()), uow
+        )
+        allocate = events.AllocationRequired("o1", "RETRIED-LAMP", 5, "key-1")
+        message_bus.handle(allocate, uow)
+        message_bus.handle(events.BatchQuantityChanged("b1", 2), uow)
+
+        [result, *_] = message_bus.handle(allocate, uow)
+
+        assert result == "b2"
+        assert uow.idempotency_keys.records["key-1"].batch_ref == "b2"
+
+
+class TestDeallocate:
+    def test_frees_the_order_line(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "TIMID-LAMP", 10, None), uow)
+        message_bus.handle(events.AllocationRequired("o1", "TIMID-LAMP", 4), uow)
+
+        [batch_refs, *_] = message_bus.handle(
+            events.DeallocationRequired("o1", "TIMID-LAMP"), uow
+        )
+
+        assert batch_refs == ["b1"]
+        [batch] = uow.products.get("TIMID-LAMP").batches
+        assert batch.available_quantity == 10
+        assert uow.committed
+
+    def test_errors_for_invalid_sku(self):
+        uow = FakeUnitOfWork()
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            message_bus.handle(
+                events.DeallocationRequired("o1", "NONEXISTENTSKU"), uow
+            )
+
+    def test_a_deallocated_line_can_be_allocated_again_under_the_same_key(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "TIMID-LAMP", 10, None), uow)
+        message_bus.handle(
+            events.BatchCreated("b2", "TIMID-LAMP", 10, date.today()), uow
+        )
+        allocate = events.AllocationRequired("o1", "TIMID-LAMP", 4, "key-1")
+        message_bus.handle(allocate, uow)
+        message_bus.handle(events.DeallocationRequired("o1", "TIMID-LAMP"), uow)
+        message_bus.handle(events.BatchQuantityChanged("b1", 2), uow)
+
+        [batch_ref, *_] = message_bus.handle(allocate, uow)
+
+        assert batch_ref == "b2"
+
+    def test_cancelling_an_order_frees_its_lines_for_every_sku(self):
+        uow = FakeUnitOfWork()
+        for sku in ("TIMID-LAMP", "SHY-CHAIR"):
+            message_bus.handle(events.BatchCreated(f"b-{sku}", sku, 10, None), uow)
+            message_bus.handle(events.AllocationRequired("o1", sku, 4), uow)
+        message_bus.handle(events.AllocationRequired("o2", "SHY-CHAIR", 3), uow)
+
+        [released, *_] = message_bus.handle(events.OrderCancelled("o1"), uow)
+
+        assert released == {
+            "SHY-CHAIR": ["b-SHY-CHAIR"], "TIMID-LAMP": ["b-TIMID-LAMP"]
+        }
+        assert uow.products.get("TIMID-LAMP").batches[0].available_quantity == 10
+        assert uow.products.get("SHY-CHAIR").batches[0].available_quantity == 7
+
+
 class TestChangeBatchQuantity:
     def test_change_available_quantity(self):
         uow = FakeUnitOfWork()
@@ -118,3 +530,66 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestConcurrencyConflicts:
+    def test_retries_conflicting_commits(self, retry_stats):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        message_bus.handle(events.BatchCreated("b1", "BUSY-CHAIR", 100, None), uow)
+        uow.conflicts = 2
+
+        results = message_bus.handle(
+            events.AllocationRequired("o1", "BUSY-CHAIR", 10), uow
+        )
+
+        assert results.pop(0) == "b1"
+        assert retry_stats.conflicts["BUSY-CHAIR"] == 2
+        assert retry_stats.retries["BUSY-CHAIR"] == 2
+        assert retry_stats.failures["BUSY-CHAIR"] == 0
+
+    def test_gives_up_after_too_many_conflicts(self, retry_stats):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        message_bus.handle(events.BatchCreated("b1", "BUSY-CHAIR", 100, None), uow)
+        uow.conflicts = 3
+
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            message_bus.handle(events.AllocationRequired("o1", "BUSY-CHAIR", 10), uow)
+
+        assert retry_stats.conflicts["BUSY-CHAIR"] == 3
+        assert retry_stats.failures["BUSY-CHAIR"] == 1
+
+    def test_bulk_handlers_retry_each_sku_on_its_own(self, retry_stats):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        message_bus.handle(events.BatchCreated("b1", "BUSY-CHAIR", 100, None), uow)
+        uow.conflicts = 1
+
+        results = message_bus.handle_all(
+            [
+                events.AllocationRequired("o1", "BUSY-CHAIR", 10),
+                events.AllocationRequired("o2", "BUSY-CHAIR", 10),
+            ],
+            uow,
+            batched=True,
+        )
+
+        assert results[:2] == ["b1", "b1"]
+        assert retry_stats.retries["BUSY-CHAIR"] == 1
+
+    def test_handlers_that_retry_per_sku_are_not_retried_again(self, retry_stats):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        message_bus.handle(events.BatchCreated("b1", "BUSY-CHAIR", 100, None), uow)
+        message_bus.handle(events.BatchCreated("b2", "BUSY-TABLE", 100, None), uow)
+        allocate = events.BulkAllocationRequired([
+            events.AllocationRequired("o1", "BUSY-TABLE", 10),
+            events.AllocationRequired("o1", "BUSY-CHAIR", 10),
+        ])
+        message_bus.handle(allocate, uow)
+        uow.conflicts = 3
+
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            message_bus.handle(events.OrderCancelled("o1"), uow)
+
+        assert retry_stats.conflicts["BUSY-CHAIR"] == 3
+        assert retry_stats.failures["BUSY-CHAIR"] == 1
+        [table] = uow.products.get("BUSY-TABLE").batches
+        assert table.available_quantity == 90
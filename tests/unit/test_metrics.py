@@ -0,0 +1,67 @@
+import pytest
+
+from allocation import instrumentation
+from allocation.domain import events
+from allocation.entry_points import prometheus
+from allocation.service_layer import message_bus
+from .test_handlers import FakeUnitOfWork
+
+
+@pytest.fixture
+def metrics():
+    yield instrumentation.enable()
+    instrumentation.disable()
+
+
+def test_histograms_count_observations_into_cumulative_buckets():
+    histogram = instrumentation.Histogram(buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+
+    assert list(histogram.cumulative()) == [(1, 2), (5, 3), (float("inf"), 4)]
+    assert histogram.sum == 14.5
+    assert histogram.count == 4
+
+
+def test_bus_records_handlers_stages_and_cascaded_events(metrics):
+    uow = FakeUnitOfWork()
+    message_bus.handle(events.BatchCreated("b1", "TIMED-LAMP", 10, None), uow)
+    message_bus.handle(events.AllocationRequired("o1", "TIMED-LAMP", 5), uow)
+
+    assert metrics.handlers["AllocationRequired", "allocate"].count == 1
+    assert metrics.handlers["BatchCreated", "add_batch"].count == 1
+    assert metrics.events["Allocated"].count == 1
+    assert metrics.stages["load"].count == 2
+    assert metrics.stages["commit"].count == 3
+    assert metrics.cascaded == {"Allocated": 1}
+    assert metrics.queue_depth.count == 2
+
+
+def test_nothing_is_recorded_while_disabled(metrics):
+    instrumentation.disable()
+    uow = FakeUnitOfWork()
+    message_bus.handle(events.BatchCreated("b1", "TIMED-LAMP", 10, None), uow)
+
+    assert metrics.handlers == {}
+    assert metrics.stages == {}
+    assert metrics.queue_depth.count == 0
+
+
+def test_metrics_render_in_prometheus_text_format(metrics):
+    uow = FakeUnitOfWork()
+    message_bus.handle(events.BatchCreated("b1", "TIMED-LAMP", 10, None), uow)
+
+    text = prometheus.render()
+
+    assert "# TYPE allocation_handler_seconds histogram" in text
+    assert (
+        'allocation_handler_seconds_bucket{event="BatchCreated",handler="add_batch",'
+        'le="+Inf"} 1'
+    ) in text
+    assert (
+        'allocation_handler_seconds_count{event="BatchCreated",handler="add_batch"} 1'
+        in text
+    )
+    assert 'allocation_bus_queue_depth_bucket{le="1.0"} 1' in text
+    assert "# TYPE allocation_conflicts_total counter" in text
+    assert text.endswith("\n")
@@ -0,0 +1,60 @@
+import copy
+import random
+from datetime import date, timedelta
+
+import numpy as np
+
+from allocation import planning
+from allocation.domain.model import Batch, OrderLine, Product
+
+today = date.today()
+
+
+def make_product(sku, rng):
+    batches = []
+    for i in range(rng.randint(1, 12)):
+        # plenty of shared etas, to check ties keep the domain's order
+        eta = today + timedelta(days=rng.randint(1, 5))
+        if rng.random() < 0.2:
+            eta = None
+        batch = Batch(f"{sku}-batch{i}", sku, rng.randint(0, 60), eta)
+        batch.allocate(OrderLine(f"{sku}-earlier{i}", sku, rng.randint(1, 30)))
+        batches.append(batch)
+    return Product(sku, batches)
+
+
+def test_plans_match_allocating_the_lines_one_by_one():
+    rng = random.Random(0)
+    products = [make_product(f"SKU-{i}", rng) for i in range(20)]
+    demand = [
+        OrderLine(f"forecast-{i}", f"SKU-{rng.randrange(21)}", rng.randint(1, 25))
+        for i in range(3000)
+    ]
+    snapshots = [planning.snapshot(p) for p in products]
+
+    plan = planning.plan(snapshots, [l.sku for l in demand], [l.qty for l in demand])
+
+    replayed = {p.sku: copy.deepcopy(p) for p in products}
+    expected = [
+        replayed[line.sku].allocate(line) if line.sku in replayed else None
+        for line in demand
+    ]
+    assert plan.batch_refs == expected
+    assert plan.leftover == {
+        b.reference: b.available_quantity
+        for p in replayed.values()
+        for b in p.batches
+    }
+    # a dry run: neither the products nor the snapshots changed
+    assert [planning.snapshot(p).available.tolist() for p in products] == [
+        s.available.tolist() for s in snapshots
+    ]
+
+
+def test_first_fit_skips_lines_that_overflow_and_goes_back_for_smaller_ones():
+    left = np.array([10, 10])
+
+    positions = planning.first_fit(left, np.array([6, 5, 3, 11, 1, 4]))
+
+    assert positions.tolist() == [0, 1, 0, -1, 0, 1]
+    assert left.tolist() == [0, 1]
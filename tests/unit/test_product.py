@@ -1,6 +1,7 @@
+import random
 from datetime import date, timedelta
 from allocation.domain import events
-from allocation.domain.model import Product, OrderLine, Batch
+from allocation.domain.model import Product, OrderLine, Batch, smallest_first
 
 
 today = date.today()
@@ -60,4 +61,174 @@ def test_increments_version_number():
     )
     product.version_number = 7
     product.allocate(line)
-    assert product.version_number == 8
\ No newline at end of file
+    assert product.version_number == 8
+
+
+def first_fit_by_sorting(batches, line):
+    return next((b for b in sorted(batches) if b.can_allocate(line)), None)
+
+
+def test_allocation_matches_first_fit_over_sorted_batches():
+    rng = random.Random(42)
+    etas = [None, today, tomorrow, later]
+    batches = [
+        Batch(f"b{i}", "WOBBLY-STOOL", rng.randint(0, 30), eta=rng.choice(etas))
+        for i in range(50)
+    ]
+    shadow = [
+        Batch(b.reference, b.sku, b._purchased_quantity, b.eta) for b in batches
+    ]
+    product = Product(sku="WOBBLY-STOOL", batches=batches)
+
+    for i in range(300):
+        line = OrderLine(f"order{i}", "WOBBLY-STOOL", rng.randint(1, 12))
+        expected = first_fit_by_sorting(shadow, line)
+        if expected is not None:
+            expected.allocate(line)
+        assert product.allocate(line) == (expected and expected.reference)
+
+
+def test_batches_added_later_take_their_place_in_eta_order():
+    product = Product(
+        sku="PLUMP-CUSHION", batches=[Batch("slow", "PLUMP-CUSHION", 10, eta=later)]
+    )
+    product.allocate(OrderLine("order1", "PLUMP-CUSHION", 1))
+
+    product.add_batch(Batch("speedy", "PLUMP-CUSHION", 10, eta=tomorrow))
+    product.batches.append(Batch("in-stock", "PLUMP-CUSHION", 1, eta=None))
+
+    assert product.allocate(OrderLine("order2", "PLUMP-CUSHION", 1)) == "in-stock"
+    assert product.allocate(OrderLine("order3", "PLUMP-CUSHION", 1)) == "speedy"
+
+
+def test_allocation_matches_first_fit_while_batches_are_added():
+    rng = random.Random(7)
+    etas = [None, today, tomorrow, later]
+    product = Product(sku="WOBBLY-STOOL", batches=[])
+    shadow = []
+
+    for i in range(200):
+        if rng.random() < 0.3:
+            eta, qty = rng.choice(etas), rng.randint(0, 30)
+            product.add_batch(Batch(f"b{i}", "WOBBLY-STOOL", qty, eta=eta))
+            shadow.append(Batch(f"b{i}", "WOBBLY-STOOL", qty, eta=eta))
+        line = OrderLine(f"order{i}", "WOBBLY-STOOL", rng.randint(1, 12))
+        expected = first_fit_by_sorting(shadow, line)
+        if expected is not None:
+            expected.allocate(line)
+        assert product.allocate(line) == (expected and expected.reference)
+
+
+def test_shrinking_a_batch_moves_the_fewest_lines_to_other_batches():
+    in_stock = Batch("in-stock", "DAINTY-VASE", 50, eta=None)
+    shipment = Batch("shipment", "DAINTY-VASE", 50, eta=tomorrow)
+    product = Product(sku="DAINTY-VASE", batches=[in_stock, shipment])
+    for order_id, qty in [("small1", 5), ("small2", 5), ("big", 30)]:
+        product.allocate(OrderLine(order_id, "DAINTY-VASE", qty))
+
+    product.change_batch_quantity("in-stock", 20)
+
+    assert in_stock.available_quantity == 10
+    assert shipment.available_quantity == 20
+    assert product.events[-1] == events.BatchRebalanced(
+        "in-stock", "DAINTY-VASE", {"big": "shipment"}, []
+    )
+
+
+def test_shrinking_a_batch_can_evict_smallest_lines_first():
+    in_stock = Batch("in-stock", "DAINTY-VASE", 50, eta=None)
+    shipment = Batch("shipment", "DAINTY-VASE", 50, eta=tomorrow)
+    product = Product(sku="DAINTY-VASE", batches=[in_stock, shipment])
+    for order_id, qty in [("small1", 5), ("small2", 5), ("big", 30)]:
+        product.allocate(OrderLine(order_id, "DAINTY-VASE", qty))
+
+    product.change_batch_quantity("in-stock", 35, evict=smallest_first)
+
+    assert in_stock.available_quantity == 0
+    assert shipment.available_quantity == 45
+
+
+def test_lines_that_no_longer_fit_anywhere_are_reported_once():
+    batch = Batch("batch1", "DAINTY-VASE", 20, eta=None)
+    product = Product(sku="DAINTY-VASE", batches=[batch])
+    for order_id in ["o1", "o2"]:
+        product.allocate(OrderLine(order_id, "DAINTY-VASE", 10))
+
+    product.change_batch_quantity("batch1", 0)
+
+    [rebalanced, out_of_stock] = product.events[-2:]
+    assert sorted(rebalanced.unallocated) == ["o1", "o2"]
+    assert out_of_stock == events.OutOfStock("DAINTY-VASE")
+
+
+def test_records_allocated_event():
+    batch = Batch("batch1", "BOUNCY-CHAIR", 10, eta=None)
+    product = Product(sku="BOUNCY-CHAIR", batches=[batch])
+    product.allocate(OrderLine("order1", "BOUNCY-CHAIR", 3))
+    assert product.events[-1] == events.Allocated(
+        "order1", "BOUNCY-CHAIR", 3, "batch1"
+    )
+
+
+def test_allocating_a_line_it_already_holds_records_nothing():
+    batch = Batch("batch1", "BOUNCY-CHAIR", 10, eta=None)
+    product = Product(sku="BOUNCY-CHAIR", batches=[batch], version_number=3)
+    line = OrderLine("order1", "BOUNCY-CHAIR", 3)
+    product.allocate(line)
+
+    assert product.allocate(line) == "batch1"
+    assert product.allocate_many([line]) == ["batch1"]
+
+    assert product.events == [events.Allocated("order1", "BOUNCY-CHAIR", 3, "batch1")]
+    assert product.version_number == 4
+    assert batch.available_quantity == 7
+
+
+def test_a_line_held_in_a_full_batch_is_not_allocated_again():
+    full = Batch("batch1", "BOUNCY-CHAIR", 3, eta=None)
+    spare = Batch("batch2", "BOUNCY-CHAIR", 10, eta=tomorrow)
+    product = Product(sku="BOUNCY-CHAIR", batches=[full, spare])
+    line = OrderLine("order1", "BOUNCY-CHAIR", 3)
+    product.allocate(line)
+
+    assert product.allocate(line) == "batch1"
+    assert product.allocate_many([line]) == ["batch1"]
+
+    assert spare.available_quantity == 10
+    assert len(product.events) == 1
+
+
+def test_deallocating_an_order_frees_its_lines_and_records_events():
+    batch = Batch("batch1", "SMALL-TABLE", 20, eta=None)
+    product = Product(sku="SMALL-TABLE", batches=[batch], version_number=7)
+    product.allocate(OrderLine("order1", "SMALL-TABLE", 5))
+    product.allocate(OrderLine("order2", "SMALL-TABLE", 3))
+
+    assert product.deallocate("order1") == ["batch1"]
+
+    assert batch.available_quantity == 17
+    assert product.events[-1] == events.Deallocated("order1", "SMALL-TABLE", 5)
+    assert product.version_number == 10
+
+
+def test_deallocating_an_unknown_order_changes_nothing():
+    batch = Batch("batch1", "SMALL-TABLE", 20, eta=None)
+    product = Product(sku="SMALL-TABLE", batches=[batch], version_number=7)
+
+    assert product.deallocate("order1") == []
+    assert product.version_number == 7
+    assert product.events == []
+
+
+def test_deallocating_follows_lines_moved_by_a_rebalance():
+    first = Batch("batch1", "SMALL-TABLE", 10, eta=None)
+    second = Batch("batch2", "SMALL-TABLE", 10, eta=tomorrow)
+    product = Product(sku="SMALL-TABLE", batches=[first, second])
+    product.allocate(OrderLine("order1", "SMALL-TABLE", 6))
+    product.deallocate("nobody")  # builds the line index before the move
+
+    product.change_batch_quantity("batch1", 5)
+    product.add_batch(Batch("batch3", "SMALL-TABLE", 10, eta=later))
+
+    assert product.deallocate("order1") == ["batch2"]
+    assert second.available_quantity == 10